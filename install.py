@@ -1,8 +1,5 @@
 import launch
 
-if not launch.is_installed("bs4"):
-    launch.run_pip("install bs4", "bs4 requirement for GDisk links parsing")
-
 if not launch.is_installed("requests-cache"):
     launch.run_pip("install requests-cache", "requests-cache requirement disabling download cache")
 
@@ -172,6 +172,13 @@ function updateDownloadCardState(id, state) {
         isResultBoxVisible = true
     } else if (state === 'Cancelled') {
         cardClass = 'mo-alert-warning'
+    } else if (state === 'Paused') {
+        cardClass = 'mo-alert-secondary'
+        isUrlVisible = true
+    } else if (state === 'Waiting') {
+        cardClass = 'mo-alert-warning'
+        isUrlVisible = true
+        isResultBoxVisible = true
     } else {
         return
     }
@@ -182,12 +189,31 @@ function updateDownloadCardState(id, state) {
     cardElement.className = className
     findElem('status-' + id).textContent = state
 
+    const pauseButton = findElem('pause-' + id)
+    if (pauseButton) {
+        pauseButton.textContent = state === 'Paused' ? 'Resume' : 'Pause'
+        const isQueued = state === 'Pending' || state === 'In Progress' || state === 'Waiting' || state === 'Paused'
+        pauseButton.style.display = isQueued ? 'inline-block' : 'none'
+    }
+
     updateDownloadBlockVisibility(id, 'url', isUrlVisible, 'block')
     updateDownloadBlockVisibility(id, 'info-bar', isDownloadProgressVisible, 'flex')
     updateDownloadBlockVisibility(id, 'progress', isDownloadProgressVisible, 'flex')
     updateDownloadBlockVisibility(id, 'result-box', isResultBoxVisible, 'block')
 }
 
+function toggleDownloadPause(id) {
+    const action = findElem('status-' + id).textContent === 'Paused' ? 'resume' : 'pause'
+    fetch(origin + '/mo/downloads/queue/' + action + '?record_id=' + encodeURIComponent(id), {method: 'POST'})
+        .catch(error => logMo(error))
+}
+
+function moveDownload(id, offset) {
+    fetch(origin + '/mo/downloads/queue/move?record_id=' + encodeURIComponent(id) + '&offset=' + offset,
+        {method: 'POST'})
+        .catch(error => logMo(error))
+}
+
 function updateResultText(id, title, text) {
     const elem = findElem('result-box-' + id)
     if (elem) {
@@ -225,9 +251,61 @@ function updateProgressBar(id, tag, isPreview, value) {
     }
 }
 
+let downloadEventSource = null
+
+/**
+ * Subscribes to download progress events. Stream starts with the whole state of the current download and is closed
+ * once the download is finished.
+ */
+function subscribeDownloadEvents() {
+    if (downloadEventSource) {
+        downloadEventSource.close()
+    }
+
+    downloadEventSource = new EventSource(origin + '/mo/downloads/events')
+    downloadEventSource.onmessage = function (event) {
+        const data = JSON.parse(event.data)
+
+        if (data.hasOwnProperty('records')) {
+            data.records.forEach(function (item, index) {
+                handleRecordUpdates(item)
+            });
+        }
+
+        if (data.hasOwnProperty('status_message')) {
+            updateStatusMessage(data.status_message)
+        }
+
+        if (data.hasOwnProperty('general_status') && data.general_status !== 'In Progress') {
+            downloadEventSource.close()
+            downloadEventSource = null
+            notifyDownloadFinished(data.seq)
+        }
+    }
+}
+
+function updateStatusMessage(html) {
+    const elem = findElem('mo-download-status-message')
+    if (elem) {
+        const content = elem.querySelector('.prose') || elem
+        content.innerHTML = html
+    }
+}
+
+function notifyDownloadFinished(seq) {
+    const textArea = findElem('mo-download-finished-box').querySelector('textarea')
+    textArea.value = seq
+    const event = new Event('input', {'bubbles': true, "composed": true});
+    textArea.dispatchEvent(event);
+}
+
 function handleProgressUpdates(value) {
     const data = JSON.parse(value);
 
+    if (data.hasOwnProperty('subscribe')) {
+        subscribeDownloadEvents()
+    }
+
     if (data.hasOwnProperty('records')) {
         data.records.forEach(function (item, index) {
             handleRecordUpdates(item)
@@ -1,9 +1,36 @@
+import asyncio
+import json
 import os
+import time
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 
+from scripts.mo.data.download_queue import DownloadQueue
+from scripts.mo.data.hash_service import HashService
+from scripts.mo.dl.download_manager import DownloadManager
 from scripts.mo.environment import logger, env
 
+_EVENTS_INTERVAL = 0.2
+_EVENTS_KEEP_ALIVE_INTERVAL = 15
+
+
+async def _download_events(request: Request, seq: int):
+    # Imported here, since UI module imports gradio.
+    from scripts.mo.ui_download import generate_progress_event
+
+    sent_at = time.monotonic()
+    while not await request.is_disconnected():
+        changes = DownloadManager.instance().get_changes(seq)
+        if changes['seq'] != seq:
+            seq = changes['seq']
+            yield f'id: {seq}\ndata: {json.dumps(generate_progress_event(changes))}\n\n'
+            sent_at = time.monotonic()
+        elif time.monotonic() - sent_at >= _EVENTS_KEEP_ALIVE_INTERVAL:
+            # Comment line keeps proxies from closing the idle connection.
+            yield ': keep-alive\n\n'
+            sent_at = time.monotonic()
+        await asyncio.sleep(_EVENTS_INTERVAL)
+
 
 def init_extension_api(app: FastAPI):
     @app.get('/mo/display-options')
@@ -24,4 +51,48 @@ def init_extension_api(app: FastAPI):
 
         return FileResponse(filename, headers={"Accept-Ranges": "bytes"})
 
+    @app.get('/mo/hashing')
+    async def get_hashing_state():
+        return HashService.instance().get_state()
+
+    @app.post('/mo/hashing/cancel')
+    async def cancel_hashing(path: str = ""):
+        if path:
+            HashService.instance().cancel(path)
+        else:
+            HashService.instance().cancel_all()
+        return HashService.instance().get_state()
+
+    @app.get('/mo/downloads/queue')
+    async def get_download_queue():
+        return DownloadQueue.instance().get_entries()
+
+    @app.post('/mo/downloads/queue/pause')
+    async def pause_download(record_id: str):
+        DownloadManager.instance().pause_download(record_id)
+        return DownloadQueue.instance().get_entries()
+
+    @app.post('/mo/downloads/queue/resume')
+    async def resume_download(record_id: str):
+        DownloadManager.instance().resume_download(record_id)
+        return DownloadQueue.instance().get_entries()
+
+    @app.post('/mo/downloads/queue/move')
+    async def move_download(record_id: str, offset: int):
+        DownloadManager.instance().move_download(record_id, offset)
+        return DownloadQueue.instance().get_entries()
+
+    @app.get('/mo/downloads/events')
+    async def get_download_events(request: Request):
+        """
+        Streams download progress as server-sent events. Every event carries changes made since the previous one,
+        reconnected client continues from its Last-Event-ID.
+        """
+        from starlette.responses import StreamingResponse
+
+        last_event_id = request.headers.get('Last-Event-ID', '')
+        seq = int(last_event_id) if last_event_id.isdigit() else 0
+        return StreamingResponse(_download_events(request, seq), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache'})
+
     logger.debug('Model Organizer API initialized')
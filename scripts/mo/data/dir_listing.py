@@ -0,0 +1,96 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Iterable
+
+PREVIEW_EXTENSIONS = [".png", ".jpg", ".webp"]
+INFO_EXTENSIONS = [".info", ".civitai.info"]
+
+_MAX_CACHED_DIRS = 4096
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class DirListing:
+    """
+    In-memory listing of a single directory. Resolves model sidecar files (preview, info and json) without
+    touching the file system.
+    """
+
+    def __init__(self, path: str, mtime_ns: Optional[int], filenames: Iterable):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.filenames = frozenset(filenames)
+        self._folded_filenames = {}
+        for filename in sorted(self.filenames):
+            self._folded_filenames.setdefault(filename.casefold(), filename)
+
+    def _find_first(self, candidates) -> Optional[str]:
+        candidates = list(candidates)
+        for filename in candidates:
+            if filename in self.filenames:
+                return os.path.join(self.path, filename)
+        # Case-insensitive file systems (Windows, macOS) resolve Model.png to Model.PNG as well.
+        for filename in candidates:
+            filename = self._folded_filenames.get(filename.casefold())
+            if filename is not None:
+                return os.path.join(self.path, filename)
+        return None
+
+    def find_preview(self, filename_no_ext: str) -> Optional[str]:
+        return self._find_first(filename_no_ext + suffix + ext
+                                for ext in PREVIEW_EXTENSIONS for suffix in ('', '.preview'))
+
+    def find_info(self, filename_no_ext: str) -> Optional[str]:
+        return self._find_first(filename_no_ext + ext for ext in INFO_EXTENSIONS)
+
+    def find_json(self, filename_no_ext: str) -> Optional[str]:
+        return self._find_first([filename_no_ext + '.json'])
+
+
+def _put(listing: DirListing):
+    with _cache_lock:
+        _cache[listing.path] = listing
+        _cache.move_to_end(listing.path)
+        while len(_cache) > _MAX_CACHED_DIRS:
+            _cache.popitem(last=False)
+
+
+def put_dir_listing(dir_path: str, mtime_ns: int, filenames: Iterable) -> DirListing:
+    """
+    Stores listing of the directory which was already scanned by the caller.
+    :param dir_path: directory path.
+    :param mtime_ns: directory mtime at the moment of the scan.
+    :param filenames: names of the files in the directory.
+    :return: stored DirListing.
+    """
+    listing = DirListing(dir_path, mtime_ns, filenames)
+    _put(listing)
+    return listing
+
+
+def get_dir_listing(dir_path: str) -> DirListing:
+    """
+    Returns cached directory listing. Directory is rescanned only if its mtime was changed.
+    :param dir_path: directory path.
+    :return: DirListing, empty if directory does not exist.
+    """
+    try:
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+    except OSError:
+        return DirListing(dir_path, None, [])
+
+    with _cache_lock:
+        listing = _cache.get(dir_path)
+    if listing is not None and listing.mtime_ns == mtime_ns:
+        return listing
+
+    try:
+        with os.scandir(dir_path) as it:
+            filenames = [entry.name for entry in it if entry.is_file()]
+    except OSError:
+        return DirListing(dir_path, None, [])
+
+    return put_dir_listing(dir_path, mtime_ns, filenames)
+
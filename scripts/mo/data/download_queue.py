@@ -0,0 +1,210 @@
+import threading
+import time
+from typing import List, Optional
+
+from scripts.mo.data import local_db
+
+QUEUE_STATUS_QUEUED = 'Queued'
+QUEUE_STATUS_DOWNLOADING = 'Downloading'
+QUEUE_STATUS_PAUSED = 'Paused'
+QUEUE_STATUS_FAILED = 'Failed'
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+
+class DownloadQueue:
+    """
+    Persistent queue of the records to download. Items are taken in priority and then position order, failed
+    items wait until their next attempt time. Queue is kept in the local database, so downloads continue after
+    browser reload or webui restart.
+    """
+    __instance = None
+    __lock = threading.Lock()
+
+    def __init__(self):
+        self._queue_lock = threading.Lock()
+        self._initialize()
+
+    @staticmethod
+    def instance():
+        if DownloadQueue.__instance is None:
+            with DownloadQueue.__lock:
+                if DownloadQueue.__instance is None:
+                    DownloadQueue.__instance = DownloadQueue()
+        return DownloadQueue.__instance
+
+    @staticmethod
+    def _initialize():
+        connection = local_db.connection()
+        connection.execute('''CREATE TABLE IF NOT EXISTS DownloadQueue
+                                    (record_id TEXT PRIMARY KEY,
+                                    priority INTEGER DEFAULT 1,
+                                    position INTEGER DEFAULT 0,
+                                    status TEXT NOT NULL,
+                                    attempts INTEGER DEFAULT 0,
+                                    next_attempt_at REAL DEFAULT 0,
+                                    last_error TEXT,
+                                    added_at REAL)
+                                 ''')
+        # Downloads interrupted by the restart are taken again.
+        connection.execute('UPDATE DownloadQueue SET status=? WHERE status=?',
+                           (QUEUE_STATUS_QUEUED, QUEUE_STATUS_DOWNLOADING))
+        connection.commit()
+
+    def add(self, record_ids: List, priority: int = PRIORITY_NORMAL):
+        """
+        Adds records to the end of the queue. Records which are already queued are moved to the end with the given
+        priority, paused and failed ones are queued again.
+        :param record_ids: ids of the records to download.
+        :param priority: PRIORITY_HIGH or PRIORITY_NORMAL.
+        :return: None.
+        """
+        with self._queue_lock:
+            connection = local_db.connection()
+            cursor = connection.cursor()
+            cursor.execute('SELECT COALESCE(MAX(position), 0) FROM DownloadQueue')
+            position = cursor.fetchone()[0]
+            for record_id in record_ids:
+                position += 1
+                cursor.execute('''INSERT INTO DownloadQueue(record_id, priority, position, status, added_at)
+                                    VALUES (?, ?, ?, ?, ?)
+                                    ON CONFLICT(record_id) DO UPDATE SET
+                                        priority=excluded.priority,
+                                        position=excluded.position,
+                                        status=excluded.status,
+                                        attempts=0,
+                                        next_attempt_at=0,
+                                        last_error=NULL
+                                    WHERE status!=?''',
+                               (str(record_id), priority, position, QUEUE_STATUS_QUEUED, time.time(),
+                                QUEUE_STATUS_DOWNLOADING))
+            connection.commit()
+
+    def take(self) -> Optional[str]:
+        """
+        Takes the next record which is due for download and marks it as downloading.
+        :return: record id or None if there is no due records.
+        """
+        with self._queue_lock:
+            connection = local_db.connection()
+            cursor = connection.cursor()
+            cursor.execute('SELECT record_id FROM DownloadQueue WHERE status=? AND next_attempt_at<=? '
+                           'ORDER BY priority, position LIMIT 1', (QUEUE_STATUS_QUEUED, time.time()))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute('UPDATE DownloadQueue SET status=? WHERE record_id=?', (QUEUE_STATUS_DOWNLOADING, row[0]))
+            connection.commit()
+            return row[0]
+
+    def get_next_attempt_delay(self) -> Optional[float]:
+        """
+        Returns time until the nearest queued record is due.
+        :return: delay in seconds, 0 if some record is due now, None if there is no queued records.
+        """
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT MIN(next_attempt_at) FROM DownloadQueue WHERE status=?', (QUEUE_STATUS_QUEUED,))
+        next_attempt_at = cursor.fetchone()[0]
+        return None if next_attempt_at is None else max(0.0, next_attempt_at - time.time())
+
+    def complete(self, record_id):
+        self._execute('DELETE FROM DownloadQueue WHERE record_id=?', (str(record_id),))
+
+    def release(self, record_id):
+        """
+        Returns record which download was interrupted back to the queue.
+        """
+        self._execute('UPDATE DownloadQueue SET status=? WHERE record_id=? AND status=?',
+                      (QUEUE_STATUS_QUEUED, str(record_id), QUEUE_STATUS_DOWNLOADING))
+
+    def retry(self, record_id, error: str, delay: float) -> int:
+        """
+        Schedules next download attempt of the failed record.
+        :param record_id: record id.
+        :param error: error description.
+        :param delay: delay before the next attempt in seconds.
+        :return: number of failed attempts.
+        """
+        self._execute('UPDATE DownloadQueue SET status=?, attempts=attempts+1, next_attempt_at=?, last_error=? '
+                      'WHERE record_id=? AND status=?',
+                      (QUEUE_STATUS_QUEUED, time.time() + delay, error, str(record_id), QUEUE_STATUS_DOWNLOADING))
+        return self.get_attempts(record_id)
+
+    def defer(self, record_id, delay: float):
+        """
+        Returns record which can't be downloaded now back to the queue without counting it as a failed attempt.
+        """
+        self._execute('UPDATE DownloadQueue SET status=?, next_attempt_at=? WHERE record_id=? AND status=?',
+                      (QUEUE_STATUS_QUEUED, time.time() + delay, str(record_id), QUEUE_STATUS_DOWNLOADING))
+
+    def fail(self, record_id, error: str):
+        self._execute('UPDATE DownloadQueue SET status=?, attempts=attempts+1, last_error=? WHERE record_id=?',
+                      (QUEUE_STATUS_FAILED, error, str(record_id)))
+
+    def get_attempts(self, record_id) -> int:
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT attempts FROM DownloadQueue WHERE record_id=?', (str(record_id),))
+        row = cursor.fetchone()
+        return 0 if row is None else row[0]
+
+    def pause(self, record_id):
+        self._execute('UPDATE DownloadQueue SET status=? WHERE record_id=? AND status IN (?, ?)',
+                      (QUEUE_STATUS_PAUSED, str(record_id), QUEUE_STATUS_QUEUED, QUEUE_STATUS_DOWNLOADING))
+
+    def resume(self, record_id):
+        self._execute('UPDATE DownloadQueue SET status=?, next_attempt_at=0 WHERE record_id=? AND status IN (?, ?)',
+                      (QUEUE_STATUS_QUEUED, str(record_id), QUEUE_STATUS_PAUSED, QUEUE_STATUS_FAILED))
+
+    def is_paused(self, record_id) -> bool:
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT 1 FROM DownloadQueue WHERE record_id=? AND status=?',
+                       (str(record_id), QUEUE_STATUS_PAUSED))
+        return cursor.fetchone() is not None
+
+    def move(self, record_id, offset: int):
+        """
+        Moves record up or down the queue by swapping its place with the neighbour record.
+        :param record_id: record id.
+        :param offset: -1 to move up, 1 to move down.
+        :return: None.
+        """
+        with self._queue_lock:
+            connection = local_db.connection()
+            cursor = connection.cursor()
+            cursor.execute('SELECT record_id, priority, position FROM DownloadQueue ORDER BY priority, position')
+            rows = cursor.fetchall()
+            index = next((i for i, row in enumerate(rows) if row[0] == str(record_id)), None)
+            if index is None or not 0 <= index + offset < len(rows):
+                return
+            current, neighbour = rows[index], rows[index + offset]
+            cursor.execute('UPDATE DownloadQueue SET priority=?, position=? WHERE record_id=?',
+                           (neighbour[1], neighbour[2], current[0]))
+            cursor.execute('UPDATE DownloadQueue SET priority=?, position=? WHERE record_id=?',
+                           (current[1], current[2], neighbour[0]))
+            connection.commit()
+
+    def clear(self):
+        """
+        Removes all records from the queue except failed ones, which are kept to show their errors.
+        """
+        self._execute('DELETE FROM DownloadQueue WHERE status!=?', (QUEUE_STATUS_FAILED,))
+
+    def has_pending(self) -> bool:
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT 1 FROM DownloadQueue WHERE status IN (?, ?) LIMIT 1',
+                       (QUEUE_STATUS_QUEUED, QUEUE_STATUS_DOWNLOADING))
+        return cursor.fetchone() is not None
+
+    def get_entries(self) -> List:
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT record_id, priority, status, attempts, next_attempt_at, last_error '
+                       'FROM DownloadQueue ORDER BY priority, position')
+        return [{'record_id': row[0], 'priority': row[1], 'status': row[2], 'attempts': row[3],
+                 'next_attempt_at': row[4], 'last_error': row[5]} for row in cursor.fetchall()]
+
+    def _execute(self, sql: str, params: tuple):
+        with self._queue_lock:
+            connection = local_db.connection()
+            connection.execute(sql, params)
+            connection.commit()
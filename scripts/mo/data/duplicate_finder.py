@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+from typing import List
+
+from scripts.mo.data.file_index import FileIndex
+from scripts.mo.data.hash_cache import HashCache
+from scripts.mo.data.record_utils import get_local_model_dirs
+from scripts.mo.environment import logger
+from scripts.mo.hashing import HASH_SHA256
+from scripts.mo.ui_format import format_bytes
+
+
+def _group_by(items: List, key) -> List:
+    groups = {}
+    for item in items:
+        value = key(item)
+        if value is not None:
+            groups.setdefault(value, []).append(item)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+class DuplicateFinder:
+    """
+    Finds duplicate model files in background. Files are grouped by size first, then by quick fingerprint and
+    only the remaining candidates are fully hashed, so unique files are never read completely.
+    Files which are already hardlinks of each other are not reported.
+    """
+    __instance = None
+    __lock = threading.Lock()
+
+    def __init__(self):
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._state = {}
+
+    @staticmethod
+    def instance():
+        if DuplicateFinder.__instance is None:
+            with DuplicateFinder.__lock:
+                if DuplicateFinder.__instance is None:
+                    DuplicateFinder.__instance = DuplicateFinder()
+        return DuplicateFinder.__instance
+
+    def start(self):
+        """
+        Starts duplicates search in background if it is not running yet.
+        :return: None.
+        """
+        with DuplicateFinder.__lock:
+            if self.is_running():
+                return
+            self._stop_event.clear()
+            self._state = {'status': 'Running', 'started_at': time.time()}
+            self._thread = threading.Thread(target=self._run, name='mo-duplicate-finder', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def get_state(self) -> dict:
+        return dict(self._state)
+
+    def _run(self):
+        try:
+            self._find()
+            self._state['status'] = 'Cancelled' if self._stop_event.is_set() else 'Completed'
+        except Exception as ex:
+            logger.exception(ex)
+            self._state['status'] = 'Error'
+            self._state['error'] = str(ex)
+        finally:
+            self._state['finished_at'] = time.time()
+
+    def _find(self):
+        files = FileIndex.instance().get_model_files(get_local_model_dirs())
+        self._state['files_checked'] = len(files)
+
+        size_groups = _group_by(files, lambda f: f.size if f.size > 0 else None)
+        self._state['size_groups'] = len(size_groups)
+
+        duplicates = []
+        for size_group in size_groups:
+            # Hardlinks share the data already, one path per inode is enough.
+            unique_files = list(self._unique_inodes(size_group).values())
+            for fingerprint_group in _group_by(unique_files, FileIndex.get_fingerprint):
+                if self._stop_event.is_set():
+                    return
+                for hash_group in _group_by(fingerprint_group, self._get_sha256):
+                    duplicates.append(hash_group)
+
+        groups = []
+        for group in duplicates:
+            # File with most hardlinks is kept, otherwise its other links would still hold a copy after relinking.
+            paths = sorted((indexed_file.path for indexed_file in group),
+                           key=lambda path: (-self._get_links_count(path), path))
+            groups.append({
+                'sha256': self._get_sha256(group[0]),
+                'size': group[0].size,
+                'files': paths,
+                'reclaimable_bytes': group[0].size * (len(group) - 1)
+            })
+        groups.sort(key=lambda g: g['reclaimable_bytes'], reverse=True)
+
+        self._state['groups'] = groups
+        self._state['reclaimable_bytes'] = sum(group['reclaimable_bytes'] for group in groups)
+        self._state['reclaimable'] = format_bytes(self._state['reclaimable_bytes'])
+
+    @staticmethod
+    def _unique_inodes(files: List) -> dict:
+        result = {}
+        for indexed_file in files:
+            try:
+                stat = os.stat(indexed_file.path)
+            except OSError:
+                continue
+            result.setdefault((stat.st_dev, stat.st_ino), indexed_file)
+        return result
+
+    @staticmethod
+    def _get_links_count(path: str) -> int:
+        try:
+            return os.stat(path).st_nlink
+        except OSError:
+            return 0
+
+    def _get_sha256(self, indexed_file):
+        try:
+            hashes = HashCache.instance().get_hashes(indexed_file.path, [HASH_SHA256], self._stop_event)
+        except OSError:
+            return None
+        return hashes[HASH_SHA256] if hashes else None
+
+    def link_duplicates(self) -> dict:
+        """
+        Replaces duplicates found by the last search with hardlinks to the first file of their group.
+        Files are checked against cached SHA256 before replacement, files on other file systems are skipped.
+        :return: dict with linked files count, reclaimed bytes and errors.
+        """
+        if self.is_running():
+            raise RuntimeError('Duplicates search is running')
+
+        result = {'linked': 0, 'reclaimed_bytes': 0, 'errors': []}
+        for group in self._state.get('groups', []):
+            source = group['files'][0]
+            for duplicate in group['files'][1:]:
+                try:
+                    if self._link(source, duplicate, group['sha256']):
+                        result['linked'] += 1
+                        result['reclaimed_bytes'] += group['size']
+                except OSError as ex:
+                    result['errors'].append(f'{duplicate}: {ex}')
+        self._state['groups'] = []
+        self._state['reclaimable_bytes'] = 0
+        self._state['reclaimable'] = format_bytes(0)
+        result['reclaimed'] = format_bytes(result['reclaimed_bytes'])
+        return result
+
+    @staticmethod
+    def _link(source: str, duplicate: str, sha256: str) -> bool:
+        source_stat = os.stat(source)
+        duplicate_stat = os.stat(duplicate)
+        if source_stat.st_dev != duplicate_stat.st_dev:
+            raise OSError('File is on another file system')
+        if source_stat.st_ino == duplicate_stat.st_ino:
+            return False
+
+        # Files changed since the search are not touched, cached hash is valid only for unchanged file.
+        for path, stat in [(source, source_stat), (duplicate, duplicate_stat)]:
+            if HashCache.instance().get_cached(path, stat).get(HASH_SHA256) != sha256:
+                raise OSError('File was changed since the search')
+
+        temp_path = duplicate + '.mo-link'
+        os.link(source, temp_path)
+        try:
+            os.replace(temp_path, duplicate)
+        except OSError:
+            os.remove(temp_path)
+            raise
+        logger.info(f'Replaced duplicate {duplicate} with hardlink to {source}')
+        return True
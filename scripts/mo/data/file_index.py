@@ -0,0 +1,417 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from scripts.mo.data import local_db
+from scripts.mo.data.dir_listing import DirListing, put_dir_listing
+from scripts.mo.data.sidecar_cache import SidecarCache, KIND_INFO, KIND_JSON
+from scripts.mo.environment import logger
+from scripts.mo.hashing import quick_fingerprint
+from scripts.mo.utils import is_model_filename, get_unique_model_dirs
+
+_MAX_SCAN_WORKERS = 8
+
+
+class IndexedFile:
+    def __init__(self, path: str, size: int, mtime_ns: int, ctime: float, metadata: dict):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.ctime = ctime
+        self.metadata = metadata
+
+    def __str__(self):
+        return f'path="{self.path}", size="{self.size}", mtime_ns="{self.mtime_ns}"'
+
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _strip_path(path: str) -> str:
+    stripped = path.rstrip('/\\')
+    return stripped if stripped else path
+
+
+class _DirScan:
+    def __init__(self, path: str, parent: Optional[str], mtime_ns: int, subdirs: List, files: List,
+                 sidecar_entries: List, sidecars: List):
+        self.path = path
+        self.parent = parent
+        self.mtime_ns = mtime_ns
+        self.subdirs = subdirs
+        self.files = files
+        self.sidecar_entries = sidecar_entries
+        self.sidecars = sidecars
+
+
+def _parse_sidecars(listing: DirListing, model_filename, sidecar_entries: List, sidecars: List) -> dict:
+    filename_no_ext = os.path.splitext(model_filename)[0]
+    metadata = {}
+
+    for key, sidecar_path in [(KIND_INFO, listing.find_info(filename_no_ext)),
+                              (KIND_JSON, listing.find_json(filename_no_ext))]:
+        if sidecar_path is None:
+            continue
+        try:
+            stat = os.stat(sidecar_path)
+        except OSError:
+            continue
+        sidecars.append([sidecar_path, stat.st_mtime_ns, stat.st_size])
+        metadata[key], entry = SidecarCache.instance().lookup(sidecar_path, key, stat)
+        if entry is not None:
+            sidecar_entries.append(entry)
+
+    return metadata
+
+
+def _is_sidecar_changed(sidecars: List) -> bool:
+    # Sidecar edited in place keeps its directory mtime.
+    for sidecar_path, mtime_ns, size in sidecars:
+        try:
+            stat = os.stat(sidecar_path)
+        except OSError:
+            return True
+        if stat.st_mtime_ns != mtime_ns or stat.st_size != size:
+            return True
+    return False
+
+
+def _scan_dir(dir_path, parent, mtime_ns) -> Optional[_DirScan]:
+    subdirs = []
+    model_entries = []
+    filenames = set()
+
+    try:
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    filenames.add(entry.name)
+                    if is_model_filename(entry.name):
+                        model_entries.append(entry)
+    except OSError as ex:
+        logger.warning(f'Failed to scan directory {dir_path}: {ex}')
+        return None
+
+    # Listing is shared with the preview lookups of the UI, so they don't have to rescan the directory.
+    listing = put_dir_listing(dir_path, mtime_ns, filenames)
+
+    files = []
+    sidecar_entries = []
+    sidecars = []
+    for entry in model_entries:
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        metadata = _parse_sidecars(listing, entry.name, sidecar_entries, sidecars)
+        files.append(IndexedFile(entry.path, stat.st_size, stat.st_mtime_ns, stat.st_ctime, metadata))
+
+    return _DirScan(dir_path, parent, mtime_ns, subdirs, files, sidecar_entries, sidecars)
+
+
+def _collect_changes(root, known_dirs: dict, force_root: bool):
+    """
+    Walks the directory tree and rescans directories with changed mtime or changed sidecar files. Does not touch
+    the database, so several trees can be processed in parallel.
+    :param root: tree root directory path.
+    :param known_dirs: indexed directories dict, path -> (mtime_ns, list of subdirectories paths, list of sidecar
+    files [path, mtime_ns, size]).
+    :param force_root: rescan root directory even if its mtime was not changed.
+    :return: tuple of rescanned directories list, removed directories list and checked directories count.
+    """
+    scans = []
+    removed = []
+    checked = 0
+
+    stack = [(root, None)]
+    while stack:
+        dir_path, parent = stack.pop()
+        checked += 1
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            removed.append(dir_path)
+            continue
+
+        known = known_dirs.get(dir_path)
+        if known is not None and known[0] == mtime_ns and not (force_root and dir_path == root) and \
+                not _is_sidecar_changed(known[2]):
+            subdirs = known[1]
+        else:
+            scan = _scan_dir(dir_path, parent, mtime_ns)
+            if scan is None:
+                continue
+            scans.append(scan)
+            subdirs = scan.subdirs
+
+        stack.extend((subdir, dir_path) for subdir in subdirs)
+
+    return scans, removed, checked
+
+
+class FileIndex:
+    """
+    Persistent index of model files in the model directories. Directories are rescanned only when their mtime
+    or one of their sidecar files changes, so refresh of an unchanged tree costs a stat call per directory and
+    sidecar file.
+    """
+    __instance = None
+    __lock = threading.Lock()
+
+    def __init__(self):
+        self._refresh_lock = threading.Lock()
+        self._last_refresh = {}
+        self._initialize()
+        SidecarCache.instance()
+
+    @staticmethod
+    def instance():
+        if FileIndex.__instance is None:
+            with FileIndex.__lock:
+                if FileIndex.__instance is None:
+                    FileIndex.__instance = FileIndex()
+        return FileIndex.__instance
+
+    @staticmethod
+    def _initialize():
+        connection = local_db.connection()
+        cursor = connection.cursor()
+        cursor.execute('''CREATE TABLE IF NOT EXISTS IndexedDir
+                                    (path TEXT PRIMARY KEY,
+                                    parent TEXT,
+                                    mtime_ns INTEGER DEFAULT 0,
+                                    sidecars TEXT DEFAULT '[]')
+                                 ''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS IndexedFile
+                                    (path TEXT PRIMARY KEY,
+                                    dir TEXT NOT NULL,
+                                    size INTEGER DEFAULT 0,
+                                    mtime_ns INTEGER DEFAULT 0,
+                                    ctime REAL DEFAULT 0,
+                                    metadata TEXT DEFAULT '{}',
+                                    fingerprint TEXT)
+                                 ''')
+        cursor.execute('PRAGMA table_info(IndexedFile)')
+        if 'fingerprint' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE IndexedFile ADD COLUMN fingerprint TEXT')
+        cursor.execute('PRAGMA table_info(IndexedDir)')
+        if 'sidecars' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE IndexedDir ADD COLUMN sidecars TEXT DEFAULT '[]'")
+            # Directories are rescanned once to record their sidecar files.
+            cursor.execute('UPDATE IndexedDir SET mtime_ns=0')
+        cursor.execute('CREATE INDEX IF NOT EXISTS IndexedDir_parent_idx ON IndexedDir(parent)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS IndexedFile_dir_idx ON IndexedFile(dir)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS IndexedFile_size_idx ON IndexedFile(size)')
+        connection.commit()
+
+    def refresh(self, roots: List):
+        """
+        Revalidates index for the model directories. Nested model directories are revalidated as a part of
+        their parent tree, separate trees are processed in parallel.
+        :param roots: list of model directories paths.
+        :return: None.
+        """
+        roots = get_unique_model_dirs([_strip_path(root) for root in roots if root])
+        self._update(roots, force_root=False)
+
+    def refresh_dirs(self, dirs: List):
+        """
+        Rescans directories regardless of their mtime and revalidates their subdirectories.
+        Used to apply file system change events.
+        :param dirs: list of directories paths to rescan.
+        :return: None.
+        """
+        self._update([_strip_path(dir_path) for dir_path in dirs], force_root=True)
+
+    def _update(self, roots: List, force_root: bool):
+        if not roots:
+            return
+
+        with self._refresh_lock:
+            start = time.time()
+            connection = local_db.connection()
+            cursor = connection.cursor()
+            known_dirs = self._load_known_dirs(cursor)
+
+            with ThreadPoolExecutor(max_workers=min(len(roots), _MAX_SCAN_WORKERS)) as executor:
+                results = list(executor.map(lambda root: _collect_changes(root, known_dirs, force_root), roots))
+
+            stats = {'dirs_checked': 0, 'dirs_rescanned': 0}
+            try:
+                for scans, removed, checked in results:
+                    for scan in scans:
+                        self._apply_scan(cursor, scan, known_dirs)
+                    for dir_path in removed:
+                        self._remove_dir(cursor, dir_path)
+                    stats['dirs_checked'] += checked
+                    stats['dirs_rescanned'] += len(scans)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+
+            stats['duration_ms'] = int((time.time() - start) * 1000)
+            stats['finished_at'] = time.time()
+            self._last_refresh = stats
+            logger.debug(f'File index refreshed: {stats}')
+
+    def rebuild(self, roots: List):
+        """
+        Drops all indexed data and builds index from scratch.
+        :param roots: list of model directories paths.
+        :return: None.
+        """
+        with self._refresh_lock:
+            connection = local_db.connection()
+            connection.execute('DELETE FROM IndexedDir')
+            connection.execute('DELETE FROM IndexedFile')
+            connection.commit()
+        self.refresh(roots)
+
+    def get_model_files(self, roots: List, refresh: bool = True) -> List:
+        """
+        Returns indexed model files placed in the model directories and their subdirectories.
+        :param roots: list of model directories paths.
+        :param refresh: revalidate changed directories before lookup if True.
+        :return: list of IndexedFile.
+        """
+        if refresh:
+            self.refresh(roots)
+
+        cursor = local_db.connection().cursor()
+        result = []
+        seen = set()
+        for root in roots:
+            if not root:
+                continue
+            root = _strip_path(root)
+            cursor.execute("""SELECT path, size, mtime_ns, ctime, metadata FROM IndexedFile
+                                WHERE dir=? OR dir LIKE ? ESCAPE '\\' ORDER BY path""",
+                           (root, _escape_like(os.path.join(root, '')) + '%'))
+            for row in cursor.fetchall():
+                if row[0] not in seen:
+                    seen.add(row[0])
+                    result.append(IndexedFile(row[0], row[1], row[2], row[3], json.loads(row[4])))
+        return result
+
+    def get_files_by_size(self, size: int) -> List:
+        """
+        Returns indexed model files of the given size.
+        :param size: file size in bytes.
+        :return: list of IndexedFile.
+        """
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT path, size, mtime_ns, ctime, metadata FROM IndexedFile WHERE size=? ORDER BY path',
+                       (size,))
+        return [IndexedFile(row[0], row[1], row[2], row[3], json.loads(row[4])) for row in cursor.fetchall()]
+
+    @staticmethod
+    def get_fingerprint(indexed_file: IndexedFile) -> Optional[str]:
+        """
+        Returns quick fingerprint of the indexed file. Fingerprint is calculated on the first request and kept
+        while the file is not changed.
+        :param indexed_file: indexed file.
+        :return: fingerprint hex string, None if file is not available or was changed since it was indexed.
+        """
+        connection = local_db.connection()
+        cursor = connection.cursor()
+        cursor.execute('SELECT fingerprint FROM IndexedFile WHERE path=? AND size=? AND mtime_ns=?',
+                       (indexed_file.path, indexed_file.size, indexed_file.mtime_ns))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        if row[0] is not None:
+            return row[0]
+
+        try:
+            stat = os.stat(indexed_file.path)
+            if stat.st_size != indexed_file.size or stat.st_mtime_ns != indexed_file.mtime_ns:
+                return None
+            fingerprint = quick_fingerprint(indexed_file.path)
+        except OSError:
+            return None
+
+        cursor.execute('UPDATE IndexedFile SET fingerprint=? WHERE path=? AND size=? AND mtime_ns=?',
+                       (fingerprint, indexed_file.path, indexed_file.size, indexed_file.mtime_ns))
+        connection.commit()
+        return fingerprint
+
+    def get_dirs(self, roots: List) -> List:
+        """
+        Returns indexed directories of the model directories trees.
+        :param roots: list of model directories paths.
+        :return: list of directories paths.
+        """
+        cursor = local_db.connection().cursor()
+        result = set()
+        for root in roots:
+            if not root:
+                continue
+            root = _strip_path(root)
+            cursor.execute("SELECT path FROM IndexedDir WHERE path=? OR path LIKE ? ESCAPE '\\'",
+                           (root, _escape_like(os.path.join(root, '')) + '%'))
+            result.update(row[0] for row in cursor.fetchall())
+        return list(result)
+
+    def get_stats(self) -> dict:
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT COUNT(*) FROM IndexedDir')
+        dirs_count = cursor.fetchone()[0]
+        cursor.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM IndexedFile')
+        files_count, total_size = cursor.fetchone()
+        return {
+            'database': local_db.database_file(),
+            'dirs_count': dirs_count,
+            'files_count': files_count,
+            'files_total_size': total_size,
+            'sidecar_cache': SidecarCache.instance().get_stats(),
+            'last_refresh': self._last_refresh
+        }
+
+    @staticmethod
+    def _load_known_dirs(cursor) -> dict:
+        cursor.execute('SELECT path, parent, mtime_ns, sidecars FROM IndexedDir')
+        rows = cursor.fetchall()
+        known_dirs = {row[0]: (row[2], [], json.loads(row[3] or '[]')) for row in rows}
+        for path, parent, _, _ in rows:
+            if parent is not None and parent in known_dirs:
+                known_dirs[parent][1].append(path)
+        return known_dirs
+
+    def _apply_scan(self, cursor, scan: _DirScan, known_dirs: dict):
+        known = known_dirs.get(scan.path)
+        if known is not None:
+            for subdir in known[1]:
+                if subdir not in scan.subdirs:
+                    self._remove_dir(cursor, subdir)
+
+        # Fingerprints of the files which were not changed stay valid.
+        cursor.execute('SELECT path, size, mtime_ns, fingerprint FROM IndexedFile '
+                       'WHERE dir=? AND fingerprint IS NOT NULL', (scan.path,))
+        fingerprints = {(row[0], row[1], row[2]): row[3] for row in cursor.fetchall()}
+
+        cursor.execute('DELETE FROM IndexedFile WHERE dir=?', (scan.path,))
+        cursor.executemany('INSERT OR REPLACE INTO IndexedFile(path, dir, size, mtime_ns, ctime, metadata, '
+                           'fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           [(f.path, scan.path, f.size, f.mtime_ns, f.ctime, json.dumps(f.metadata),
+                             fingerprints.get((f.path, f.size, f.mtime_ns))) for f in scan.files])
+        SidecarCache.instance().store(cursor, scan.sidecar_entries)
+
+        # Nested model directory may be revalidated as a root, keep the link to its parent directory then.
+        cursor.execute('''INSERT INTO IndexedDir(path, parent, mtime_ns, sidecars) VALUES (?, ?, ?, ?)
+                            ON CONFLICT(path) DO UPDATE SET mtime_ns=excluded.mtime_ns,
+                                                            sidecars=excluded.sidecars,
+                                                            parent=COALESCE(excluded.parent, parent)''',
+                       (scan.path, scan.parent, scan.mtime_ns, json.dumps(scan.sidecars)))
+
+    @staticmethod
+    def _remove_dir(cursor, dir_path):
+        prefix = _escape_like(os.path.join(dir_path, '')) + '%'
+        cursor.execute("DELETE FROM IndexedFile WHERE dir=? OR dir LIKE ? ESCAPE '\\'", (dir_path, prefix))
+        cursor.execute("DELETE FROM IndexedDir WHERE path=? OR path LIKE ? ESCAPE '\\'", (dir_path, prefix))
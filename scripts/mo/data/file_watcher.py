@@ -0,0 +1,255 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from typing import Callable, List
+
+from scripts.mo.data.file_index import FileIndex
+from scripts.mo.environment import logger
+
+MODE_INOTIFY = 'inotify'
+MODE_POLLING = 'polling'
+
+_POLLING_INTERVAL = 30
+_DEBOUNCE_SECONDS = 2
+_MAX_DEBOUNCE_SECONDS = 10
+_ROOTS_CHECK_INTERVAL = 10
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | \
+              _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class _WatchLimitError(Exception):
+    pass
+
+
+class _Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add_watch(self, path: str) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise _WatchLimitError(f'inotify watch limit exhausted on {path}')
+            raise OSError(error, f'inotify_add_watch failed: {path}')
+        return wd
+
+    def remove_watch(self, wd: int):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self) -> List:
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+            events.append((wd, mask))
+            offset += _EVENT_HEADER.size + name_len
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _is_inotify_supported() -> bool:
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        return hasattr(libc, 'inotify_init1')
+    except OSError:
+        return False
+
+
+class FileWatcher:
+    """
+    Keeps FileIndex up to date by applying model directories changes in background. Uses inotify where it is
+    available and falls back to periodic polling otherwise or when the inotify watch limit is exhausted.
+    Events are collected into a set of changed directories and applied after a quiet period.
+    """
+    __instance = None
+    __lock = threading.Lock()
+
+    def __init__(self):
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._roots_provider = None
+        self._roots = []
+        self._mode = None
+        self._watches = {}
+        self._last_error = None
+
+    @staticmethod
+    def instance():
+        if FileWatcher.__instance is None:
+            with FileWatcher.__lock:
+                if FileWatcher.__instance is None:
+                    FileWatcher.__instance = FileWatcher()
+        return FileWatcher.__instance
+
+    def start(self, roots_provider: Callable[[], List]):
+        if self.is_running():
+            logger.warning('File watcher already running')
+            return
+
+        self._roots_provider = roots_provider
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='mo-file-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.is_running():
+            return
+        self._stop_event.set()
+        self._thread.join()
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def is_watching(self, roots: List) -> bool:
+        """
+        Checks index for the roots is kept up to date by the watcher, so no refresh is required before lookup.
+        :param roots: list of model directories paths.
+        :return: True if watcher is running and watches all the roots.
+        """
+        if not self.is_running() or self._mode is None:
+            return False
+        watched = set(os.path.normpath(root) for root in self._roots)
+        return all(os.path.normpath(root) in watched for root in roots if root)
+
+    def get_state(self) -> dict:
+        return {
+            'running': self.is_running(),
+            'mode': self._mode,
+            'roots': self._roots,
+            'watches_count': len(self._watches),
+            'last_error': self._last_error
+        }
+
+    def _current_roots(self) -> List:
+        return list(filter(None, self._roots_provider()))
+
+    def _run(self):
+        try:
+            if _is_inotify_supported():
+                try:
+                    self._run_inotify()
+                except _WatchLimitError as ex:
+                    logger.warning(f'{ex}, falling back to polling.')
+                    self._last_error = str(ex)
+            if not self._stop_event.is_set():
+                self._run_polling()
+        except Exception as ex:
+            self._last_error = str(ex)
+            logger.exception(ex)
+        finally:
+            self._mode = None
+            self._watches = {}
+
+    def _run_polling(self):
+        logger.debug('File watcher started in polling mode')
+        while not self._stop_event.is_set():
+            roots = self._current_roots()
+            FileIndex.instance().refresh(roots)
+            self._roots = roots
+            self._mode = MODE_POLLING
+            self._stop_event.wait(_POLLING_INTERVAL)
+
+    def _run_inotify(self):
+        inotify = _Inotify()
+        try:
+            self._roots = self._current_roots()
+            FileIndex.instance().refresh(self._roots)
+            self._sync_watches(inotify)
+            self._mode = MODE_INOTIFY
+            logger.debug(f'File watcher started in inotify mode, {len(self._watches)} watches')
+
+            dirty_dirs = set()
+            first_event_at = None
+            last_event_at = None
+            roots_checked_at = time.time()
+
+            while not self._stop_event.is_set():
+                readable, _, _ = select.select([inotify.fd], [], [], 0.5)
+                now = time.time()
+
+                if readable:
+                    for wd, mask in inotify.read_events():
+                        if mask & _IN_Q_OVERFLOW:
+                            dirty_dirs.update(self._roots)
+                        elif mask & _IN_IGNORED:
+                            self._watches.pop(wd, None)
+                            continue
+
+                        # Removed or moved directory is dropped from the index on its rescan,
+                        # parent directory gets its own event.
+                        dir_path = self._watches.get(wd)
+                        if dir_path is not None:
+                            dirty_dirs.add(dir_path)
+
+                    first_event_at = first_event_at or now
+                    last_event_at = now
+
+                if dirty_dirs and (now - last_event_at >= _DEBOUNCE_SECONDS or
+                                   now - first_event_at >= _MAX_DEBOUNCE_SECONDS):
+                    FileIndex.instance().refresh_dirs(list(dirty_dirs))
+                    self._sync_watches(inotify)
+                    dirty_dirs.clear()
+                    first_event_at = None
+                    last_event_at = None
+
+                if now - roots_checked_at >= _ROOTS_CHECK_INTERVAL:
+                    roots_checked_at = now
+                    roots = self._current_roots()
+                    if set(roots) != set(self._roots):
+                        FileIndex.instance().refresh(roots)
+                        self._roots = roots
+                        self._sync_watches(inotify)
+        finally:
+            inotify.close()
+
+    def _sync_watches(self, inotify: _Inotify):
+        dirs = set(FileIndex.instance().get_dirs(self._roots))
+        watched = {path: wd for wd, path in self._watches.items()}
+
+        for path, wd in watched.items():
+            if path not in dirs:
+                inotify.remove_watch(wd)
+                self._watches.pop(wd, None)
+
+        for path in dirs:
+            if path not in watched:
+                try:
+                    wd = inotify.add_watch(path)
+                except OSError as ex:
+                    logger.debug(f'Failed to watch {path}: {ex}')
+                    continue
+                self._watches[wd] = path
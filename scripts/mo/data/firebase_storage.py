@@ -6,15 +6,16 @@ from firebase_admin import credentials
 from firebase_admin import firestore
 from google.cloud.firestore_v1 import CollectionReference
 
-from scripts.mo.data.storage import Storage, map_dict_to_record, map_record_to_dict
+from scripts.mo.data.storage import Storage, map_dict_to_record, map_record_to_dict, is_record_downloaded, \
+    sort_records, record_matches_query
 from scripts.mo.environment import env
-from scripts.mo.models import Record
+from scripts.mo.models import Record, ModelSort
 
 FIREBASE_APP_NAME = "sd-model-organizer-app"
 
 
 def _filter_download(record: Record, show_downloaded, show_not_downloaded):
-    is_downloaded = bool(record.location) and os.path.exists(record.location)
+    is_downloaded = is_record_downloaded(record)
     return (show_downloaded and is_downloaded) or (show_not_downloaded and not is_downloaded)
 
 
@@ -39,7 +40,7 @@ class FirebaseStorage(Storage):
         return records
 
     def query_records(self, name_query=None, groups=None, model_types=None, show_downloaded=None,
-                      show_not_downloaded=None) -> List:
+                      show_not_downloaded=None, sort_order: ModelSort = None, sort_downloaded_first=False) -> List:
 
         query_ref = self._records()
         if model_types is not None and model_types:
@@ -50,13 +51,16 @@ class FirebaseStorage(Storage):
             records.append(map_dict_to_record(ref.id, ref.to_dict()))
 
         if name_query is not None and name_query:
-            records = [record for record in records if name_query.lower() in record.name.lower()]
+            records = [record for record in records if record_matches_query(record, name_query)]
 
         if groups is not None and len(groups) > 0:
             records = [item for item in records if all(val in item.groups for val in groups)]
 
         records = list(filter(lambda r: _filter_download(r, show_downloaded, show_not_downloaded), records))
 
+        if sort_order is not None:
+            records = sort_records(records, sort_order, sort_downloaded_first)
+
         return records
 
     def get_record_by_id(self, _id) -> Record:
@@ -64,7 +68,8 @@ class FirebaseStorage(Storage):
         return map_dict_to_record(doc.id, doc.to_dict())
 
     def add_record(self, record: Record):
-        self._records().add(map_record_to_dict(record))
+        _, ref = self._records().add(map_record_to_dict(record))
+        return ref.id
 
     def update_record(self, record: Record):
         ref = self._records().document(record.id_)
@@ -82,9 +87,7 @@ class FirebaseStorage(Storage):
         return list(set(groups))
 
     def get_records_by_group(self, group: str) -> List:
-        col_ref = self._records()
-
-        query_ref = col_ref.where('group', 'array_contains', f'%{group}%')
+        query_ref = self._records().where('groups', 'array_contains', group)
 
         records = []
         for ref in query_ref.stream():
@@ -0,0 +1,154 @@
+import os
+import threading
+from typing import Iterable, List, Optional, Callable
+
+from scripts.mo.data import local_db
+from scripts.mo.hashing import hash_file, autov2_hash, HASH_MD5, HASH_SHA256, HASH_AUTOV2
+
+_CACHED_ALGORITHMS = (HASH_MD5, HASH_SHA256)
+
+
+def _file_identity(stat: os.stat_result) -> tuple:
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+class HashCache:
+    """
+    Persistent cache of the model files digests. Entry is valid while file path, size, mtime and inode are the same,
+    so file is hashed only once until it is changed or replaced.
+    """
+    __instance = None
+    __lock = threading.Lock()
+
+    def __init__(self):
+        self._initialize()
+
+    @staticmethod
+    def instance():
+        if HashCache.__instance is None:
+            with HashCache.__lock:
+                if HashCache.__instance is None:
+                    HashCache.__instance = HashCache()
+        return HashCache.__instance
+
+    @staticmethod
+    def _initialize():
+        connection = local_db.connection()
+        connection.execute('''CREATE TABLE IF NOT EXISTS FileHash
+                                    (path TEXT PRIMARY KEY,
+                                    size INTEGER NOT NULL,
+                                    mtime_ns INTEGER NOT NULL,
+                                    inode INTEGER NOT NULL,
+                                    md5 TEXT,
+                                    sha256 TEXT)
+                                 ''')
+        connection.execute('CREATE INDEX IF NOT EXISTS FileHash_sha256_idx ON FileHash(sha256)')
+        connection.commit()
+
+    def get_cached(self, file_path: str, stat: Optional[os.stat_result] = None) -> dict:
+        """
+        Returns cached digests of the file without reading it.
+        :param file_path: target file path.
+        :param stat: file stat result, taken from the file if None.
+        :return: dict of algorithm name to hex digest string, empty if file is unknown or was changed.
+        """
+        try:
+            stat = stat or os.stat(file_path)
+        except OSError:
+            return {}
+
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT md5, sha256 FROM FileHash WHERE path=? AND size=? AND mtime_ns=? AND inode=?',
+                       (file_path, *_file_identity(stat)))
+        row = cursor.fetchone()
+        if row is None:
+            return {}
+
+        result = {algorithm: value for algorithm, value in zip(_CACHED_ALGORITHMS, row) if value}
+        if HASH_SHA256 in result:
+            result[HASH_AUTOV2] = autov2_hash(result[HASH_SHA256])
+        return result
+
+    def put(self, file_path: str, hashes: dict, stat: Optional[os.stat_result] = None):
+        """
+        Stores file digests. Digests which are already cached for the same file are kept.
+        :param file_path: target file path.
+        :param hashes: dict of algorithm name to hex digest string.
+        :param stat: file stat result taken before hashing, taken from the file if None.
+        :return: None.
+        """
+        stat = stat or os.stat(file_path)
+        connection = local_db.connection()
+        connection.execute('''INSERT INTO FileHash(path, size, mtime_ns, inode, md5, sha256)
+                                VALUES (?, ?, ?, ?, ?, ?)
+                                ON CONFLICT(path) DO UPDATE SET
+                                    md5=CASE WHEN size=excluded.size AND mtime_ns=excluded.mtime_ns
+                                             AND inode=excluded.inode THEN COALESCE(excluded.md5, md5)
+                                             ELSE excluded.md5 END,
+                                    sha256=CASE WHEN size=excluded.size AND mtime_ns=excluded.mtime_ns
+                                                AND inode=excluded.inode THEN COALESCE(excluded.sha256, sha256)
+                                                ELSE excluded.sha256 END,
+                                    size=excluded.size,
+                                    mtime_ns=excluded.mtime_ns,
+                                    inode=excluded.inode''',
+                           (file_path, *_file_identity(stat), hashes.get(HASH_MD5), hashes.get(HASH_SHA256)))
+        connection.commit()
+
+    def get_hashes(self, file_path: str, algorithms: Iterable = _CACHED_ALGORITHMS,
+                   stop_event: Optional[threading.Event] = None,
+                   on_progress: Optional[Callable[[int], None]] = None) -> Optional[dict]:
+        """
+        Returns file digests from the cache, file is hashed only if some of the digests are missing.
+        :param file_path: target file path.
+        :param algorithms: digests to return, HASH_MD5 and/or HASH_SHA256.
+        :param stop_event: hashing is cancelled when event is set.
+        :param on_progress: called with the size of every chunk read.
+        :return: dict of algorithm name to hex digest string, None if hashing was cancelled.
+        """
+        stat = os.stat(file_path)
+        result = self.get_cached(file_path, stat)
+        missing = [algorithm for algorithm in algorithms if algorithm not in result]
+        if missing:
+            hashes = hash_file(file_path, missing, stop_event, on_progress)
+            if hashes is None:
+                return None
+            result.update(hashes)
+            # File could be changed while it was hashed, such digests would be stale.
+            if _file_identity(os.stat(file_path)) == _file_identity(stat):
+                self.put(file_path, result, stat)
+        return result
+
+    def get_sha256(self, file_path: str) -> str:
+        """
+        Returns SHA256 digest of the file, file is hashed only if it is not cached.
+        :param file_path: target file path.
+        :return: SHA256 hex digest string.
+        """
+        return self.get_hashes(file_path, [HASH_SHA256])[HASH_SHA256]
+
+    def get_paths(self, sha256: str) -> List:
+        """
+        Returns files which cached SHA256 is equal to the given one and which were not changed since they were hashed.
+        :param sha256: SHA256 hex digest string.
+        :return: list of file paths.
+        """
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT path FROM FileHash WHERE sha256=? ORDER BY path', (sha256.lower(),))
+        return [row[0] for row in cursor.fetchall()
+                if self.get_cached(row[0]).get(HASH_SHA256) == sha256.lower()]
+
+    def remove(self, file_path: str):
+        """
+        Removes cached digests of the deleted file.
+        :param file_path: target file path.
+        :return: None.
+        """
+        connection = local_db.connection()
+        connection.execute('DELETE FROM FileHash WHERE path=?', (file_path,))
+        connection.commit()
+
+    def get_entries(self) -> List:
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT path, size, mtime_ns, inode, md5, sha256 FROM FileHash ORDER BY path')
+        return [{'path': row[0], 'size': row[1], 'mtime_ns': row[2], 'inode': row[3], 'md5': row[4],
+                 'sha256': row[5]} for row in cursor.fetchall()]
@@ -0,0 +1,226 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import List, Optional
+
+from scripts.mo.data.hash_cache import HashCache
+from scripts.mo.data.location_reconciler import LocationReconciler
+from scripts.mo.environment import env, logger
+from scripts.mo.hashing import HASH_MD5, HASH_SHA256
+
+PRIORITY_USER = 0
+PRIORITY_VISIBLE = 1
+PRIORITY_BACKGROUND = 2
+
+STATUS_QUEUED = 'Queued'
+STATUS_RUNNING = 'Running'
+STATUS_COMPLETED = 'Completed'
+STATUS_CANCELLED = 'Cancelled'
+STATUS_ERROR = 'Error'
+
+_MAX_WORKERS = 2
+_MAX_FINISHED_JOBS = 100
+
+
+class _HashJob:
+    def __init__(self, path: str, priority: int):
+        self.path = path
+        self.priority = priority
+        self.record_ids = set()
+        self.status = STATUS_QUEUED
+        self.bytes_total = 0
+        self.bytes_ready = 0
+        self.error = None
+        self.hashes = None
+        self.stop_event = threading.Event()
+
+    def to_dict(self) -> dict:
+        return {
+            'path': self.path,
+            'priority': self.priority,
+            'status': self.status,
+            'bytes_ready': self.bytes_ready,
+            'bytes_total': self.bytes_total,
+            'error': self.error,
+            'sha256': self.hashes.get(HASH_SHA256) if self.hashes else None
+        }
+
+
+class _Throttle:
+    """
+    Limits total read rate of all hashing workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._available_at = 0.0
+
+    def consume(self, size: int, stop_event: threading.Event):
+        limit = env.hash_bandwidth_limit() * 1024 * 1024
+        if limit <= 0:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._available_at = max(now, self._available_at) + size / limit
+            delay = self._available_at - now
+        stop_event.wait(delay)
+
+
+class HashService:
+    """
+    Calculates model files digests in background. Jobs are processed by a bounded pool of workers in priority
+    order, digests are stored to HashCache and filled into the records bound to the file.
+    """
+    __instance = None
+    __lock = threading.Lock()
+
+    def __init__(self):
+        self._jobs_lock = threading.Lock()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._jobs = {}
+        self._finished = []
+        self._workers = []
+        self._throttle = _Throttle()
+
+    @staticmethod
+    def instance():
+        if HashService.__instance is None:
+            with HashService.__lock:
+                if HashService.__instance is None:
+                    HashService.__instance = HashService()
+        return HashService.__instance
+
+    def submit(self, path: str, priority: int = PRIORITY_BACKGROUND, record_id=None):
+        """
+        Queues file hashing. If the file is already queued its priority is raised when needed.
+        :param path: path to the model file.
+        :param priority: PRIORITY_USER, PRIORITY_VISIBLE or PRIORITY_BACKGROUND.
+        :param record_id: id of the record to fill sha256 and md5 hashes when hashing is finished.
+        :return: None.
+        """
+        with self._jobs_lock:
+            job = self._jobs.get(path)
+            if job is None:
+                job = _HashJob(path, priority)
+                self._jobs[path] = job
+                heapq.heappush(self._queue, (priority, next(self._sequence), job))
+            elif job.status == STATUS_QUEUED and priority < job.priority:
+                # Stale heap entry is skipped by the worker since its priority doesn't match.
+                job.priority = priority
+                heapq.heappush(self._queue, (priority, next(self._sequence), job))
+
+            if record_id is not None and record_id != '':
+                job.record_ids.add(record_id)
+
+            self._ensure_workers()
+
+    def submit_records(self, records: List, priority: int = PRIORITY_VISIBLE):
+        """
+        Queues hashing of the downloaded records which have no hashes yet.
+        :param records: list of records.
+        :param priority: jobs priority.
+        :return: None.
+        """
+        for record in records:
+            if record.id_ and record.location and not record.sha256_hash and os.path.isfile(record.location):
+                self.submit(record.location, priority, record.id_)
+
+    def cancel(self, path: str):
+        with self._jobs_lock:
+            job = self._jobs.get(path)
+            if job is not None:
+                job.stop_event.set()
+                if job.status == STATUS_QUEUED:
+                    self._finish(job, STATUS_CANCELLED)
+
+    def cancel_all(self):
+        with self._jobs_lock:
+            for job in list(self._jobs.values()):
+                job.stop_event.set()
+                if job.status == STATUS_QUEUED:
+                    self._finish(job, STATUS_CANCELLED)
+
+    def get_state(self) -> dict:
+        with self._jobs_lock:
+            jobs = sorted(self._jobs.values(), key=lambda j: (j.status != STATUS_RUNNING, j.priority))
+            return {
+                'bandwidth_limit_mb': env.hash_bandwidth_limit(),
+                'workers': len(self._workers),
+                'queued': sum(1 for job in jobs if job.status == STATUS_QUEUED),
+                'running': [job.to_dict() for job in jobs if job.status == STATUS_RUNNING],
+                'finished': [job.to_dict() for job in reversed(self._finished)]
+            }
+
+    def _ensure_workers(self):
+        while len(self._workers) < min(_MAX_WORKERS, len(self._jobs)):
+            worker = threading.Thread(target=self._run, name='mo-hash-worker', daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def _next_job(self) -> Optional[_HashJob]:
+        with self._jobs_lock:
+            while self._queue:
+                priority, _, job = heapq.heappop(self._queue)
+                if job.status == STATUS_QUEUED and job.priority == priority:
+                    job.status = STATUS_RUNNING
+                    return job
+            # Worker leaves under the lock, so submit() never counts on a worker which is about to exit.
+            self._workers.remove(threading.current_thread())
+            return None
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                self._process(job)
+            except Exception as ex:
+                logger.exception(ex)
+                with self._jobs_lock:
+                    job.error = str(ex)
+                    self._finish(job, STATUS_ERROR)
+
+    def _process(self, job: _HashJob):
+        job.bytes_total = os.path.getsize(job.path)
+
+        def on_progress(size):
+            job.bytes_ready += size
+            self._throttle.consume(size, job.stop_event)
+
+        hashes = HashCache.instance().get_hashes(job.path, [HASH_MD5, HASH_SHA256], job.stop_event, on_progress)
+
+        with self._jobs_lock:
+            if hashes is None:
+                self._finish(job, STATUS_CANCELLED)
+                return
+            job.hashes = hashes
+            record_ids = list(job.record_ids)
+            # Records submitted from now on get a new job, which is served from the hash cache.
+            self._release(job)
+
+        for record_id in record_ids:
+            record = env.storage.get_record_by_id(record_id)
+            # Record could be rebound to another file while it was hashed.
+            if record is not None and record.location == job.path:
+                record.sha256_hash = hashes[HASH_SHA256]
+                record.md5_hash = hashes[HASH_MD5]
+                env.storage.update_record(record)
+                LocationReconciler.instance().update_fingerprint(record)
+
+        with self._jobs_lock:
+            self._finish(job, STATUS_COMPLETED)
+
+    def _release(self, job: _HashJob):
+        if self._jobs.get(job.path) is job:
+            del self._jobs[job.path]
+
+    def _finish(self, job: _HashJob, status: str):
+        job.status = status
+        self._release(job)
+        self._finished.append(job)
+        del self._finished[:-_MAX_FINISHED_JOBS]
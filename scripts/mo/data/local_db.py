@@ -0,0 +1,37 @@
+import os
+import sqlite3
+import threading
+
+from modules import shared
+
+from scripts.mo.environment import env
+
+_DB_FILE = 'local.sqlite'
+_DB_TIMEOUT = 30
+
+_local = threading.local()
+
+
+def database_dir() -> str:
+    """
+    Returns directory where extension databases are stored.
+    :return: value of --mo-database-dir param if defined, extension directory otherwise.
+    """
+    mo_database_dir = getattr(shared.cmd_opts, "mo_database_dir")
+    return mo_database_dir if mo_database_dir is not None else env.script_dir
+
+
+def database_file() -> str:
+    return os.path.join(database_dir(), _DB_FILE)
+
+
+def connection() -> sqlite3.Connection:
+    """
+    Returns thread bound connection to the local database. Local database keeps machine specific data like
+    local files index and caches, so it is used regardless of the selected records storage.
+    :return: sqlite3 connection.
+    """
+    if not hasattr(_local, "connection"):
+        _local.connection = sqlite3.connect(database_file(), _DB_TIMEOUT)
+        _local.connection.execute('PRAGMA journal_mode=WAL')
+    return _local.connection
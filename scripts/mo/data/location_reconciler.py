@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+from typing import Optional
+
+from scripts.mo.data import local_db
+from scripts.mo.data.file_index import FileIndex
+from scripts.mo.data.hash_cache import HashCache
+from scripts.mo.data.record_utils import get_local_model_dirs
+from scripts.mo.environment import env, logger
+from scripts.mo.hashing import quick_fingerprint
+from scripts.mo.models import Record
+
+
+class LocationReconciler:
+    """
+    Finds model files which were moved or renamed outside the extension and rebinds records to them.
+    Every bound record keeps a quick fingerprint of its file, stale records are matched against unbound indexed
+    files of the same size by fingerprint. Full SHA256 is calculated only when several files match.
+    """
+    __instance = None
+    __lock = threading.Lock()
+
+    def __init__(self):
+        self._thread = None
+        self._state = {}
+        self._initialize()
+
+    @staticmethod
+    def instance():
+        if LocationReconciler.__instance is None:
+            with LocationReconciler.__lock:
+                if LocationReconciler.__instance is None:
+                    LocationReconciler.__instance = LocationReconciler()
+        return LocationReconciler.__instance
+
+    @staticmethod
+    def _initialize():
+        connection = local_db.connection()
+        connection.execute('''CREATE TABLE IF NOT EXISTS RecordFingerprint
+                                    (record_id TEXT PRIMARY KEY,
+                                    location TEXT NOT NULL,
+                                    size INTEGER NOT NULL,
+                                    mtime_ns INTEGER NOT NULL,
+                                    fingerprint TEXT NOT NULL)
+                                 ''')
+        connection.commit()
+
+    @staticmethod
+    def update_fingerprint(record: Record):
+        """
+        Stores fingerprint of the record file. File is read only if it was changed since the previous call.
+        :param record: record bound to the local file.
+        :return: None.
+        """
+        if not record.id_ or not record.location:
+            return
+        try:
+            stat = os.stat(record.location)
+        except OSError:
+            return
+
+        connection = local_db.connection()
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1 FROM RecordFingerprint WHERE record_id=? AND location=? AND size=? AND mtime_ns=?',
+                       (str(record.id_), record.location, stat.st_size, stat.st_mtime_ns))
+        if cursor.fetchone() is not None:
+            return
+
+        try:
+            fingerprint = quick_fingerprint(record.location)
+        except OSError as ex:
+            logger.warning(f'Failed to fingerprint {record.location}: {ex}')
+            return
+
+        cursor.execute('INSERT OR REPLACE INTO RecordFingerprint(record_id, location, size, mtime_ns, fingerprint) '
+                       'VALUES (?, ?, ?, ?, ?)',
+                       (str(record.id_), record.location, stat.st_size, stat.st_mtime_ns, fingerprint))
+        connection.commit()
+
+    @staticmethod
+    def _get_fingerprint(record: Record) -> Optional[tuple]:
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT size, fingerprint FROM RecordFingerprint WHERE record_id=?', (str(record.id_),))
+        return cursor.fetchone()
+
+    def start(self):
+        """
+        Starts reconciliation in background if it is not running yet.
+        :return: None.
+        """
+        with LocationReconciler.__lock:
+            if self.is_running():
+                return
+            self._state = {'status': 'Running', 'started_at': time.time()}
+            self._thread = threading.Thread(target=self._run, name='mo-location-reconciler', daemon=True)
+            self._thread.start()
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def get_state(self) -> dict:
+        return dict(self._state)
+
+    def _run(self):
+        try:
+            self._reconcile()
+            self._state['status'] = 'Completed'
+        except Exception as ex:
+            logger.exception(ex)
+            self._state['status'] = 'Error'
+            self._state['error'] = str(ex)
+        finally:
+            self._state['finished_at'] = time.time()
+
+    def _reconcile(self):
+        records = env.storage.get_all_records()
+        bound = set()
+        stale = []
+        for record in records:
+            if not record.location:
+                continue
+            if os.path.isfile(record.location):
+                bound.add(record.location)
+                self.update_fingerprint(record)
+            else:
+                stale.append(record)
+
+        self._state.update({'records_checked': len(records), 'stale': len(stale), 'relinked': [],
+                            'ambiguous': [], 'not_found': []})
+        if not stale:
+            return
+
+        # Files renamed in place are found even if they are outside the model directories.
+        roots = get_local_model_dirs() + [os.path.dirname(record.location) for record in stale
+                                          if os.path.isdir(os.path.dirname(record.location))]
+        FileIndex.instance().refresh(roots)
+
+        candidates = {}
+        for record in stale:
+            fingerprint = self._get_fingerprint(record)
+            if fingerprint is None:
+                self._state['not_found'].append({'record_id': record.id_, 'location': record.location,
+                                                 'reason': 'No fingerprint'})
+                continue
+            size, expected = fingerprint
+            candidates[record.id_] = [indexed_file.path
+                                      for indexed_file in FileIndex.instance().get_files_by_size(size)
+                                      if indexed_file.path not in bound and
+                                      FileIndex.get_fingerprint(indexed_file) == expected]
+
+        claims = {}
+        for paths in candidates.values():
+            for path in paths:
+                claims[path] = claims.get(path, 0) + 1
+
+        for record in stale:
+            if record.id_ not in candidates:
+                continue
+            paths = [path for path in candidates[record.id_] if path not in bound]
+            if not paths:
+                self._state['not_found'].append({'record_id': record.id_, 'location': record.location,
+                                                 'reason': 'No matching file'})
+                continue
+
+            if len(paths) == 1 and claims[paths[0]] == 1:
+                new_location = paths[0]
+            elif record.sha256_hash:
+                new_location = next((path for path in paths
+                                     if HashCache.instance().get_sha256(path) == record.sha256_hash.lower()), None)
+            else:
+                new_location = None
+
+            if new_location is None:
+                self._state['ambiguous'].append({'record_id': record.id_, 'location': record.location,
+                                                 'candidates': paths})
+                continue
+
+            self._state['relinked'].append({'record_id': record.id_, 'old_location': record.location,
+                                            'new_location': new_location})
+            record.location = new_location
+            env.storage.update_record(record)
+            self.update_fingerprint(record)
+            bound.add(new_location)
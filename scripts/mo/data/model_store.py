@@ -0,0 +1,181 @@
+import os
+import shutil
+import stat
+import threading
+from typing import Optional
+
+from scripts.mo.data.hash_cache import HashCache
+from scripts.mo.environment import env, logger
+from scripts.mo.hashing import HASH_SHA256
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Linux ioctl which makes the destination file share data blocks of the source file (btrfs, xfs).
+_FICLONE = 0x40049409
+_LINK_SUFFIX = '.mo-link'
+
+
+def _reflink(source: str, destination: str):
+    if fcntl is None:
+        raise OSError('Reflinks are not supported')
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        fcntl.ioctl(destination_file.fileno(), _FICLONE, source_file.fileno())
+
+
+def _get_store_path(sha256: str) -> Optional[str]:
+    store_dir = env.model_store_path()
+    if not store_dir:
+        return None
+    return os.path.join(store_dir, sha256[:2], sha256)
+
+
+def _remove_unlinked(store_path: str) -> Optional[int]:
+    # Store file which is the only link to its data is not used by any model directory.
+    try:
+        file_stat = os.lstat(store_path)
+        if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_nlink != 1:
+            return None
+        os.remove(store_path)
+    except FileNotFoundError:
+        return None
+    except OSError as ex:
+        logger.warning(f'Failed to remove unlinked store file {store_path}: {ex}')
+        return None
+
+    HashCache.instance().remove(store_path)
+    try:
+        os.rmdir(os.path.dirname(store_path))
+    except OSError:
+        pass
+    logger.info(f'Removed unlinked store file {store_path}')
+    return file_stat.st_size
+
+
+class ModelStore:
+    """
+    Content-addressable store of the model files. Files are kept by their SHA256 and hardlinked into the model
+    directories, so the file downloaded for several records or folders takes disk space once. Files which are
+    already hashed in the model directories are linked the same way, even if the store is disabled.
+    Stored file is kept while any model directory links it, it is removed with the last model file removed by
+    the extension or by remove_unlinked().
+    """
+    __instance = None
+    __lock = threading.Lock()
+
+    @staticmethod
+    def instance():
+        if ModelStore.__instance is None:
+            with ModelStore.__lock:
+                if ModelStore.__instance is None:
+                    ModelStore.__instance = ModelStore()
+        return ModelStore.__instance
+
+    def find(self, sha256: str) -> Optional[str]:
+        """
+        Finds local file with the given content. Only files which cached SHA256 is still valid are returned,
+        so no file is read.
+        :param sha256: expected SHA256 hex digest string.
+        :return: file path or None if there is no such file or linking is disabled.
+        """
+        if not sha256 or not env.link_existing_files():
+            return None
+
+        sha256 = sha256.lower()
+        store_path = _get_store_path(sha256)
+        if store_path is not None and HashCache.instance().get_cached(store_path).get(HASH_SHA256) == sha256:
+            return store_path
+
+        paths = HashCache.instance().get_paths(sha256)
+        return paths[0] if paths else None
+
+    def link(self, source: str, destination: str) -> str:
+        """
+        Creates destination file with the content of the source file. Hardlink is used if possible, then reflink,
+        file is copied if source is on another file system.
+        :param source: existing file path.
+        :param destination: path of the file to create.
+        :return: 'hardlink', 'reflink' or 'copy'.
+        """
+        temp_path = destination + _LINK_SUFFIX
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        try:
+            try:
+                os.link(source, temp_path)
+                method = 'hardlink'
+            except OSError:
+                try:
+                    _reflink(source, temp_path)
+                    method = 'reflink'
+                except OSError:
+                    shutil.copyfile(source, temp_path)
+                    method = 'copy'
+            os.replace(temp_path, destination)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        logger.info(f'Created {destination} from {source} by {method}')
+        return method
+
+    def put(self, file_path: str, hashes: dict):
+        """
+        Adds hardlink of the file to the store if the store is enabled. File is not added if it's already stored or
+        the store is on another file system.
+        :param file_path: path of the hashed file.
+        :param hashes: file digests, must contain SHA256.
+        :return: None.
+        """
+        store_path = _get_store_path(hashes[HASH_SHA256].lower())
+        if store_path is None or os.path.exists(store_path):
+            return
+
+        temp_path = store_path + _LINK_SUFFIX
+        try:
+            os.makedirs(os.path.dirname(store_path), exist_ok=True)
+            os.link(file_path, temp_path)
+            os.replace(temp_path, store_path)
+        except OSError as ex:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            logger.warning(f'File is not added to the model store: {ex}')
+            return
+        HashCache.instance().put(store_path, hashes)
+
+    def release(self, sha256: str):
+        """
+        Removes stored file of the given content if no model directory links it anymore. Should be called after
+        the model file is removed, so its disk space is freed.
+        :param sha256: SHA256 hex digest string of the removed file.
+        :return: None.
+        """
+        if not sha256:
+            return
+        store_path = _get_store_path(sha256.lower())
+        if store_path is not None:
+            _remove_unlinked(store_path)
+
+    def remove_unlinked(self) -> dict:
+        """
+        Removes every stored file which is not linked by any model directory, e.g. its model was removed outside of
+        the extension.
+        :return: dict with the number of 'removed' files and 'freed' bytes.
+        """
+        store_dir = env.model_store_path()
+        removed = 0
+        freed = 0
+        if not store_dir or not os.path.isdir(store_dir):
+            return {'removed': removed, 'freed': freed}
+
+        for prefix_dir in os.scandir(store_dir):
+            if not prefix_dir.is_dir(follow_symlinks=False):
+                continue
+            for name in os.listdir(prefix_dir.path):
+                size = _remove_unlinked(os.path.join(prefix_dir.path, name))
+                if size is not None:
+                    removed += 1
+                    freed += size
+        return {'removed': removed, 'freed': freed}
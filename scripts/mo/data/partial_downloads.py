@@ -0,0 +1,103 @@
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+from scripts.mo.data import local_db
+
+
+class PartialDownload:
+    def __init__(self, path: str, url: str, total_size: int = 0, etag: Optional[str] = None,
+                 last_modified: Optional[str] = None, segments: Optional[List] = None):
+        self.path = path
+        self.url = url
+        self.total_size = total_size
+        self.etag = etag
+        self.last_modified = last_modified
+        # List of [start, end, position] of the file ranges, position is the next byte to download.
+        self.segments = segments or []
+
+    @property
+    def bytes_ready(self) -> int:
+        return sum(position - start for start, _, position in self.segments)
+
+    def get_validator(self) -> Optional[str]:
+        """
+        Returns value for If-Range header. Weak ETag can't be used for ranges, Last-Modified is used instead.
+        :return: validator string or None if server provided none.
+        """
+        if self.etag and not self.etag.startswith('W/'):
+            return self.etag
+        return self.last_modified
+
+
+class PartialDownloads:
+    """
+    Persistent state of the unfinished downloads. Entry is keyed by the partial file path and lets the download
+    continue from the downloaded bytes after cancel, error or webui restart.
+    """
+    __instance = None
+    __lock = threading.Lock()
+
+    def __init__(self):
+        self._initialize()
+
+    @staticmethod
+    def instance():
+        if PartialDownloads.__instance is None:
+            with PartialDownloads.__lock:
+                if PartialDownloads.__instance is None:
+                    PartialDownloads.__instance = PartialDownloads()
+        return PartialDownloads.__instance
+
+    @staticmethod
+    def _initialize():
+        connection = local_db.connection()
+        connection.execute('''CREATE TABLE IF NOT EXISTS PartialDownload
+                                    (path TEXT PRIMARY KEY,
+                                    url TEXT NOT NULL,
+                                    total_size INTEGER DEFAULT 0,
+                                    bytes_ready INTEGER DEFAULT 0,
+                                    etag TEXT,
+                                    last_modified TEXT,
+                                    segments TEXT,
+                                    updated_at REAL)
+                                 ''')
+        connection.commit()
+
+    def get(self, path: str, url: str) -> Optional[PartialDownload]:
+        """
+        Returns state of the partial download.
+        :param path: partial file path.
+        :param url: download url, entry of another url is not returned.
+        :return: PartialDownload or None if there is nothing to resume.
+        """
+        if not os.path.isfile(path):
+            return None
+
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT total_size, etag, last_modified, segments FROM PartialDownload WHERE path=? AND url=?',
+                       (path, url))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return PartialDownload(path, url, row[0], row[1], row[2], json.loads(row[3]) if row[3] else [])
+
+    def contains(self, path: str, url: str) -> bool:
+        return self.get(path, url) is not None
+
+    def put(self, partial: PartialDownload):
+        connection = local_db.connection()
+        connection.execute('INSERT OR REPLACE INTO PartialDownload'
+                           '(path, url, total_size, bytes_ready, etag, last_modified, segments, updated_at) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                           (partial.path, partial.url, partial.total_size, partial.bytes_ready, partial.etag,
+                            partial.last_modified, json.dumps(partial.segments), time.time()))
+        connection.commit()
+
+    def remove(self, path: str):
+        connection = local_db.connection()
+        connection.execute('DELETE FROM PartialDownload WHERE path=?', (path,))
+        connection.commit()
+
@@ -0,0 +1,136 @@
+import json
+import os
+import threading
+from typing import Optional, Tuple, List
+
+from scripts.mo.data import local_db
+from scripts.mo.environment import logger
+
+KIND_INFO = 'info'
+KIND_JSON = 'json'
+
+
+def _extract_info_fields(info_data: dict) -> dict:
+    preview_url = ''
+    for image in info_data.get('images') or []:
+        if image.get('type') == 'image' and image.get('url'):
+            preview_url = image['url'].replace('/width=450', '')
+            break
+
+    download_url = ''
+    sha256 = ''
+    files = info_data.get('files') or []
+    if files:
+        download_url = files[0].get('downloadUrl') or ''
+        sha256 = (files[0].get('hashes') or {}).get('SHA256') or ''
+
+    return {
+        'preview_url': preview_url,
+        'download_url': download_url,
+        'sha256': sha256,
+        'trained_words': ', '.join(info_data.get('trainedWords') or [])
+    }
+
+
+def _extract_json_fields(json_data: dict) -> dict:
+    return {
+        'activation_text': json_data.get('activation text'),
+        'negative_text': json_data.get('negative text'),
+        'preferred_weight': json_data.get('preferred weight')
+    }
+
+
+_EXTRACTORS = {
+    KIND_INFO: _extract_info_fields,
+    KIND_JSON: _extract_json_fields
+}
+
+
+class SidecarCache:
+    """
+    Persistent cache of the fields extracted from the model sidecar files (.info, .civitai.info and .json).
+    Entries are keyed by sidecar path and revalidated by its mtime and size, so unchanged sidecars are never
+    read again.
+    """
+    __instance = None
+    __lock = threading.Lock()
+
+    def __init__(self):
+        self._initialize()
+
+    @staticmethod
+    def instance():
+        if SidecarCache.__instance is None:
+            with SidecarCache.__lock:
+                if SidecarCache.__instance is None:
+                    SidecarCache.__instance = SidecarCache()
+        return SidecarCache.__instance
+
+    @staticmethod
+    def _initialize():
+        connection = local_db.connection()
+        connection.execute('''CREATE TABLE IF NOT EXISTS SidecarMetadata
+                                    (path TEXT PRIMARY KEY,
+                                    kind TEXT NOT NULL,
+                                    mtime_ns INTEGER DEFAULT 0,
+                                    size INTEGER DEFAULT 0,
+                                    data TEXT)
+                                 ''')
+        connection.commit()
+
+    @staticmethod
+    def lookup(sidecar_path: str, kind: str, stat: os.stat_result = None) -> Tuple[Optional[dict], Optional[tuple]]:
+        """
+        Returns fields extracted from the sidecar file. The file is parsed only if it was changed since it was
+        cached. Does not write to the database, so it is safe to call from the scan workers.
+        :param sidecar_path: path to the sidecar file.
+        :param kind: sidecar kind, KIND_INFO or KIND_JSON.
+        :param stat: sidecar file stat if it's already taken by the caller.
+        :return: tuple of extracted fields dict (None if file is missing or can't be parsed) and cache entry
+        which should be passed to store() if file was parsed, None otherwise.
+        """
+        if stat is None:
+            try:
+                stat = os.stat(sidecar_path)
+            except OSError:
+                return None, None
+
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT data FROM SidecarMetadata WHERE path=? AND kind=? AND mtime_ns=? AND size=?',
+                       (sidecar_path, kind, stat.st_mtime_ns, stat.st_size))
+        row = cursor.fetchone()
+        if row is not None:
+            return (json.loads(row[0]) if row[0] is not None else None), None
+
+        try:
+            with open(sidecar_path) as file:
+                data = _EXTRACTORS[kind](json.load(file))
+        except Exception as ex:
+            logger.debug(f'Failed to parse {kind} file {sidecar_path}: {ex}')
+            data = None
+
+        # Parse failures are cached as well, broken file is retried only after it is changed.
+        data_json = json.dumps(data) if data is not None else None
+        return data, (sidecar_path, kind, stat.st_mtime_ns, stat.st_size, data_json)
+
+    @staticmethod
+    def store(cursor, entries: List):
+        """
+        Stores entries returned by lookup(). Commit is up to the caller.
+        :param cursor: local database cursor.
+        :param entries: list of cache entries.
+        :return: None.
+        """
+        cursor.executemany('INSERT OR REPLACE INTO SidecarMetadata(path, kind, mtime_ns, size, data) '
+                           'VALUES (?, ?, ?, ?, ?)', entries)
+
+    def get_stats(self) -> dict:
+        cursor = local_db.connection().cursor()
+        cursor.execute('SELECT COUNT(*) FROM SidecarMetadata')
+        return {'entries_count': cursor.fetchone()[0]}
+
+    @staticmethod
+    def clear():
+        connection = local_db.connection()
+        connection.execute('DELETE FROM SidecarMetadata')
+        connection.commit()
@@ -3,16 +3,44 @@ import sqlite3
 import threading
 from typing import List
 
-from modules import shared
-
-from scripts.mo.data.storage import Storage
-from scripts.mo.environment import env, logger
-from scripts.mo.models import Record, ModelType
+from scripts.mo.data.local_db import database_dir
+from scripts.mo.data.storage import Storage, is_record_downloaded, search_tokens
+from scripts.mo.environment import logger
+from scripts.mo.models import Record, ModelType, ModelSort
 
 _DB_FILE = 'database.sqlite'
-_DB_VERSION = 6
+_DB_VERSION = 7
 _DB_TIMEOUT = 30
 
+_ORDER_BY = {
+    ModelSort.TIME_ADDED_ASC: 'created_at ASC, id ASC',
+    ModelSort.TIME_ADDED_DESC: 'created_at DESC, id DESC',
+    ModelSort.NAME_ASC: '_name COLLATE NOCASE ASC, id ASC',
+    ModelSort.NAME_DESC: '_name COLLATE NOCASE DESC, id DESC',
+    ModelSort.RELEVANCE: 'created_at ASC, id ASC'
+}
+
+_SEARCH_GROUPS = "(SELECT group_concat(_group, ' ') FROM RecordGroup WHERE record_id = {})"
+
+
+_GROUPS_SEPARATOR = '\x1f'
+
+# Column order matches the original Record table layout, groups are aggregated from RecordGroup table.
+_SELECT_RECORD = f'''SELECT id, _name, model_type, download_url, url, download_path, download_filename, preview_url,
+                            description, positive_prompts, negative_prompts, sha256_hash, md5_hash, created_at,
+                            (SELECT group_concat(_group, char({ord(_GROUPS_SEPARATOR)})) FROM
+                                (SELECT _group FROM RecordGroup WHERE record_id = Record.id ORDER BY rowid)),
+                            subdir, location, weight
+                        FROM Record'''
+
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _build_match_query(tokens: List) -> str:
+    return ' '.join(f'"{token}"*' for token in tokens)
+
 
 def map_row_to_record(row) -> Record:
     return Record(
@@ -30,7 +58,7 @@ def map_row_to_record(row) -> Record:
         sha256_hash=row[11],
         md5_hash=row[12],
         created_at=row[13],
-        groups=row[14].split(',') if row[14] else [],
+        groups=row[14].split(_GROUPS_SEPARATOR) if row[14] else [],
         subdir=row[15],
         location=row[16],
         weight=row[17]
@@ -45,9 +73,7 @@ class SQLiteStorage(Storage):
 
     def _connection(self):
         if not hasattr(self.local, "connection"):
-            mo_database_dir = getattr(shared.cmd_opts, "mo_database_dir")
-            database_dir = mo_database_dir if mo_database_dir is not None else env.script_dir
-            db_file_path = os.path.join(database_dir, _DB_FILE)
+            db_file_path = os.path.join(database_dir(), _DB_FILE)
             self.local.connection = sqlite3.connect(db_file_path, _DB_TIMEOUT)
         return self.local.connection
 
@@ -75,10 +101,82 @@ class SQLiteStorage(Storage):
                                     weight REAL DEFAULT 1)
                                  ''')
 
+        cursor.execute('''CREATE TABLE IF NOT EXISTS RecordGroup
+                                    (record_id INTEGER NOT NULL,
+                                    _group TEXT NOT NULL,
+                                    UNIQUE (record_id, _group))
+                                 ''')
+
         cursor.execute(f'''CREATE TABLE IF NOT EXISTS Version
                                 (version INTEGER DEFAULT {_DB_VERSION})''')
         self._connection().commit()
         self._check_database_version()
+        self._create_indexes()
+        self.is_search_enabled = self._create_search_index()
+
+    def _create_indexes(self):
+        cursor = self._connection().cursor()
+        cursor.execute('CREATE INDEX IF NOT EXISTS Record_name_idx ON Record(_name COLLATE NOCASE)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS Record_model_type_idx ON Record(model_type)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS Record_url_idx ON Record(url)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS Record_download_destination_idx '
+                       'ON Record(download_path, download_filename)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS Record_created_at_idx ON Record(created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS RecordGroup_group_idx ON RecordGroup(_group, record_id)')
+        self._connection().commit()
+
+    def _create_search_index(self) -> bool:
+        cursor = self._connection().cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='RecordSearch'")
+        if cursor.fetchone() is not None:
+            return True
+
+        try:
+            cursor.execute('''CREATE VIRTUAL TABLE RecordSearch USING fts5(
+                                    _name,
+                                    description,
+                                    positive_prompts,
+                                    negative_prompts,
+                                    groups,
+                                    tokenize = 'unicode61 remove_diacritics 2',
+                                    prefix = '2 3')
+                                 ''')
+        except sqlite3.OperationalError as ex:
+            logger.warning(f'SQLite FTS5 is not available, search falls back to name matching: {ex}')
+            return False
+
+        cursor.execute('''CREATE TRIGGER Record_search_insert AFTER INSERT ON Record BEGIN
+                                INSERT INTO RecordSearch(rowid, _name, description, positive_prompts, negative_prompts,
+                                    groups)
+                                VALUES (new.id, new._name, new.description, new.positive_prompts, new.negative_prompts,
+                                    ''' + _SEARCH_GROUPS.format('new.id') + ''');
+                            END''')
+        cursor.execute('''CREATE TRIGGER Record_search_update
+                            AFTER UPDATE OF _name, description, positive_prompts, negative_prompts ON Record BEGIN
+                                UPDATE RecordSearch SET _name=new._name,
+                                                        description=new.description,
+                                                        positive_prompts=new.positive_prompts,
+                                                        negative_prompts=new.negative_prompts
+                                WHERE rowid=new.id;
+                            END''')
+        cursor.execute('''CREATE TRIGGER Record_search_delete AFTER DELETE ON Record BEGIN
+                                DELETE FROM RecordSearch WHERE rowid=old.id;
+                            END''')
+        cursor.execute('''CREATE TRIGGER RecordGroup_search_insert AFTER INSERT ON RecordGroup BEGIN
+                                UPDATE RecordSearch SET groups=''' + _SEARCH_GROUPS.format('new.record_id') + '''
+                                WHERE rowid=new.record_id;
+                            END''')
+        cursor.execute('''CREATE TRIGGER RecordGroup_search_delete AFTER DELETE ON RecordGroup BEGIN
+                                UPDATE RecordSearch SET groups=''' + _SEARCH_GROUPS.format('old.record_id') + '''
+                                WHERE rowid=old.record_id;
+                            END''')
+
+        cursor.execute('''INSERT INTO RecordSearch(rowid, _name, description, positive_prompts, negative_prompts, groups)
+                            SELECT id, _name, description, positive_prompts, negative_prompts,
+                                ''' + _SEARCH_GROUPS.format('Record.id') + '''
+                            FROM Record''')
+        self._connection().commit()
+        return True
 
     def _check_database_version(self):
         cursor = self._connection().cursor()
@@ -105,6 +203,8 @@ class SQLiteStorage(Storage):
                 self._migrate_4_to_5()
             elif ver == 5:
                 self._migrage_5_to_6()
+            elif ver == 6:
+                self._migrate_6_to_7()
             else:
                 raise Exception(f'Missing SQLite migration from {ver} to {_DB_VERSION}')
 
@@ -144,9 +244,26 @@ class SQLiteStorage(Storage):
         cursor.execute('INSERT INTO Version VALUES (6)')
         self._connection().commit()
 
+    def _migrate_6_to_7(self):
+        cursor = self._connection().cursor()
+        cursor.execute('SELECT id, groups FROM Record')
+        for row in cursor.fetchall():
+            if row[1]:
+                self._insert_groups(cursor, row[0], row[1].split(','))
+        cursor.execute("UPDATE Record SET groups=''")
+        cursor.execute("DELETE FROM Version")
+        cursor.execute('INSERT INTO Version VALUES (7)')
+        self._connection().commit()
+
+    @staticmethod
+    def _insert_groups(cursor, record_id, groups):
+        groups = list(dict.fromkeys(filter(None, map(str.strip, groups))))
+        cursor.executemany('INSERT INTO RecordGroup(record_id, _group) VALUES (?, ?)',
+                           [(record_id, group) for group in groups])
+
     def get_all_records(self) -> List:
         cursor = self._connection().cursor()
-        cursor.execute('SELECT * FROM Record')
+        cursor.execute(_SELECT_RECORD)
         rows = cursor.fetchall()
         result = []
         for row in rows:
@@ -154,77 +271,79 @@ class SQLiteStorage(Storage):
         return result
 
     def query_records(self, name_query: str = None, groups=None, model_types=None, show_downloaded=True,
-                      show_not_downloaded=True) -> List:
-
-        query = 'SELECT * FROM Record'
-
-        is_where_appended = False
-        append_and = False
-
-        if name_query is not None and name_query:
-            if not is_where_appended:
-                query += ' WHERE'
-                is_where_appended = True
-
-            query += f" LOWER(_name) LIKE '%{name_query}%'"
-            append_and = True
+                      show_not_downloaded=True, sort_order: ModelSort = None, sort_downloaded_first=False) -> List:
+
+        if not show_downloaded and not show_not_downloaded:
+            return []
+
+        query = _SELECT_RECORD
+        conditions = []
+        params = []
+        is_ranked = False
+
+        tokens = search_tokens(name_query)
+        if self.is_search_enabled and tokens:
+            query += ' JOIN (SELECT rowid, rank FROM RecordSearch WHERE RecordSearch MATCH ?) AS Search ' \
+                     'ON Search.rowid = Record.id'
+            params.append(_build_match_query(tokens))
+            is_ranked = True
+        elif name_query is not None and name_query:
+            conditions.append("_name LIKE ? ESCAPE '\\'")
+            params.append(f'%{_escape_like(name_query)}%')
 
         if model_types is not None and len(model_types) > 0:
-            if not is_where_appended:
-                query += ' WHERE'
-                is_where_appended = True
-
-            if append_and:
-                query += ' AND'
+            conditions.append(f'model_type IN ({", ".join("?" * len(model_types))})')
+            params.extend(model_types)
 
-            query += ' ('
-            append_or = False
-            for model_type in model_types:
-                if append_or:
-                    query += ' OR'
-                query += f" model_type='{model_type}'"
-                append_or = True
-
-            query += ')'
+        if groups is not None and len(groups) > 0:
+            groups = list(set(groups))
+            conditions.append(f'''id IN (SELECT record_id FROM RecordGroup WHERE _group IN ({", ".join("?" * len(groups))})
+                                GROUP BY record_id HAVING COUNT(*) = ?)''')
+            params.extend(groups)
+            params.append(len(groups))
 
-            append_and = True
-            pass
+        if show_downloaded and not show_not_downloaded:
+            conditions.append("location != ''")
 
-        if groups is not None and len(groups) > 0:
-            if not is_where_appended:
-                query += ' WHERE'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
 
-            for group in groups:
-                if append_and:
-                    query += ' AND'
-                query += f" LOWER(groups) LIKE '%{group}%'"
-                append_and = True
+        if sort_order == ModelSort.RELEVANCE and is_ranked:
+            query += ' ORDER BY Search.rank, Record.id'
+        elif sort_order is not None:
+            query += ' ORDER BY ' + _ORDER_BY[sort_order]
 
-        logger.debug(f'query: {query}')
+        logger.debug(f'query: {query}, params: {params}')
         cursor = self._connection().cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
+        cursor.execute(query, params)
+
+        # Downloaded state is known only after the file existence check.
+        is_download_filter_needed = not (show_downloaded and show_not_downloaded)
         result = []
-        for row in rows:
+        for row in cursor:
             record = map_row_to_record(row)
-            is_downloaded = bool(record.location) and os.path.exists(record.location)
+            if is_download_filter_needed:
+                is_downloaded = is_record_downloaded(record)
+                if (show_downloaded and not is_downloaded) or (show_not_downloaded and is_downloaded):
+                    continue
+
+            result.append(record)
 
-            if show_downloaded and is_downloaded:
-                result.append(record)
-            elif show_not_downloaded and not is_downloaded:
-                result.append(record)
+        if sort_order is not None and sort_downloaded_first:
+            # Stable partition keeps SQL order inside downloaded and not downloaded parts.
+            result.sort(key=lambda r: not is_record_downloaded(r))
 
         return result
 
     def get_record_by_id(self, id_) -> Record:
         cursor = self._connection().cursor()
-        cursor.execute('SELECT * FROM Record WHERE id=?', (id_,))
+        cursor.execute(f'{_SELECT_RECORD} WHERE id=?', (id_,))
         row = cursor.fetchone()
         return None if row is None else map_row_to_record(row)
 
     def get_records_by_group(self, group: str) -> List:
         cursor = self._connection().cursor()
-        cursor.execute(f"SELECT * FROM Record WHERE LOWER(groups) LIKE '%{group}%'")
+        cursor.execute(f'{_SELECT_RECORD} WHERE id IN (SELECT record_id FROM RecordGroup WHERE _group=?)', (group,))
         rows = cursor.fetchall()
         result = []
         for row in rows:
@@ -247,7 +366,6 @@ class SQLiteStorage(Storage):
             record.sha256_hash,
             record.md5_hash,
             record.created_at,
-            ",".join(record.groups),
             record.subdir,
             record.location,
             record.weight
@@ -267,12 +385,14 @@ class SQLiteStorage(Storage):
                     sha256_hash,
                     md5_hash,
                     created_at,
-                    groups,
                     subdir,
                     location,
-                    weight) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    weight) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
             data)
+        record_id = cursor.lastrowid
+        self._insert_groups(cursor, record_id, record.groups)
         self._connection().commit()
+        return record_id
 
     def update_record(self, record: Record):
         cursor = self._connection().cursor()
@@ -289,7 +409,6 @@ class SQLiteStorage(Storage):
             record.negative_prompts,
             record.sha256_hash,
             record.md5_hash,
-            ",".join(record.groups),
             record.subdir,
             record.location,
             record.weight,
@@ -309,32 +428,27 @@ class SQLiteStorage(Storage):
                     negative_prompts=?,
                     sha256_hash=?,
                     md5_hash=?,
-                    groups=?,
                     subdir=?,
                     location=?,
                     weight=?
                 WHERE id=?
             """, data
         )
+        cursor.execute('DELETE FROM RecordGroup WHERE record_id=?', (record.id_,))
+        self._insert_groups(cursor, record.id_, record.groups)
 
         self._connection().commit()
 
     def remove_record(self, _id):
         cursor = self._connection().cursor()
+        cursor.execute("DELETE FROM RecordGroup WHERE record_id=?", (_id,))
         cursor.execute("DELETE FROM Record WHERE id=?", (_id,))
         self._connection().commit()
 
     def get_available_groups(self) -> List:
         cursor = self._connection().cursor()
-        cursor.execute('SELECT groups FROM Record')
-        rows = cursor.fetchall()
-        result = []
-        for row in rows:
-            if row[0]:
-                result.extend(row[0].split(","))
-
-        result = list(set(result))
-        return list(filter(None, result))
+        cursor.execute('SELECT DISTINCT _group FROM RecordGroup')
+        return [row[0] for row in cursor.fetchall()]
 
     def get_all_records_locations(self) -> List:
         cursor = self._connection().cursor()
@@ -349,7 +463,7 @@ class SQLiteStorage(Storage):
 
     def get_records_by_name(self, record_name) -> List:
         cursor = self._connection().cursor()
-        cursor.execute('SELECT * FROM Record WHERE _name=?', (record_name,))
+        cursor.execute(f'{_SELECT_RECORD} WHERE _name=?', (record_name,))
         rows = cursor.fetchall()
         result = []
         for row in rows:
@@ -358,7 +472,7 @@ class SQLiteStorage(Storage):
 
     def get_records_by_url(self, url) -> List:
         cursor = self._connection().cursor()
-        cursor.execute('SELECT * FROM Record WHERE url=?', (url,))
+        cursor.execute(f'{_SELECT_RECORD} WHERE url=?', (url,))
         rows = cursor.fetchall()
         result = []
         for row in rows:
@@ -367,7 +481,7 @@ class SQLiteStorage(Storage):
 
     def get_records_by_download_destination(self, download_path, download_filename) -> List:
         cursor = self._connection().cursor()
-        cursor.execute('SELECT * FROM Record WHERE download_path=? AND download_filename=?',
+        cursor.execute(f'{_SELECT_RECORD} WHERE download_path=? AND download_filename=?',
                        (download_path, download_filename,))
         rows = cursor.fetchall()
         result = []
@@ -1,7 +1,9 @@
+import os
+import re
 from abc import ABC, abstractmethod
 from typing import Dict, List
 
-from scripts.mo.models import Record, ModelType
+from scripts.mo.models import Record, ModelType, ModelSort
 
 
 def map_dict_to_record(id_, raw: Dict) -> Record:
@@ -50,6 +52,70 @@ def map_record_to_dict(record: Record) -> dict:
     }
 
 
+def is_record_downloaded(record: Record) -> bool:
+    return bool(record.location) and os.path.exists(record.location)
+
+
+def search_tokens(query: str) -> List:
+    """
+    Splits search query into lowercase word tokens.
+    :param query: search query string.
+    :return: list of tokens, empty if query has no words.
+    """
+    return re.findall(r'\w+', query.lower()) if query else []
+
+
+def record_matches_query(record: Record, query: str) -> bool:
+    """
+    Checks every query token is a prefix of some word in the record name, description, prompts or groups.
+    Mirrors the full-text search behaviour for records that are not in the database.
+    :param record: record to check.
+    :param query: search query string.
+    :return: True if record matches the query.
+    """
+    tokens = search_tokens(query)
+    if not tokens:
+        return True
+
+    text = ' '.join([record.name, record.description, record.positive_prompts, record.negative_prompts,
+                     *record.groups])
+    words = search_tokens(text)
+    return all(any(word.startswith(token) for word in words) for token in tokens)
+
+
+def record_sort_key(sort_order: ModelSort, sort_downloaded_first: bool):
+    """
+    Builds sorting key for the records list.
+    :param sort_order: records sort order.
+    :param sort_downloaded_first: put downloaded records first if True.
+    :return: tuple of key function and reverse flag to pass into sorted() or heapq.merge().
+    """
+    if sort_order == ModelSort.TIME_ADDED_ASC or sort_order == ModelSort.TIME_ADDED_DESC:
+        field_key = lambda r: r.created_at
+    elif sort_order == ModelSort.NAME_ASC or sort_order == ModelSort.NAME_DESC:
+        field_key = lambda r: r.name.lower()
+    elif sort_order == ModelSort.RELEVANCE:
+        # Relevance rank is known to the storage only, already ranked records keep their order.
+        field_key = lambda r: 0
+    else:
+        raise ValueError(f'An unhandled sort_order value: {sort_order.value}')
+
+    reverse = sort_order == ModelSort.TIME_ADDED_DESC or sort_order == ModelSort.NAME_DESC
+
+    if sort_downloaded_first:
+        if reverse:
+            return lambda r: (is_record_downloaded(r), field_key(r)), True
+        else:
+            return lambda r: (not is_record_downloaded(r), field_key(r)), False
+
+    return field_key, reverse
+
+
+def sort_records(records: List, sort_order: ModelSort, sort_downloaded_first: bool) -> List:
+    key, reverse = record_sort_key(sort_order, sort_downloaded_first)
+    return sorted(records, key=key, reverse=reverse)
+
+
 class Storage(ABC):
 
     @abstractmethod
@@ -58,7 +124,7 @@ class Storage(ABC):
 
     @abstractmethod
     def query_records(self, name_query=None, groups=None, model_types=None, show_downloaded=None,
-                      show_not_downloaded=None) -> List:
+                      show_not_downloaded=None, sort_order: ModelSort = None, sort_downloaded_first=False) -> List:
         pass
 
     @abstractmethod
@@ -67,6 +133,11 @@ class Storage(ABC):
 
     @abstractmethod
     def add_record(self, record: Record):
+        """
+        Adds new record.
+        :param record: record to add.
+        :return: id of the added record.
+        """
         pass
 
     @abstractmethod
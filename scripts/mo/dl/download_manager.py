@@ -1,16 +1,27 @@
+import errno
 import os
+import shutil
 import tempfile
 import threading
-from copy import deepcopy
-from typing import List
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Optional
 from urllib.parse import urlparse
 
+import requests
+
+from scripts.mo.data.hash_cache import HashCache
+from scripts.mo.data.download_queue import DownloadQueue, PRIORITY_NORMAL
+from scripts.mo.data.location_reconciler import LocationReconciler
+from scripts.mo.data.model_store import ModelStore
+from scripts.mo.data.partial_downloads import PartialDownloads
 from scripts.mo.dl.downloader import Downloader
 from scripts.mo.dl.gdrive_downloader import GDriveDownloader
 from scripts.mo.dl.http_downloader import HttpDownloader
-from scripts.mo.environment import env, logger, calculate_md5
+from scripts.mo.environment import env, logger
+from scripts.mo.hashing import hash_file, MultiHasher, HASH_MD5, HASH_SHA256
 from scripts.mo.models import Record
-from scripts.mo.utils import resize_preview_image, get_model_filename_without_extension, calculate_sha256
+from scripts.mo.utils import resize_preview_image, get_model_filename_without_extension
 
 GENERAL_STATUS_IN_PROGRESS = 'In Progress'
 GENERAL_STATUS_CANCELLED = 'Cancelled'
@@ -23,6 +34,19 @@ RECORD_STATUS_COMPLETED = 'Completed'
 RECORD_STATUS_EXISTS = 'Exists'
 RECORD_STATUS_ERROR = 'Error'
 RECORD_STATUS_CANCELLED = 'Cancelled'
+RECORD_STATUS_PAUSED = 'Paused'
+RECORD_STATUS_WAITING = 'Waiting'
+
+_HOST_SLOT_WAIT_TIMEOUT = 0.5
+_QUEUE_POLL_INTERVAL = 1
+_MAX_ATTEMPTS = 5
+_RETRY_BASE_DELAY = 5
+_RETRY_MAX_DELAY = 300
+_DESTINATION_BUSY_DELAY = 5
+_PARTIAL_FILE_SUFFIX = '.mo-part'
+_PROBE_WORKERS = 8
+# Space left free on the destination file system, so webui and other programs don't fail on full disk.
+_FREE_SPACE_RESERVE = 512 * 1024 * 1024
 
 
 def _get_destination_dir_path(record: Record) -> str:
@@ -54,17 +78,10 @@ def _get_filename_from_url(url):
     return filename + extension
 
 
-def _get_filename(downloader: Downloader, record: Record) -> str:
+def _get_filename(record: Record) -> Optional[str]:
     if record.download_filename:
-        filename = record.download_filename
-    else:
-        url_filename = _get_filename_from_url(record.download_url)
-        if url_filename is not None:
-            return url_filename
-        filename = downloader.fetch_filename(record.download_url)
-        if filename is None:
-            filename = str(record.id_)
-    return filename
+        return record.download_filename
+    return _get_filename_from_url(record.download_url)
 
 
 def _change_file_extension(filename, new_extension):
@@ -78,7 +95,39 @@ def _change_file_extension(filename, new_extension):
     return new_filename
 
 
+def _is_transient_error(ex: Exception) -> bool:
+    if isinstance(ex, requests.HTTPError) and ex.response is not None:
+        return ex.response.status_code == 429 or ex.response.status_code >= 500
+    return isinstance(ex, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                           ConnectionError, TimeoutError))
+
+
+def _get_retry_delay(ex: Exception, attempts: int) -> float:
+    if isinstance(ex, requests.HTTPError) and ex.response is not None:
+        retry_after = ex.response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return min(int(retry_after), _RETRY_MAX_DELAY)
+    return min(_RETRY_BASE_DELAY * 2 ** (attempts - 1), _RETRY_MAX_DELAY)
+
+
+class _RecordStopEvent(threading.Event):
+    """
+    Stop event of a single record download. It is set when the record is paused or the whole download is stopped.
+    """
+
+    def __init__(self, general_stop_event: threading.Event):
+        super().__init__()
+        self._general_stop_event = general_stop_event
+
+    def is_set(self) -> bool:
+        return super().is_set() or self._general_stop_event.is_set()
+
+
 class DownloadManager:
+    """
+    Downloads records from DownloadQueue by a pool of workers, number of concurrent downloads from the same host is
+    limited separately. Transient errors are retried with exponential backoff.
+    """
     __instance = None
     __lock = threading.Lock()
 
@@ -86,10 +135,27 @@ class DownloadManager:
         self._stop_event = threading.Event()
         self._stop_event.set()
 
-        self._state = {}
-        self._latest_state = {}
+        # Every state change gets the next sequence number, records are ordered by their last change, so readers
+        # get the changes made since their previous read without copying the whole state.
+        self._state_lock = threading.Lock()
+        self._seq = 0
+        self._reset_seq = 0
+        self._general_state = {}
+        self._general_seq = 0
+        self._records = OrderedDict()
         self._thread = None
+        self._loop_lock = threading.Lock()
+        # Loop is active until it exits, stopped loop is still active while its downloads are being stopped.
+        self._loop_active = False
+        self._restart = False
+        self._record_stop_events = {}
+        self._preflight_batches = []
+        self._temp_files_lock = threading.Lock()
         self._temp_files = set()
+        self._host_slots_lock = threading.Lock()
+        self._host_slots = {}
+        self._destinations_lock = threading.Lock()
+        self._destinations = {}
 
         self._downloaders: List = [
             GDriveDownloader(),
@@ -105,160 +171,604 @@ class DownloadManager:
         return DownloadManager.__instance
 
     def is_running(self) -> bool:
-        return not self._stop_event.is_set()
+        return not self._stop_event.is_set() or self._restart
 
     def get_state(self) -> dict:
-        return self._state
-
-    def get_latest_state(self) -> dict:
-        return self._latest_state
-
-    def start_download(self, records: List):
-        if not self._stop_event.is_set():
-            logger.warning('Download already running')
-            return
-
-        self._stop_event.clear()
-        self._state = {}
-        self._latest_state = {}
-        self._state_update(general_status=GENERAL_STATUS_IN_PROGRESS)
-        self._thread = threading.Thread(target=self._download_loop, args=(records,), daemon=True)
-        self._thread.start()
-
-    def stop_download(self):
-        if self._stop_event.is_set():
-            logger.warning('Download not running')
-            return
+        return self.get_changes(0)
+
+    def get_changes(self, since_seq: int) -> dict:
+        """
+        Returns download state changed since the given sequence number. Whole state is returned if the download was
+        restarted since then or the number is unknown, e.g. it was returned before webui restart.
+        :param since_seq: 'seq' of the previously returned state, 0 to get the whole state.
+        :return: dict with 'seq', general state fields if they changed and 'records' with states of the changed
+        records.
+        """
+        with self._state_lock:
+            if since_seq < self._reset_seq or since_seq > self._seq:
+                since_seq = 0
+
+            result = {'seq': self._seq}
+            if self._general_seq > since_seq:
+                result.update(self._general_state)
+
+            records = {}
+            for record_id in reversed(self._records):
+                record_seq, record_state = self._records[record_id]
+                if record_seq <= since_seq:
+                    break
+                records[record_id] = dict(record_state)
+            if records:
+                result['records'] = records
+            return result
+
+    def start_download(self, records: List, priority: int = PRIORITY_NORMAL):
+        """
+        Starts processing of the records if it is not running yet. Records are added to the download queue by the
+        download loop after the pre-flight check, records which don't fit the free space of their destination file
+        system are not queued and marked as failed.
+        :param records: records to download.
+        :param priority: queue priority of the records.
+        :return: None.
+        """
+        with self._loop_lock:
+            if not self.is_running():
+                self._reset_state()
+            for record in records:
+                if self._get_record_status(record.id_) != RECORD_STATUS_IN_PROGRESS:
+                    self._state_update(record_id=record.id_, record_state={'status': RECORD_STATUS_PENDING})
+            # Probes could take a while on slow hosts, so they don't hold the caller.
+            self._preflight_batches.append((records, priority))
+            if not self.is_running():
+                self._start_loop()
+
+    def preflight(self, records: List, stop_event: Optional[threading.Event] = None) -> dict:
+        """
+        Requests sizes of the records files concurrently and checks that they fit free space of their destination
+        file systems. Records are admitted in the given order, record which doesn't fit is skipped, so smaller
+        records after it are still downloaded. Files which exist or could be linked take no space.
+        :param records: records to download.
+        :param stop_event: probes which are not started yet are skipped when event is set.
+        :return: dict with 'total_size' - bytes to download by the admitted records, 'sizes' - bytes to download by
+        record id, None if the size is unknown, 'filesystems' - list of dicts with 'path', 'free', 'required' and
+        'refused' bytes of each destination file system, 'refused' - ids of the records which don't fit.
+        """
+        records = [record for record in records if record.download_url]
+        if not records:
+            return {'total_size': 0, 'sizes': {}, 'filesystems': [], 'refused': []}
+
+        with ThreadPoolExecutor(max_workers=min(_PROBE_WORKERS, len(records)),
+                                thread_name_prefix='mo-probe') as executor:
+            required = list(executor.map(lambda record: self._get_required_size(record, stop_event), records))
+
+        filesystems = {}
+        sizes = {}
+        refused = []
+        for record, (destination_dir, size) in zip(records, required):
+            sizes[record.id_] = size
+            if destination_dir is None or not size:
+                continue
+
+            device = os.stat(destination_dir).st_dev
+            filesystem = filesystems.get(device)
+            if filesystem is None:
+                filesystem = {'path': destination_dir, 'free': shutil.disk_usage(destination_dir).free,
+                              'required': 0, 'refused': 0}
+                filesystems[device] = filesystem
+
+            if filesystem['required'] + size > filesystem['free'] - _FREE_SPACE_RESERVE:
+                logger.warning(f'Record {record.id_} needs {size} bytes, which does not fit free space of '
+                               f'{filesystem["path"]}')
+                filesystem['refused'] += size
+                refused.append(record.id_)
+            else:
+                filesystem['required'] += size
+
+        return {
+            'total_size': sum(filesystem['required'] for filesystem in filesystems.values()),
+            'sizes': sizes,
+            'filesystems': list(filesystems.values()),
+            'refused': refused
+        }
+
+    def _get_required_size(self, record: Record, stop_event: Optional[threading.Event] = None) -> tuple:
+        """
+        Finds out how many bytes the record download will take on disk.
+        :param record: record to download.
+        :param stop_event: record is not probed if event is set.
+        :return: destination directory and size in bytes, None instead of unknown directory or size.
+        """
+        if stop_event is not None and stop_event.is_set():
+            return None, None
 
-        self._stop_event.set()
-        self._thread.join()
+        try:
+            destination_dir = _get_destination_dir_path(record)
+        except Exception as ex:
+            logger.warning(f'Record {record.id_} destination is unavailable: {ex}')
+            return None, None
 
-    def _state_update(self, general_status=None, exception=None, record_id=None, record_state=None):
-        new_general_state = deepcopy(self._state)
+        filename = _get_filename(record)
+        if filename is not None and os.path.exists(os.path.join(destination_dir, filename)):
+            return destination_dir, 0
+        if ModelStore.instance().find(record.sha256_hash) is not None:
+            return destination_dir, 0
 
-        latest_state = {}
+        try:
+            info = self._get_downloader(record.download_url).probe(record.download_url)
+        except Exception as ex:
+            logger.warning(f'Failed to probe record {record.id_}: {ex}')
+            info = None
+        if info is None:
+            return destination_dir, None
 
-        if general_status is not None:
-            new_general_state['general_status'] = general_status
-            latest_state['general_status'] = general_status
+        if filename is None:
+            filename = os.path.basename(info.get('filename') or '')
+            if filename and os.path.exists(os.path.join(destination_dir, filename)):
+                return destination_dir, 0
+            filename = None
+
+        size = info.get('size')
+        if not size:
+            return destination_dir, None
+
+        # Partial file of the resumed download already holds its blocks. There are no st_blocks on Windows, where
+        # the preallocated file size is counted instead.
+        partial_file_path = os.path.join(destination_dir, (filename or str(record.id_)) + _PARTIAL_FILE_SUFFIX)
+        if os.path.exists(partial_file_path):
+            partial_stat = os.stat(partial_file_path)
+            blocks = getattr(partial_stat, 'st_blocks', None)
+            size -= min(size, partial_stat.st_size if blocks is None else blocks * 512)
+        return destination_dir, size
+
+    def resume_queue(self):
+        """
+        Starts processing of the records left in the queue, e.g. by the previous webui run.
+        :return: None.
+        """
+        with self._loop_lock:
+            if not self.is_running() and DownloadQueue.instance().has_pending():
+                self._reset_state()
+                self._start_loop()
 
-        if exception is not None:
-            new_general_state['exception'] = str(exception)
-            latest_state['exception'] = str(exception)
+    def stop_download(self):
+        """
+        Stops the downloads. Loop stops the running downloads and clears the queue in background, so the caller
+        is not held until they finish.
+        :return: None.
+        """
+        with self._loop_lock:
+            if self._stop_event.is_set() and not self._restart:
+                logger.warning('Download not running')
+                return
 
-        if record_id is not None and record_state is not None:
-            if new_general_state.get('records') is None:
-                new_general_state['records'] = {}
+            self._restart = False
+            self._preflight_batches = []
+            self._stop_event.set()
+
+    def pause_download(self, record_id):
+        DownloadQueue.instance().pause(record_id)
+        with self._loop_lock:
+            stop_event = self._record_stop_events.get(str(record_id))
+        if stop_event is not None:
+            stop_event.set()
+        elif DownloadQueue.instance().is_paused(record_id):
+            self._state_update(record_id=self._get_state_record_id(record_id),
+                               record_state={'status': RECORD_STATUS_PAUSED})
+
+    def resume_download(self, record_id):
+        DownloadQueue.instance().resume(record_id)
+        self._state_update(record_id=self._get_state_record_id(record_id),
+                           record_state={'status': RECORD_STATUS_PENDING})
+        self.resume_queue()
 
-            if new_general_state['records'].get(record_id) is None:
-                new_general_state['records'][record_id] = record_state
-            else:
-                new_general_state['records'][record_id].update(record_state)
+    @staticmethod
+    def move_download(record_id, offset: int):
+        DownloadQueue.instance().move(record_id, offset)
+
+    def _reset_state(self):
+        with self._state_lock:
+            self._seq += 1
+            self._reset_seq = self._seq
+            self._general_state = {}
+            self._records.clear()
+        # Host limit could be changed in the settings since the previous download.
+        self._host_slots = {}
+
+    def _start_loop(self):
+        self._state_update(general_status=GENERAL_STATUS_IN_PROGRESS)
+        if self._loop_active:
+            # Stopped loop starts over once its downloads are stopped.
+            self._restart = True
+            return
 
-            latest_state['records'] = {record_id: record_state}
+        self._stop_event.clear()
+        self._loop_active = True
+        self._thread = threading.Thread(target=self._download_loop, daemon=True)
+        self._thread.start()
 
-        if general_status == GENERAL_STATUS_CANCELLED and new_general_state.get('records') is not None:
-            for key, value in new_general_state['records'].items():
-                if value.get('status') and \
-                        (value['status'] == RECORD_STATUS_PENDING or value['status'] == RECORD_STATUS_IN_PROGRESS):
-                    value['status'] = RECORD_STATUS_CANCELLED
+    def _get_record_status(self, record_id) -> Optional[str]:
+        with self._state_lock:
+            entry = self._records.get(record_id)
+            return None if entry is None else entry[1].get('status')
+
+    def _get_state_record_id(self, record_id):
+        # Queue keeps ids as strings, while state is keyed by the record ids.
+        with self._state_lock:
+            return next((key for key in self._records if str(key) == str(record_id)), record_id)
+
+    def _has_record_status(self, status: str) -> bool:
+        with self._state_lock:
+            return any(record_state.get('status') == status for _, record_state in self._records.values())
+
+    def _state_update(self, general_status=None, exception=None, record_id=None, record_state=None, preflight=None):
+        with self._state_lock:
+            if general_status is not None or exception is not None or preflight is not None:
+                self._seq += 1
+                self._general_seq = self._seq
+                if general_status is not None:
+                    self._general_state['general_status'] = general_status
+                if exception is not None:
+                    self._general_state['exception'] = str(exception)
+                if preflight is not None:
+                    self._general_state['preflight'] = preflight
+
+            if record_id is not None and record_state is not None:
+                self._update_record_state(record_id, record_state)
+
+            if general_status == GENERAL_STATUS_CANCELLED:
+                for key, (_, value) in list(self._records.items()):
+                    if value.get('status') == RECORD_STATUS_PENDING or value.get('status') == RECORD_STATUS_IN_PROGRESS:
+                        self._update_record_state(key, {'status': RECORD_STATUS_CANCELLED})
+
+    def _update_record_state(self, record_id, record_state: dict):
+        # Record state is updated in place, nested progress dicts are replaced, so shallow copies are consistent.
+        self._seq += 1
+        entry = self._records.get(record_id)
+        state = {} if entry is None else entry[1]
+        state.update(record_state)
+        self._records[record_id] = (self._seq, state)
+        self._records.move_to_end(record_id)
+
+    def _download_loop(self):
+        while True:
+            error = None
+            try:
+                self._clear_temp_files()
+                workers = max(1, env.download_workers())
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mo-download') as executor:
+                    self._process_queue(executor, workers)
+            except Exception as ex:
+                error = ex
+                logger.exception(ex)
+            self._clear_temp_files()
 
-        self._state = new_general_state
-        self._latest_state = latest_state
+            with self._loop_lock:
+                # Records could be added while the loop was finishing.
+                if error is None and not self._stop_event.is_set() and \
+                        (self._preflight_batches or DownloadQueue.instance().has_pending()):
+                    continue
 
-    def _download_loop(self, records: List):
-        try:
-            self._clear_temp_files()
-            for record in records:
-                for upd in self._download_record(record):
-                    self._state_update(record_id=record.id_, record_state=upd)
+                if self._stop_event.is_set():
+                    # Downloads are stopped by now, records left in the queue are dropped.
+                    DownloadQueue.instance().clear()
+                    if self._restart:
+                        self._restart = False
+                        self._stop_event.clear()
+                        continue
+
+                self._preflight_batches = []
+
+                if error is not None:
+                    self._state_update(general_status=GENERAL_STATUS_ERROR, exception=str(error))
+                elif self._stop_event.is_set():
+                    self._state_update(general_status=GENERAL_STATUS_CANCELLED)
+                elif self._has_record_status(RECORD_STATUS_ERROR):
+                    self._state_update(general_status=GENERAL_STATUS_ERROR)
+                else:
+                    self._state_update(general_status=GENERAL_STATUS_COMPLETED)
+                self._stop_event.set()
+                self._loop_active = False
+                return
 
-                    if self._stop_event.is_set():
-                        break
+    def _process_queue(self, executor: ThreadPoolExecutor, workers: int):
+        queue = DownloadQueue.instance()
+        running = set()
+        while not self._stop_event.is_set():
+            self._admit_records()
 
-            exception = None
-            for key, value in self._state['records'].items():
-                if value.get('exception') is not None:
-                    exception = value['exception']
+            while len(running) < workers:
+                record = self._take_record()
+                if record is None:
                     break
+                running.add(executor.submit(self._process_record, record))
 
-            if exception is not None:
-                self._state_update(general_status=GENERAL_STATUS_ERROR)
-            elif self._stop_event.is_set():
-                self._state_update(general_status=GENERAL_STATUS_CANCELLED)
+            if not running and not queue.has_pending() and not self._preflight_batches:
+                return
+
+            delay = queue.get_next_attempt_delay()
+            timeout = _QUEUE_POLL_INTERVAL if delay is None else max(0.1, min(delay, _QUEUE_POLL_INTERVAL))
+            if running:
+                done, running = wait(running, timeout=timeout)
+                for future in done:
+                    future.result()
             else:
-                self._state_update(general_status=GENERAL_STATUS_COMPLETED)
+                self._stop_event.wait(timeout)
+
+    def _admit_records(self):
+        """
+        Runs pre-flight check of the records added since the previous call, queues records which fit the free space
+        and marks the others as failed. Check result is published in the download state.
+        :return: None.
+        """
+        with self._loop_lock:
+            batches, self._preflight_batches = self._preflight_batches, []
+
+        for records, priority in batches:
+            try:
+                # Stopped download doesn't wait for probes of every record.
+                preflight = self.preflight(records, self._stop_event)
+            except Exception as ex:
+                # Check is advisory, records are downloaded without it rather than dropped.
+                logger.exception(ex)
+                preflight = {'total_size': 0, 'sizes': {}, 'filesystems': [], 'refused': []}
+            if self._stop_event.is_set():
+                return
 
-        except Exception as ex:
-            self._state_update(general_status=GENERAL_STATUS_ERROR, exception=str(ex))
-            logger.exception(ex)
-        self._clear_temp_files()
+            refused = set(preflight['refused'])
+            for record_id in refused:
+                self._state_update(record_id=record_id, record_state={
+                    'status': RECORD_STATUS_ERROR,
+                    'exception': OSError(errno.ENOSPC, 'Not enough free disk space to download '
+                                                       f'{preflight["sizes"][record_id]} bytes')
+                })
+            DownloadQueue.instance().add([record.id_ for record in records if record.id_ not in refused], priority)
+            self._state_update(preflight=preflight)
 
-        self._stop_event.set()
-        self._running = False
+    @staticmethod
+    def _take_record() -> Optional[Record]:
+        queue = DownloadQueue.instance()
+        while True:
+            record_id = queue.take()
+            if record_id is None:
+                return None
+            record = env.storage.get_record_by_id(record_id)
+            if record is not None and record.download_url:
+                return record
+            logger.warning(f'Record {record_id} has nothing to download, it is removed from the download queue')
+            queue.complete(record_id)
+
+    def _process_record(self, record: Record):
+        stop_event = _RecordStopEvent(self._stop_event)
+        with self._loop_lock:
+            self._record_stop_events[str(record.id_)] = stop_event
+
+        status = None
+        exception = None
+        try:
+            host_slot = self._acquire_host_slot(record.download_url, stop_event)
+            if host_slot is not None:
+                updates = self._download_record(record, stop_event)
+                try:
+                    for upd in updates:
+                        if upd.get('status') == RECORD_STATUS_ERROR:
+                            exception = upd.get('exception')
+                            upd = self._schedule_retry(record, exception) or upd
+                        status = upd.get('status', status)
+                        self._state_update(record_id=record.id_, record_state=upd)
+
+                        if stop_event.is_set():
+                            break
+                finally:
+                    updates.close()
+                    host_slot.release()
+        finally:
+            self._release_destination(record.id_)
+            with self._loop_lock:
+                del self._record_stop_events[str(record.id_)]
+
+        queue = DownloadQueue.instance()
+        if status == RECORD_STATUS_COMPLETED or status == RECORD_STATUS_EXISTS:
+            queue.complete(record.id_)
+        elif status == RECORD_STATUS_ERROR:
+            queue.fail(record.id_, str(exception))
+        elif status == RECORD_STATUS_WAITING:
+            pass
+        elif queue.is_paused(record.id_):
+            self._state_update(record_id=record.id_, record_state={'status': RECORD_STATUS_PAUSED})
+        else:
+            queue.release(record.id_)
+
+    def _schedule_retry(self, record: Record, exception: Exception) -> Optional[dict]:
+        if not _is_transient_error(exception) or self._stop_event.is_set():
+            return None
+
+        attempts = DownloadQueue.instance().get_attempts(record.id_) + 1
+        if attempts >= _MAX_ATTEMPTS:
+            return None
+
+        delay = _get_retry_delay(exception, attempts)
+        logger.warning(f'Download of record {record.id_} failed, retrying in {delay} seconds: {exception}')
+        DownloadQueue.instance().retry(record.id_, str(exception), delay)
+        return {'status': RECORD_STATUS_WAITING, 'exception': exception, 'retry_delay': delay, 'deferred': False}
+
+    def _claim_destination(self, record_id, destination_file_path: str) -> bool:
+        """
+        Marks destination file as being downloaded by the record, so duplicate records don't write the same partial
+        file at the same time.
+        :return: True if the destination was claimed, False if another record is downloading it.
+        """
+        key = os.path.normcase(os.path.abspath(destination_file_path))
+        with self._destinations_lock:
+            owner = next((owner for owner, path in self._destinations.items() if path == key), None)
+            if owner is not None and owner != record_id:
+                return False
+            self._destinations[record_id] = key
+            return True
+
+    def _release_destination(self, record_id):
+        with self._destinations_lock:
+            self._destinations.pop(record_id, None)
 
-    def _download_record(self, record: Record):
+    @staticmethod
+    def _defer(record: Record) -> dict:
+        # Destination is checked again when the record is taken, so it ends as existing once the other one is done.
+        logger.info(f'Destination of record {record.id_} is being downloaded by another record, download is deferred')
+        DownloadQueue.instance().defer(record.id_, _DESTINATION_BUSY_DELAY)
+        return {'status': RECORD_STATUS_WAITING, 'exception': None, 'retry_delay': _DESTINATION_BUSY_DELAY,
+                'deferred': True}
+
+    def _acquire_host_slot(self, url: str, stop_event: threading.Event) -> Optional[threading.Semaphore]:
+        host = urlparse(url).hostname or ''
+        with self._host_slots_lock:
+            host_slot = self._host_slots.get(host)
+            if host_slot is None:
+                host_slot = threading.BoundedSemaphore(max(1, env.download_host_workers()))
+                self._host_slots[host] = host_slot
+
+        while not stop_event.is_set():
+            if host_slot.acquire(timeout=_HOST_SLOT_WAIT_TIMEOUT):
+                return host_slot
+        return None
+
+    def _download_record(self, record: Record, stop_event: threading.Event):
+        record_temp_files = []
+        partial_file_path = None
         try:
             yield {'status': RECORD_STATUS_IN_PROGRESS}
 
             downloader = self._get_downloader(record.download_url)
             logger.debug('Start download record with id: %s', record.id_)
 
-            if self._stop_event.is_set():
+            if stop_event.is_set():
                 return
 
-            filename = _get_filename(downloader, record)
+            filename = _get_filename(record)
             logger.debug('filename: %s', filename)
 
-            yield {'filename': filename}
-
-            if self._stop_event.is_set():
-                return
-
             destination_dir = _get_destination_dir_path(record)
-            destination_file_path = os.path.join(destination_dir, filename)
-            logger.debug('destination_file_path: %s', destination_file_path)
+            destination_file_path = None
+            if filename is not None:
+                destination_file_path = os.path.join(destination_dir, filename)
+                logger.debug('destination_file_path: %s', destination_file_path)
+                yield {'filename': filename, 'destination': destination_file_path}
+
+                if not self._claim_destination(record.id_, destination_file_path):
+                    yield self._defer(record)
+                    return
 
-            yield {'destination': destination_file_path}
+                if os.path.exists(destination_file_path):
+                    logger.debug('File already exists')
+                    yield {'status': RECORD_STATUS_EXISTS}
+                    return
 
-            if os.path.exists(destination_file_path):
-                logger.debug('File already exists')
-                yield {'status': RECORD_STATUS_EXISTS}
-                return
+                partial_file_path = destination_file_path + _PARTIAL_FILE_SUFFIX
+            else:
+                # Name is taken from the download response, so data is written by the record id until it is known.
+                partial_file_path = os.path.join(destination_dir, f'{record.id_}{_PARTIAL_FILE_SUFFIX}')
 
-            if self._stop_event.is_set():
+            if stop_event.is_set():
                 return
 
-            with tempfile.NamedTemporaryFile(delete=False, dir=destination_dir) as temp:
-                logger.debug('Downloading into tmp file: %s', temp.name)
-                self._temp_files.add(temp)
-                for upd in downloader.download(record.download_url, temp.name, filename, self._stop_event):
-                    yield {'dl': upd}
-
-                temp.close()
+            # Same content could be already downloaded for another record or kept in the model store.
+            source = ModelStore.instance().find(record.sha256_hash)
+            link_source = source is not None and destination_file_path is not None
+            downloaded = False
+
+            if not link_source:
+                if os.path.exists(partial_file_path) and \
+                        not PartialDownloads.instance().contains(partial_file_path, record.download_url):
+                    os.remove(partial_file_path)
+
+                hasher = MultiHasher([HASH_MD5, HASH_SHA256])
+                logger.debug('Downloading into partial file: %s', partial_file_path)
+                exists = False
+                busy = False
+                download = downloader.download(record.download_url, partial_file_path, filename or str(record.id_),
+                                               stop_event, hasher)
+                try:
+                    for upd in download:
+                        if destination_file_path is None and 'filename' in upd:
+                            # Server provided name could contain a path, only its last part is used.
+                            filename = os.path.basename(upd['filename'] or '') or str(record.id_)
+                            destination_file_path = os.path.join(destination_dir, filename)
+                            logger.debug('destination_file_path: %s', destination_file_path)
+                            yield {'filename': filename, 'destination': destination_file_path}
+
+                            busy = not self._claim_destination(record.id_, destination_file_path)
+                            if busy:
+                                break
+
+                            exists = os.path.exists(destination_file_path)
+                            # Content is available locally, only the name was needed from the server.
+                            link_source = not exists and source is not None
+                            if exists or link_source:
+                                break
+                        upd.pop('filename', None)
+                        yield {'dl': upd}
+
+                    if destination_file_path is None:
+                        filename = str(record.id_)
+                        destination_file_path = os.path.join(destination_dir, filename)
+                        yield {'filename': filename, 'destination': destination_file_path}
+                        exists = os.path.exists(destination_file_path)
+
+                    downloaded = not exists and not busy and not link_source and not stop_event.is_set()
+                finally:
+                    # Downloader saves its resume state on close, file is kept only if it can be resumed.
+                    download.close()
+                    if exists or busy or link_source:
+                        self._remove_partial_file(partial_file_path)
+                    elif not downloaded:
+                        self._remove_unresumable_file(partial_file_path, record.download_url)
+
+                if busy:
+                    yield self._defer(record)
+                    return
 
-                if self._stop_event.is_set():
+                if exists:
+                    logger.debug('File already exists')
+                    yield {'status': RECORD_STATUS_EXISTS}
                     return
 
-                os.rename(temp.name, destination_file_path)
-                self._temp_files.remove(temp)
+            if link_source:
+                yield {'source': source}
+                ModelStore.instance().link(source, destination_file_path)
+                hashes = HashCache.instance().get_hashes(source)
+                size = os.path.getsize(destination_file_path)
+                yield {'dl': {'bytes_ready': size, 'bytes_total': size, 'speed_rate': 0, 'elapsed': 0}}
+            elif downloaded:
+                os.replace(partial_file_path, destination_file_path)
                 os.chmod(destination_file_path, 0o644)
-                logger.debug('Move from tmp file to destination: %s', destination_file_path)
+                logger.debug('Move from partial file to destination: %s', destination_file_path)
+
+                if hasher.bytes_hashed == os.path.getsize(destination_file_path):
+                    hashes = hasher.hexdigests()
+                else:
+                    logger.debug('Download was not hashed from the start, hashing file: %s', destination_file_path)
+                    hashes = hash_file(destination_file_path, [HASH_MD5, HASH_SHA256])
+            else:
+                return
 
             record.location = destination_file_path
-            record.md5_hash = calculate_md5(destination_file_path)
-            record.sha256_hash = calculate_sha256(destination_file_path)
+            record.md5_hash = hashes[HASH_MD5]
+            record.sha256_hash = hashes[HASH_SHA256]
+            HashCache.instance().put(destination_file_path, hashes)
+            ModelStore.instance().put(destination_file_path, hashes)
 
             env.storage.update_record(record)
+            LocationReconciler.instance().update_fingerprint(record)
 
         except Exception as ex:
+            if isinstance(ex, OSError) and ex.errno == errno.ENOSPC and partial_file_path is not None:
+                # File can't be resumed until space is freed, its blocks are given back to the other downloads.
+                self._remove_partial_file(partial_file_path)
             yield {'status': RECORD_STATUS_ERROR, 'exception': ex}
             logger.exception(ex)
             return
 
-        self._clear_temp_files()
+        self._clear_temp_files(record_temp_files)
 
-        if self._stop_event.is_set():
+        if stop_event.is_set():
             return
 
         if record.preview_url and env.download_preview():
@@ -267,7 +777,7 @@ class DownloadManager:
                 logger.debug('Preview image name: %s', preview_filename)
                 yield {'preview_filename': preview_filename}
 
-                if self._stop_event.is_set():
+                if stop_event.is_set():
                     return
 
                 destination_dir = _get_destination_dir_path(record)
@@ -275,19 +785,19 @@ class DownloadManager:
                 logger.debug('preview_destination_file_path: %s', preview_destination_file_path)
                 yield {'preview_destination': preview_destination_file_path}
 
-                if self._stop_event.is_set():
+                if stop_event.is_set():
                     return
 
                 preview_downloader = self._get_downloader(record.preview_url)
 
                 with tempfile.NamedTemporaryFile(dir=destination_dir, delete=False) as temp:
                     logger.debug('Downloading preview into tmp file: %s', temp.name)
-                    self._temp_files.add(temp)
+                    self._add_temp_file(temp, record_temp_files)
                     for upd in preview_downloader.download(record.preview_url, temp.name, preview_filename,
-                                                           self._stop_event):
+                                                           stop_event):
                         yield {'preview_dl': upd}
 
-                    if self._stop_event.is_set():
+                    if stop_event.is_set():
                         return
 
                     resize_preview_image(temp.name, preview_destination_file_path)
@@ -297,7 +807,7 @@ class DownloadManager:
                 yield {'exception_preview': ex}
                 logger.exception(ex)
 
-            self._clear_temp_files()
+            self._clear_temp_files(record_temp_files)
 
         yield {'status': RECORD_STATUS_COMPLETED}
 
@@ -313,8 +823,33 @@ class DownloadManager:
                 return True
         return False
 
-    def _clear_temp_files(self):
-        for temp_file in self._temp_files:
+    @staticmethod
+    def _remove_partial_file(partial_file_path: str):
+        PartialDownloads.instance().remove(partial_file_path)
+        if os.path.exists(partial_file_path):
+            os.remove(partial_file_path)
+
+    @staticmethod
+    def _remove_unresumable_file(partial_file_path: str, url: str):
+        if os.path.exists(partial_file_path) and not PartialDownloads.instance().contains(partial_file_path, url):
+            os.remove(partial_file_path)
+
+    def _add_temp_file(self, temp_file, record_temp_files: List):
+        with self._temp_files_lock:
+            self._temp_files.add(temp_file)
+        record_temp_files.append(temp_file)
+
+    def _clear_temp_files(self, temp_files=None):
+        """
+        Removes temporary files left by downloads.
+        :param temp_files: temporary files to remove, all files of the running download if None.
+        :return: None.
+        """
+        with self._temp_files_lock:
+            temp_files = list(self._temp_files if temp_files is None else temp_files)
+            self._temp_files.difference_update(temp_files)
+
+        for temp_file in temp_files:
             try:
                 if temp_file:
                     temp_file.close()
@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from tqdm import tqdm
+
+from scripts.mo.environment import env
+
+_REPORT_INTERVAL = 0.1
+_SPEED_WINDOW = 3
+
+
+class DownloadProgress:
+    """
+    Counts downloaded bytes of a file, data could be received by several threads. Progress is reported at a fixed
+    rate instead of every received chunk, speed is measured over the last few seconds.
+    Console progress bar is shown only if it's enabled in the settings.
+    """
+
+    def __init__(self, total: Optional[int], description: str, initial: int = 0):
+        self.total = total
+        self.bytes_ready = initial
+        self._lock = threading.Lock()
+        self._started_at = time.monotonic()
+        self._reported_at = 0
+        self._samples = deque([(self._started_at, initial)])
+        self._progress_bar = None
+        if env.download_console_progress():
+            self._progress_bar = tqdm(total=total, initial=initial, unit='iB', unit_scale=True, desc=description)
+
+    def update(self, size: int):
+        with self._lock:
+            self.bytes_ready += size
+            if self._progress_bar is not None:
+                self._progress_bar.update(size)
+
+    def is_due(self) -> bool:
+        return time.monotonic() - self._reported_at >= _REPORT_INTERVAL
+
+    def report(self) -> dict:
+        """
+        Creates progress update and starts the next report interval.
+        :return: dict with bytes_ready, bytes_total, speed_rate in bytes per second and elapsed seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            bytes_ready = self.bytes_ready
+        self._reported_at = now
+
+        self._samples.append((now, bytes_ready))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= _SPEED_WINDOW:
+            self._samples.popleft()
+        sample_time, sample_bytes = self._samples[0]
+
+        return {
+            'bytes_ready': bytes_ready,
+            'bytes_total': self.total,
+            'speed_rate': (bytes_ready - sample_bytes) / (now - sample_time) if now > sample_time else 0,
+            'elapsed': now - self._started_at
+        }
+
+    def close(self):
+        if self._progress_bar is not None:
+            self._progress_bar.close()
@@ -1,5 +1,8 @@
 import threading
 from abc import ABC, abstractmethod
+from typing import Optional
+
+from scripts.mo.hashing import MultiHasher
 
 
 class Downloader(ABC):
@@ -7,10 +10,28 @@ class Downloader(ABC):
     def accepts_url(self, url: str) -> bool:
         pass
 
-    @abstractmethod
-    def fetch_filename(self, url: str):
-        pass
+    def probe(self, url: str) -> Optional[dict]:
+        """
+        Requests file information without downloading the file.
+        :param url: url to download.
+        :return: dict with 'size' in bytes, 'ranges' - whether download could be resumed or split and 'filename'
+        provided by the server or None, None if the downloader can't tell.
+        """
+        return None
 
     @abstractmethod
-    def download(self, url: str, destination_file: str, description: str, stop_event: threading.Event):
+    def download(self, url: str, destination_file: str, description: str, stop_event: threading.Event,
+                 hasher: Optional[MultiHasher] = None):
+        """
+        Downloads file and yields progress updates. Update yielded once the response headers are received contains
+        'filename' with the file name provided by the server or None, so the name is known before the file data.
+        :param url: url to download.
+        :param destination_file: path to the file to write. File could contain a partial download saved to
+        PartialDownloads, downloader may continue it instead of downloading from the start.
+        :param description: progress description.
+        :param stop_event: download is cancelled when event is set.
+        :param hasher: optional hasher which receives every written chunk in order. Chunks written at non-zero
+        offset of the file must not be passed unless the previous bytes were passed first, so hasher.bytes_hashed
+        not equal to the file size means digests should be calculated from the file.
+        """
         pass
@@ -29,16 +29,18 @@ import re
 import shutil
 import tempfile
 import textwrap
-import six
+from typing import Optional
 
-import requests
-import tqdm
-from bs4 import BeautifulSoup
+import six
 
+from scripts.mo.data.partial_downloads import PartialDownload, PartialDownloads
+from scripts.mo.dl import http_client
+from scripts.mo.dl.download_progress import DownloadProgress
 from scripts.mo.dl.downloader import Downloader
 from scripts.mo.environment import logger
+from scripts.mo.hashing import MultiHasher
 
-CHUNK_SIZE = 512 * 1024  # 512KB
+CHUNK_SIZE = 4 * 1024 * 1024  # 4MB
 home = osp.expanduser("~")
 
 
@@ -117,7 +119,7 @@ def _get_url_from_gdrive_confirmation(contents):
 
 
 def _get_session(use_cookies, return_cookies_file=False):
-    sess = requests.session()
+    sess = http_client.create_session()
 
     sess.headers.update(
         {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6)"}
@@ -146,6 +148,7 @@ def _download(
         verify=True,
         fuzzy=True,
         resume=False,
+        hasher: Optional[MultiHasher] = None
 ):
     url_origin = url
 
@@ -229,6 +232,9 @@ def _download(
     else:
         filename_from_url = osp.basename(url)
 
+    yield {'bytes_ready': 0, 'bytes_total': 0, 'speed_rate': 0, 'elapsed': 0,
+           'filename': filename_from_url if gdrive_file_id and is_gdrive_download_link else None}
+
     if output is None:
         output = filename_from_url
 
@@ -272,6 +278,12 @@ def _download(
     if tmp_file is not None and f.tell() != 0:
         headers = {"Range": "bytes={}-".format(f.tell())}
         res = sess.get(url, headers=headers, stream=True, verify=verify)
+        if res.status_code == 206:
+            # Digests can't be continued from the middle of the file, caller hashes the whole file instead.
+            hasher = None
+        else:
+            logger.info("Server ignored the range request, downloading from the start")
+            f.truncate(0)
 
     if stop_event.is_set():
         return
@@ -290,33 +302,30 @@ def _download(
         return
 
     total = res.headers.get("Content-Length")
+    progress = None
     try:
         yield {'bytes_ready': 0, 'bytes_total': total, 'speed_rate': 0, 'elapsed': 0}
 
         if total is not None:
             total = int(total)
 
-        pbar = tqdm.tqdm(total=total, unit="iB", unit_scale=True, desc=description)
+        progress = DownloadProgress(total, description)
 
         if stop_event.is_set():
             return
 
         for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
             f.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
 
             if stop_event.is_set():
                 return
 
-            pbar.update(len(chunk))
-            format_dict = pbar.format_dict
-            yield {
-                'bytes_ready': format_dict['n'],
-                'bytes_total': format_dict['total'],
-                'speed_rate': format_dict['rate'],
-                'elapsed': format_dict['elapsed']
-            }
+            progress.update(len(chunk))
+            if progress.is_due():
+                yield progress.report()
 
-        pbar.close()
 
         if tmp_file:
             f.close()
@@ -330,7 +339,11 @@ def _download(
             'elapsed': 0
         }
     finally:
-        sess.close()
+        # Session is not closed, its connection pools are shared with other requests. Response releases
+        # its connection back to the pool.
+        res.close()
+        if progress is not None:
+            progress.close()
 
     return output
 
@@ -340,37 +353,16 @@ class GDriveDownloader(Downloader):
         hostname = urlparse(url).hostname
         return hostname == 'drive.google.com' and '/file/' in url
 
-    def fetch_filename(self, url: str):
-        try:
-            gdrive_file_id, is_gdrive_download_link = _parse_url(url)
-
-            if gdrive_file_id is None:
-                return None
-
-            url = "https://drive.google.com/uc?id={id}".format(id=gdrive_file_id)
-            sess = _get_session(use_cookies=True, return_cookies_file=False)
-            res = sess.get(url, stream=True, verify=True)
-        except Exception as e:
-            logger.warning(e)
-            return None
-
-        if res.status_code == 200:
-            if 'Content-Disposition' in res.headers:
-                content_disp = res.headers['Content-Disposition']
-                filename_from_url = content_disp.split(';')[1].split('=')[1].strip('\"')
-                return filename_from_url.replace(os.path.sep, "_")
-
-            if res.headers["Content-Type"].startswith("text/html"):
-                soup = BeautifulSoup(res.text, 'html.parser')
-                filename = soup.find('span', {'class': 'uc-name-size'}).find('a').text
-                match = re.search(r'\b\w+\.\w+\b', filename)
-                if match:
-                    return match.group(0)
-        else:
-            return None
-
-    def download(self, url: str, destination_file: str, description: str, stop_event: threading.Event):
+    def download(self, url: str, destination_file: str, description: str, stop_event: threading.Event,
+                 hasher: Optional[MultiHasher] = None):
+        # Google Drive gives no validators, partial file is resumed by its size.
+        resume = PartialDownloads.instance().contains(destination_file, url)
+        PartialDownloads.instance().put(PartialDownload(destination_file, url))
         yield from _download(url=url,
                              output=destination_file,
                              description=description,
-                             stop_event=stop_event)
+                             stop_event=stop_event,
+                             resume=resume,
+                             hasher=hasher)
+        if not stop_event.is_set():
+            PartialDownloads.instance().remove(destination_file)
@@ -0,0 +1,113 @@
+import threading
+from urllib.parse import urlparse
+
+import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase
+from urllib3.util.retry import Retry
+
+from scripts.mo.environment import env
+
+_CIVITAI_HOST = 'civitai.com'
+
+# Concurrent downloads by several segments each should all fit the pool of a single host.
+_POOL_CONNECTIONS = 16
+_POOL_MAXSIZE = 32
+_CONNECT_TIMEOUT = 10
+_READ_TIMEOUT = 60
+
+# Only failed connects are retried by the adapter: they are cheap and nothing was sent yet. Error responses and broken
+# reads are retried by the download queue, which owns the backoff and honours Retry-After up to its own limit, and
+# the adapter would otherwise sleep for Retry-After uninterruptibly and multiply the queue attempts.
+_RETRY = Retry(
+    total=3,
+    connect=3,
+    read=0,
+    status=0,
+    other=0,
+    backoff_factor=0.5,
+    allowed_methods=frozenset(['GET', 'HEAD']),
+    respect_retry_after_header=False,
+    raise_on_status=False
+)
+
+_lock = threading.Lock()
+_adapter = None
+_session = None
+
+
+class _CivitaiAuth(AuthBase):
+    """
+    Adds API key to the Civitai requests only. Requests strips the header on redirect to another host,
+    so the key never reaches download mirrors.
+    """
+
+    def __call__(self, request):
+        api_key = env.api_key()
+        hostname = urlparse(request.url).hostname or ''
+        if api_key and (hostname == _CIVITAI_HOST or hostname.endswith('.' + _CIVITAI_HOST)):
+            request.headers['Authorization'] = 'Bearer ' + api_key
+        return request
+
+
+def _get_adapter() -> HTTPAdapter:
+    global _adapter
+    with _lock:
+        if _adapter is None:
+            _adapter = HTTPAdapter(pool_connections=_POOL_CONNECTIONS, pool_maxsize=_POOL_MAXSIZE, max_retries=_RETRY)
+        return _adapter
+
+
+def create_session() -> requests.Session:
+    """
+    Creates session which shares connection pools with every other session of the extension. Session should not
+    be closed, since closing drops pooled connections of the shared adapter.
+    :return: new session with separate cookies.
+    """
+    # Session created with global requests cache installed would cache downloaded files.
+    with requests_cache.disabled():
+        session = requests.Session()
+    adapter = _get_adapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.auth = _CivitaiAuth()
+    return session
+
+
+def get_session() -> requests.Session:
+    """
+    Returns session shared by all network requests of the extension, so TCP and TLS connections are reused.
+    :return: shared session.
+    """
+    global _session
+    if _session is None:
+        session = create_session()
+        with _lock:
+            if _session is None:
+                _session = session
+    return _session
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """
+    Sends GET request by the shared session. Connect and read timeouts are applied if not passed.
+    :param url: request url.
+    :param kwargs: requests.get arguments.
+    :return: response.
+    """
+    kwargs.setdefault('timeout', (_CONNECT_TIMEOUT, _READ_TIMEOUT))
+    return get_session().get(url, **kwargs)
+
+
+def head(url: str, **kwargs) -> requests.Response:
+    """
+    Sends HEAD request by the shared session. Redirects are followed and timeouts are applied if not passed.
+    :param url: request url.
+    :param kwargs: requests.head arguments.
+    :return: response.
+    """
+    kwargs.setdefault('timeout', (_CONNECT_TIMEOUT, _READ_TIMEOUT))
+    kwargs.setdefault('allow_redirects', True)
+    return get_session().head(url, **kwargs)
+
@@ -1,12 +1,184 @@
+import errno
+import os
+import re
 import threading
-from urllib.parse import urlparse
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Optional, Callable, List
+from urllib.parse import urlparse, unquote
 
 import requests
-import requests_cache
-from tqdm import tqdm
 
+from scripts.mo.data.partial_downloads import PartialDownload, PartialDownloads
+from scripts.mo.dl import http_client
+from scripts.mo.dl.download_progress import DownloadProgress
 from scripts.mo.dl.downloader import Downloader
-from scripts.mo.environment import env
+from scripts.mo.environment import logger
+from scripts.mo.hashing import MultiHasher
+
+_SEGMENTS_COUNT = 4
+_MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+_SEGMENT_RETRIES = 3
+# Large reads keep per chunk overhead of hashing, writing and progress negligible.
+_CHUNK_SIZE = 4 * 1024 * 1024
+_SEGMENT_TIMEOUT = 30
+_PROGRESS_INTERVAL = 0.1
+_SAVE_STATE_INTERVAL = 2
+# Parameter of Content-Disposition, value is a quoted string with escapes or a token up to the next ';'.
+_DISPOSITION_PARAM = re.compile(r';\s*([^\s;=]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+
+class _Segment:
+    def __init__(self, start: int, end: int, position: Optional[int] = None):
+        self.start = start
+        self.end = end
+        self.position = start if position is None else position
+
+    @property
+    def remaining(self) -> int:
+        return self.end + 1 - self.position
+
+    def to_list(self) -> List:
+        return [self.start, self.end, self.position]
+
+
+def _split_segments(total_size: int) -> List:
+    count = max(1, min(_SEGMENTS_COUNT, total_size // _MIN_SEGMENT_SIZE))
+    segment_size = -(-total_size // count)
+    return [_Segment(start, min(start + segment_size, total_size) - 1) for start in range(0, total_size, segment_size)]
+
+
+def _is_ranges_supported(response: requests.Response, total_size: int) -> bool:
+    return response.status_code == 200 and \
+        response.headers.get('Accept-Ranges', '').lower() == 'bytes' and \
+        response.headers.get('Content-Encoding', 'identity') == 'identity' and \
+        total_size > 0
+
+
+def _get_content_range_total(response: requests.Response) -> Optional[int]:
+    content_range = response.headers.get('Content-Range', '')
+    total = content_range.rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def _hash_file_prefix(file_path: str, size: int, hasher: MultiHasher):
+    with open(file_path, 'rb') as file:
+        while size > 0:
+            data = file.read(min(_CHUNK_SIZE, size))
+            if not data:
+                raise IOError(f'Partial file is shorter than expected: {file_path}')
+            hasher.update(data)
+            size -= len(data)
+
+
+def _parse_disposition_params(content_disposition: str) -> dict:
+    params = {}
+    for match in _DISPOSITION_PARAM.finditer(content_disposition):
+        value = match.group(2).strip()
+        if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        else:
+            value = value.strip('"')
+        params.setdefault(match.group(1).lower(), value)
+    return params
+
+
+def _get_filename(response: requests.Response) -> Optional[str]:
+    """
+    Returns file name from Content-Disposition header. Extended RFC 5987 filename* takes precedence over filename.
+    :param response: response to read the header from.
+    :return: file name or None if header is missing or has no usable name.
+    """
+    params = _parse_disposition_params(response.headers.get('Content-Disposition', ''))
+
+    filename = None
+    if 'filename*' in params:
+        charset, _, value = params['filename*'].partition("'")
+        _, _, value = value.partition("'")
+        try:
+            filename = unquote(value, encoding=charset or 'utf-8', errors='strict')
+        except (LookupError, UnicodeDecodeError):
+            filename = None
+    if not filename and 'filename' in params:
+        filename = params['filename']
+        # Header is decoded as latin-1, servers sending raw UTF-8 names (chinese ones too) need it re-decoded.
+        try:
+            filename = filename.encode('latin-1').decode('utf-8')
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+
+    filename = (filename or '').strip()
+    if filename in ['', '.', '..']:
+        return None
+    return filename
+
+
+def _preallocate(file, size: int):
+    # Disk space is reserved before the first byte, so full disk fails the download at start instead of midway.
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+            return
+        except OSError as ex:
+            if ex.errno == errno.ENOSPC:
+                raise
+    file.truncate(size)
+
+
+def _save_state(partial: PartialDownload, segments: List):
+    # Segments flush data before advancing positions, so fsync of the file after taking the positions covers
+    # every byte the saved state points to.
+    partial.segments = [segment.to_list() for segment in segments]
+    with open(partial.path, 'r+b') as file:
+        os.fsync(file.fileno())
+    PartialDownloads.instance().put(partial)
+
+
+def _download_segment(url: str, headers: dict, destination_file: str, segment: _Segment,
+                      stop_event: threading.Event, on_data: Callable[[bytes], None],
+                      response: Optional[requests.Response] = None):
+    """
+    Downloads bytes range of the file into the same range of the destination file. Failed request is retried
+    from the last written byte.
+    :param response: already opened response which starts from the segment position, used for the first attempt.
+    """
+    failures = 0
+    while segment.remaining > 0 and not stop_event.is_set():
+        position = segment.position
+        try:
+            if response is None:
+                range_headers = dict(headers, Range=f'bytes={segment.position}-{segment.end}')
+                response = http_client.get(url, stream=True, headers=range_headers, timeout=_SEGMENT_TIMEOUT)
+                if response.status_code != 206:
+                    response.close()
+                    response.raise_for_status()
+                    raise IOError(f'Range request failed with status code {response.status_code}')
+
+            with response, open(destination_file, 'r+b') as file:
+                file.seek(segment.position)
+                for data in response.iter_content(_CHUNK_SIZE):
+                    if stop_event.is_set():
+                        return
+                    data = data[:segment.remaining]
+                    file.write(data)
+                    # Position is saved as resume state, so data is handed to the OS before it is advanced.
+                    file.flush()
+                    segment.position += len(data)
+                    on_data(data)
+                    if segment.remaining == 0:
+                        break
+
+            if segment.remaining > 0:
+                raise ConnectionError('Connection closed before the end of the segment')
+
+        except (requests.RequestException, IOError) as ex:
+            failures = 1 if segment.position > position else failures + 1
+            if failures > _SEGMENT_RETRIES or ex.errno == errno.ENOSPC:
+                raise
+            logger.warning(f'Segment {segment.start}-{segment.end} failed at {segment.position}, retrying: {ex}')
+            stop_event.wait(failures)
+        finally:
+            response = None
 
 
 class HttpDownloader(Downloader):
@@ -15,74 +187,173 @@ class HttpDownloader(Downloader):
         parsed_url = urlparse(url)
         return parsed_url.scheme in ['http', 'https'] and parsed_url.hostname not in ['drive.google.com', 'mega.nz']
 
-    def fetch_filename(self, url):
+    def probe(self, url: str) -> Optional[dict]:
+        try:
+            with http_client.head(url) as response:
+                total_size = int(response.headers.get('content-length', 0)) if response.ok else 0
+                if total_size > 0:
+                    return {'size': total_size, 'ranges': _is_ranges_supported(response, total_size),
+                            'filename': _get_filename(response)}
 
-        api_key = env.api_key()
-        headers = {'Range': 'bytes=0-1'}
-        if api_key:
-            headers['Authorization'] = 'Bearer ' + api_key
-
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200 or response.status_code == 206:
-            if 'Content-Disposition' in response.headers:
-                content_disp = response.headers['Content-Disposition']
-                filename = content_disp.split(';')[1].split('=')[1].strip('\"')
-                return (filename.encode('utf-8').decode('GBK').encode('utf-8')
-                        .decode('utf-8'))  # Needed to properly encode/decode chinese symbols, have fun.
-        else:
+            # Pre-signed storage urls are often signed for GET only, single byte range returns the size instead.
+            with http_client.get(url, stream=True, headers={'Range': 'bytes=0-0'}) as response:
+                response.raise_for_status()
+                if response.status_code == 206:
+                    total_size = _get_content_range_total(response)
+                else:
+                    total_size = int(response.headers.get('content-length', 0)) or None
+                return {'size': total_size, 'ranges': response.status_code == 206,
+                        'filename': _get_filename(response)}
+        except requests.RequestException as ex:
+            logger.warning(f'Failed to probe {url}: {ex}')
             return None
 
-    def download(self, url: str, destination_file: str, description: str, stop_event: threading.Event):
+    def download(self, url: str, destination_file: str, description: str, stop_event: threading.Event,
+                 hasher: Optional[MultiHasher] = None):
         if stop_event.is_set():
             return
 
         yield {'bytes_ready': 'None', 'bytes_total': 'None', 'speed_rate': 'None', 'elapsed': 'None'}
 
-        api_key = env.api_key()
-        if api_key:
-            auth_header = {'Content-Type': 'application/json',
-                           'Authorization': 'Bearer ' + api_key}
-            with requests_cache.disabled():
-                response = requests.get(url, stream=True, headers=auth_header)
-        else:
-            with requests_cache.disabled():
-                response = requests.get(url, stream=True)
+        partial = PartialDownloads.instance().get(destination_file, url)
+        segments = [_Segment(*segment) for segment in partial.segments] if partial is not None else []
+        resume_segment = next((segment for segment in segments if segment.remaining > 0), None)
+
+        if resume_segment is not None:
+            response = http_client.get(url, stream=True,
+                                       headers={'Range': f'bytes={resume_segment.position}-{resume_segment.end}',
+                                                'If-Range': partial.get_validator()})
+            # Server error doesn't mean the file was changed, state and data are kept for the next attempt.
+            # 416 is returned if the file became shorter than the resume position.
+            if not response.ok and response.status_code != 416:
+                response.close()
+                response.raise_for_status()
+
+            if response.status_code == 206 and _get_content_range_total(response) == partial.total_size:
+                logger.info(f'Resuming download of {url} from {partial.bytes_ready} bytes')
+                yield {'bytes_ready': partial.bytes_ready, 'bytes_total': partial.total_size, 'speed_rate': 0,
+                       'elapsed': 0, 'filename': _get_filename(response)}
+                yield from self._download_segments(response, partial, segments, resume_segment, description,
+                                                   stop_event, hasher)
+                return
+
+            logger.info(f'{url} was changed since the download was interrupted, downloading it from the start')
+            response.close()
+
+        if partial is not None:
+            PartialDownloads.instance().remove(destination_file)
+
+        response = http_client.get(url, stream=True)
+        # Error page should never be saved as the model file, status code also tells whether to retry.
+        response.raise_for_status()
 
         total_size = int(response.headers.get('content-length', 0))
 
-        yield {'bytes_ready': 0, 'bytes_total': total_size, 'speed_rate': 0, 'elapsed': 0}
+        yield {'bytes_ready': 0, 'bytes_total': total_size, 'speed_rate': 0, 'elapsed': 0,
+               'filename': _get_filename(response)}
 
         if stop_event.is_set():
             return
 
-        progress_bar = tqdm(total=total_size, unit='iB', unit_scale=True, desc=description)
+        if _is_ranges_supported(response, total_size):
+            partial = PartialDownload(destination_file, url, total_size, response.headers.get('ETag'),
+                                      response.headers.get('Last-Modified'))
+            segments = _split_segments(total_size)
+            with open(destination_file, 'wb') as file:
+                _preallocate(file, total_size)
+            yield from self._download_segments(response, partial, segments, segments[0], description,
+                                               stop_event, hasher)
+            return
 
-        with open(destination_file, 'wb') as file:
+        progress = DownloadProgress(total_size, description)
+        try:
+            with response, open(destination_file, 'wb') as file:
+                if total_size > 0:
+                    _preallocate(file, total_size)
 
-            if stop_event.is_set():
-                progress_bar.close()
-                return
+                for data in response.iter_content(_CHUNK_SIZE):
+                    if stop_event.is_set():
+                        return
+
+                    file.write(data)
+                    if hasher is not None:
+                        hasher.update(data)
+                    progress.update(len(data))
+
+                    if progress.is_due():
+                        yield progress.report()
+
+                # Decoded content of the compressed response differs from its Content-Length.
+                file.truncate(progress.bytes_ready)
+        finally:
+            progress.close()
+
+        yield dict(progress.report(), bytes_total=progress.bytes_ready)
+
+    @staticmethod
+    def _download_segments(response: requests.Response, partial: PartialDownload, segments: List,
+                           response_segment: _Segment, description: str, stop_event: threading.Event,
+                           hasher: Optional[MultiHasher]):
+        """
+        Downloads file ranges by several connections in parallel, each of them writes its own range of the file.
+        Already opened response is used for its segment, the rest are requested from the redirected url.
+        State is saved periodically, so the download can be resumed if the server provided a validator.
+        Hasher is used only for a single segment, since otherwise data is written out of order.
+        """
+        destination_file = partial.path
+        validator = partial.get_validator()
+        headers = {}
+        if validator:
+            # Changed file is returned with status 200 instead of 206, so the segment fails instead of mixing data.
+            headers['If-Range'] = validator
+
+        if len(segments) == 1 and hasher is not None:
+            _hash_file_prefix(destination_file, segments[0].position, hasher)
+        else:
+            hasher = None
+
+        logger.debug(f'Downloading {response.url} by {sum(1 for s in segments if s.remaining > 0)} connections')
+
+        progress = DownloadProgress(partial.total_size, description, partial.bytes_ready)
+        segments_stop_event = threading.Event()
+
+        def on_data(data):
+            if hasher is not None:
+                hasher.update(data)
+            progress.update(len(data))
+
+        completed = False
+        try:
+            with ThreadPoolExecutor(max_workers=len(segments), thread_name_prefix='mo-segment') as executor:
+                pending = [executor.submit(_download_segment, response.url, headers, destination_file, segment,
+                                           segments_stop_event, on_data,
+                                           response if segment is response_segment else None)
+                           for segment in segments if segment.remaining > 0]
+                # Segments are stopped on cancel, on failure of any of them or when the caller closes the generator,
+                # executor waits for them on exit.
+                try:
+                    saved_at = time.monotonic()
+                    while pending:
+                        done, pending = wait(pending, timeout=_PROGRESS_INTERVAL)
+                        for future in done:
+                            future.result()
+
+                        if stop_event.is_set():
+                            return
+
+                        yield progress.report()
+
+                        if validator and time.monotonic() - saved_at >= _SAVE_STATE_INTERVAL:
+                            _save_state(partial, segments)
+                            saved_at = time.monotonic()
+                    completed = True
+                finally:
+                    segments_stop_event.set()
+        finally:
+            progress.close()
+            if completed:
+                PartialDownloads.instance().remove(destination_file)
+            elif validator:
+                _save_state(partial, segments)
 
-            for data in response.iter_content(1024):
-
-                if stop_event.is_set():
-                    progress_bar.close()
-                    return
-
-                file.write(data)
-                progress_bar.update(len(data))
-                format_dict = progress_bar.format_dict
-
-                yield {
-                    'bytes_ready': format_dict['n'],
-                    'bytes_total': format_dict['total'],
-                    'speed_rate': format_dict['rate'],
-                    'elapsed': format_dict['elapsed']
-                }
-        yield {
-            'bytes_ready': format_dict['n'],
-            'bytes_total': format_dict['n'],
-            'speed_rate': format_dict['rate'],
-            'elapsed': format_dict['elapsed']
-        }
-        progress_bar.close()
+        yield progress.report()
@@ -1,4 +1,3 @@
-import hashlib
 import logging
 import os.path
 from typing import Callable
@@ -65,6 +64,14 @@ class Environment:
     prefill_pos_prompt: Callable[[], bool]
     prefill_neg_prompt: Callable[[], bool]
     autobind_file: Callable[[], bool]
+    watch_model_dirs: Callable[[], bool]
+    hash_visible_records: Callable[[], bool]
+    hash_bandwidth_limit: Callable[[], int]
+    download_workers: Callable[[], int]
+    download_host_workers: Callable[[], int]
+    download_console_progress: Callable[[], bool]
+    link_existing_files: Callable[[], bool]
+    model_store_path: Callable[[], str]
     model_path: Callable[[], str]
     vae_path: Callable[[], str]
     lora_path: Callable[[], str]
@@ -127,14 +134,3 @@ class Environment:
 
 
 env = Environment()
-
-
-def calculate_md5(file_path):
-    with open(file_path, 'rb') as f:
-        md5 = hashlib.md5()
-        while True:
-            data = f.read(1024)
-            if not data:
-                break
-            md5.update(data)
-    return md5.hexdigest()
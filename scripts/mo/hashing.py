@@ -0,0 +1,161 @@
+import hashlib
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Callable
+
+HASH_MD5 = 'md5'
+HASH_SHA256 = 'sha256'
+HASH_CRC32 = 'crc32'
+HASH_ADLER32 = 'adler32'
+HASH_AUTOV2 = 'autov2'
+
+DEFAULT_ALGORITHMS = (HASH_MD5, HASH_SHA256)
+
+_BUFFER_SIZE = 8 * 1024 * 1024
+_AUTOV2_LENGTH = 10
+_FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+
+
+class _ZlibChecksum:
+    def __init__(self, function, initial):
+        self._function = function
+        self._value = initial
+
+    def update(self, data):
+        self._value = self._function(data, self._value)
+
+    def hexdigest(self) -> str:
+        return format(self._value & 0xFFFFFFFF, '08x')
+
+
+def _create_hash(algorithm: str):
+    if algorithm == HASH_MD5:
+        return hashlib.md5()
+    elif algorithm == HASH_SHA256:
+        return hashlib.sha256()
+    elif algorithm == HASH_CRC32:
+        return _ZlibChecksum(zlib.crc32, 0)
+    elif algorithm == HASH_ADLER32:
+        return _ZlibChecksum(zlib.adler32, 1)
+    raise ValueError(f'Unsupported hash algorithm: {algorithm}')
+
+
+def autov2_hash(sha256: str) -> str:
+    """
+    Returns Civitai AutoV2 short hash.
+    :param sha256: SHA256 hex digest string.
+    :return: AutoV2 hash string, first 10 characters of SHA256 hex digest.
+    """
+    return sha256[:_AUTOV2_LENGTH] if sha256 else ''
+
+
+class MultiHasher:
+    """
+    Computes several digests of the same data in a single pass.
+    """
+
+    def __init__(self, algorithms: Iterable = DEFAULT_ALGORITHMS):
+        self._hashes = {algorithm: _create_hash(algorithm) for algorithm in algorithms}
+        self.bytes_hashed = 0
+
+    @property
+    def algorithms(self) -> List:
+        return list(self._hashes.keys())
+
+    def update(self, data):
+        for hash_object in self._hashes.values():
+            hash_object.update(data)
+        self.bytes_hashed += len(data)
+
+    def submit_update(self, executor: ThreadPoolExecutor, data) -> List:
+        """
+        Updates every digest in its own executor thread. hashlib and zlib release GIL for large buffers,
+        so digests are computed in parallel.
+        :param executor: executor to run updates on.
+        :param data: bytes-like object, should not be modified until returned futures are done.
+        :return: list of futures.
+        """
+        self.bytes_hashed += len(data)
+        return [executor.submit(hash_object.update, data) for hash_object in self._hashes.values()]
+
+    def hexdigests(self) -> dict:
+        """
+        Returns hex digests of the data passed so far.
+        :return: dict of algorithm name to hex digest string, contains AutoV2 hash if SHA256 is computed.
+        """
+        result = {algorithm: hash_object.hexdigest() for algorithm, hash_object in self._hashes.items()}
+        if HASH_SHA256 in result:
+            result[HASH_AUTOV2] = autov2_hash(result[HASH_SHA256])
+        return result
+
+
+def hash_file(file_path, algorithms: Iterable = DEFAULT_ALGORITHMS, stop_event: Optional[threading.Event] = None,
+              on_progress: Optional[Callable[[int], None]] = None) -> Optional[dict]:
+    """
+    Calculates file digests in a single pass. File is read with readinto into two reusable buffers,
+    so next chunk is read while the previous one is hashed by the worker threads.
+    :param file_path: target file path.
+    :param algorithms: digests to calculate, any of HASH_MD5, HASH_SHA256, HASH_CRC32 and HASH_ADLER32.
+    :param stop_event: hashing is cancelled when event is set.
+    :param on_progress: called with the size of every chunk read, may block to throttle reading.
+    :return: dict of algorithm name to hex digest string, contains AutoV2 hash if SHA256 is computed.
+    None if hashing was cancelled.
+    """
+    hasher = MultiHasher(algorithms)
+    buffers = [bytearray(_BUFFER_SIZE), bytearray(_BUFFER_SIZE)]
+    index = 0
+    pending = []
+
+    with open(file_path, 'rb', buffering=0) as file, \
+            ThreadPoolExecutor(max_workers=len(hasher.algorithms) or 1, thread_name_prefix='mo-hash') as executor:
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                return None
+            read = file.readinto(buffers[index])
+            for future in pending:
+                future.result()
+            if not read:
+                break
+            pending = hasher.submit_update(executor, memoryview(buffers[index])[:read])
+            index ^= 1
+            if on_progress is not None:
+                on_progress(read)
+
+    return hasher.hexdigests()
+
+
+def calculate_sha256(file_path) -> str:
+    """
+    Calculates SHA256 file hash.
+    :param file_path: target file path.
+    :return: SHA256 hex digest string.
+    """
+    return hash_file(file_path, [HASH_SHA256])[HASH_SHA256]
+
+
+def calculate_md5(file_path) -> str:
+    """
+    Calculates MD5 file hash.
+    :param file_path: target file path.
+    :return: MD5 hex digest string.
+    """
+    return hash_file(file_path, [HASH_MD5])[HASH_MD5]
+
+
+def quick_fingerprint(file_path) -> str:
+    """
+    Calculates cheap file fingerprint from the file size and its first and last megabytes. Files with different
+    fingerprints are different, equal fingerprints should be confirmed with full hash when the match matters.
+    :param file_path: target file path.
+    :return: fingerprint hex string.
+    """
+    with open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        fingerprint = hashlib.sha256(size.to_bytes(8, 'little'))
+        fingerprint.update(file.read(_FINGERPRINT_BLOCK_SIZE))
+        if size > _FINGERPRINT_BLOCK_SIZE:
+            file.seek(max(_FINGERPRINT_BLOCK_SIZE, size - _FINGERPRINT_BLOCK_SIZE))
+            fingerprint.update(file.read(_FINGERPRINT_BLOCK_SIZE))
+    return fingerprint.hexdigest()
@@ -24,6 +24,7 @@ class ModelSort(Enum):
     TIME_ADDED_DESC = 'Time Added Reversed'
     NAME_ASC = 'Name'
     NAME_DESC = 'Name Reversed'
+    RELEVANCE = 'Relevance'
 
     @staticmethod
     def by_value(value: str):
@@ -4,10 +4,10 @@ import time
 from urllib.parse import urlparse, parse_qs
 
 import gradio as gr
-import requests
 
 from scripts.mo.data.mapping_utils import create_version_dict
 from scripts.mo.data.storage import map_record_to_dict
+from scripts.mo.dl import http_client
 from scripts.mo.environment import env
 from scripts.mo.models import ModelType, Record
 from scripts.mo.ui_styled_html import alert_danger, alert_warning
@@ -115,7 +115,7 @@ def _on_fetch_url_clicked(url):
     url = f"https://civitai.com/api/v1/models/{model_id}"
     headers = {"Content-Type": "application/json"}
 
-    response = requests.get(url, headers=headers)
+    response = http_client.get(url, headers=headers)
 
     try:
         if response.status_code == 200:
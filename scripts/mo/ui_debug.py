@@ -1,15 +1,21 @@
-import hashlib
 import json
 import os
 import time
-import zlib
 
 import gradio as gr
 
+from scripts.mo.data.duplicate_finder import DuplicateFinder
+from scripts.mo.data.file_index import FileIndex
+from scripts.mo.data.file_watcher import FileWatcher
+from scripts.mo.data.hash_cache import HashCache
+from scripts.mo.data.hash_service import HashService, PRIORITY_BACKGROUND
+from scripts.mo.data.location_reconciler import LocationReconciler
+from scripts.mo.data.model_store import ModelStore
+from scripts.mo.data.record_utils import get_local_model_dirs
 from scripts.mo.environment import env
+from scripts.mo.hashing import hash_file, HASH_SHA256, HASH_MD5, HASH_CRC32, HASH_ADLER32
 from scripts.mo.models import ModelType
-from scripts.mo.utils import get_model_files_in_dir, find_preview_file, link_preview, read_hash_cache, \
-    calculate_file_temp_hash, write_hash_cache, calculate_sha256
+from scripts.mo.utils import get_model_files_in_dir, find_preview_file, link_preview, scan_model_files
 
 
 def _ui_state_report():
@@ -63,200 +69,153 @@ def _ui_local_files():
                           outputs=local_files_json)
 
 
-def _on_read_hash_click():
-    cache = read_hash_cache()
-    return [
-        gr.JSON.update(value=json.dumps(cache)),
-        gr.Button.update(visible=False)
-    ]
+def _file_index_stats():
+    stats = FileIndex.instance().get_stats()
+    stats['watcher'] = FileWatcher.instance().get_state()
+    return gr.JSON.update(value=json.dumps(stats))
 
 
-def calculate_crc32(file_path):
-    # Initialize the CRC32 checksum
-    crc32 = 0
+def _on_file_index_stats_click():
+    return _file_index_stats()
 
-    try:
-        # Open the file in binary mode
-        with open(file_path, "rb") as file:
-            # Read the file in chunks to conserve memory
-            chunk_size = 1024  # You can adjust this according to your needs
-            while True:
-                data = file.read(chunk_size)
-                if not data:
-                    break
-                crc32 = zlib.crc32(data, crc32)
 
-    except FileNotFoundError:
-        print(f"File not found: {file_path}")
-        return None
+def _on_file_index_refresh_click():
+    FileIndex.instance().refresh(get_local_model_dirs())
+    return _file_index_stats()
 
-    # Ensure the CRC32 value is a positive integer
-    crc32 = crc32 & 0xFFFFFFFF
 
-    return hex(crc32)[2:]
+def _on_file_index_rebuild_click():
+    FileIndex.instance().rebuild(get_local_model_dirs())
+    return _file_index_stats()
 
 
-def calculate_md5(file_path):
-    # Create an instance of the MD5 hash object
-    md5_hash = hashlib.md5()
+def _on_reconcile_click():
+    LocationReconciler.instance().start()
+    return gr.JSON.update(value=json.dumps(LocationReconciler.instance().get_state()))
 
-    try:
-        # Open the file in binary mode
-        with open(file_path, "rb") as file:
-            # Read the file in chunks to conserve memory
-            chunk_size = 8192  # You can adjust this according to your needs
-            while True:
-                data = file.read(chunk_size)
-                if not data:
-                    break
-                md5_hash.update(data)
 
-    except FileNotFoundError:
-        print(f"File not found: {file_path}")
-        return None
+def _on_reconcile_state_click():
+    return gr.JSON.update(value=json.dumps(LocationReconciler.instance().get_state()))
 
-    # Get the MD5 hash value as a hexadecimal string
-    md5_hex = md5_hash.hexdigest()
 
-    return md5_hex
+def _ui_file_index():
+    with gr.Column():
+        stats_button = gr.Button('Show index stats')
+        refresh_button = gr.Button('Refresh index')
+        rebuild_button = gr.Button('Rebuild index')
+        reconcile_button = gr.Button('Find moved files of records')
+        reconcile_state_button = gr.Button('Show moved files search result')
 
+        file_index_json = gr.JSON(label='File index')
 
-def calculate_adler32(file_path):
-    # Initialize the Adler-32 checksum
-    adler32_checksum = zlib.adler32(b'', 0)
+    stats_button.click(fn=_on_file_index_stats_click, outputs=file_index_json)
+    refresh_button.click(fn=_on_file_index_refresh_click, outputs=file_index_json)
+    rebuild_button.click(fn=_on_file_index_rebuild_click, outputs=file_index_json)
+    reconcile_button.click(fn=_on_reconcile_click, outputs=file_index_json)
+    reconcile_state_button.click(fn=_on_reconcile_state_click, outputs=file_index_json)
 
-    try:
-        # Open the file in binary mode
-        with open(file_path, "rb") as file:
-            # Read the file in chunks to conserve memory
-            chunk_size = 1024  # You can adjust this according to your needs
-            while True:
-                data = file.read(chunk_size)
-                if not data:
-                    break
-                adler32_checksum = zlib.adler32(data, adler32_checksum)
 
-        # Ensure the Adler-32 value is a positive integer
-        adler32_checksum &= 0xFFFFFFFF
+def _on_read_hash_click():
+    return gr.JSON.update(value=json.dumps(HashCache.instance().get_entries()))
 
-        return hex(adler32_checksum)[2:]
 
-    except FileNotFoundError:
-        print(f"File not found: {file_path}")
-        return None
+def _on_calculate_hash_click():
+    for file in scan_model_files(get_local_model_dirs()):
+        HashService.instance().submit(file, PRIORITY_BACKGROUND)
+    return gr.JSON.update(value=json.dumps(HashService.instance().get_state()))
 
 
-def _on_calculate_hash_click():
-    result = []
+def _on_hashing_state_click():
+    return gr.JSON.update(value=json.dumps(HashService.instance().get_state()))
 
-    def calc_in_dir(model_type) -> list:
-        dir_path = env.get_model_path(model_type)
-        local = []
-        files = get_model_files_in_dir(dir_path)
-        for file in files:
-            start_ms = int(time.time() * 1000)
-            sha256 = calculate_sha256(file)
-            time_spent_sha256 = int(time.time() * 1000) - start_ms
 
-            start_ms = int(time.time() * 1000)
-            crc32 = calculate_crc32(file)
-            time_spent_crc32 = int(time.time() * 1000) - start_ms
+def _on_cancel_hashing_click():
+    HashService.instance().cancel_all()
+    return gr.JSON.update(value=json.dumps(HashService.instance().get_state()))
 
-            start_ms = int(time.time() * 1000)
-            md5 = calculate_md5(file)
-            time_spent_md5 = int(time.time() * 1000) - start_ms
 
-            start_ms = int(time.time() * 1000)
-            adler32 = calculate_adler32(file)
-            time_spent_adler32 = int(time.time() * 1000) - start_ms
+def _on_compare_hash_click():
+    result = []
+    for file in scan_model_files(get_local_model_dirs()):
+        result.append({
+            'path': file,
+            'sha256': HashCache.instance().get_cached(file).get(HASH_SHA256)
+        })
+    return gr.JSON.update(value=json.dumps(result))
 
-            rec = {
-                'path': file,
-                'file_size': os.path.getsize(file),
-                'temp_hash': calculate_file_temp_hash(file),
-                'sha256': sha256,
-                'sha256_time_ms': time_spent_sha256,
-                'crc32': crc32,
-                'crc32_time_ms': time_spent_crc32,
-                'md5': md5,
-                'md5_time_ms': time_spent_md5,
-                'adler32': adler32,
-                'adler32_time_ms': time_spent_adler32
-            }
-            local.append(rec)
-        return local
 
-    result.extend(calc_in_dir(ModelType.CHECKPOINT))
-    result.extend(calc_in_dir(ModelType.VAE))
-    result.extend(calc_in_dir(ModelType.LORA))
-    result.extend(calc_in_dir(ModelType.HYPER_NETWORK))
-    result.extend(calc_in_dir(ModelType.EMBEDDING))
-    result.extend(calc_in_dir(ModelType.LYCORIS))
+def _on_calculate_checksums_click():
+    result = []
+    for file in scan_model_files(get_local_model_dirs()):
+        start_ms = int(time.time() * 1000)
+        hashes = hash_file(file, [HASH_SHA256, HASH_MD5, HASH_CRC32, HASH_ADLER32])
+        time_spent = int(time.time() * 1000) - start_ms
+
+        rec = {
+            'path': file,
+            'file_size': os.path.getsize(file),
+            'hash_time_ms': time_spent
+        }
+        rec.update(hashes)
+        result.append(rec)
 
-    return [
-        gr.JSON.update(value=json.dumps(result)),
-        gr.Button.update(visible=True)
-    ]
+    return gr.JSON.update(value=json.dumps(result))
 
 
-def _on_compare_hash_click():
-    result = []
+def _ui_hash_cache():
+    with gr.Column():
+        read_button = gr.Button('Read hash cache')
+        compare_hash_button = gr.Button('Compare hash with cache')
+        calculate_button = gr.Button('Calculate hashes in background')
+        hashing_state_button = gr.Button('Background hashing state')
+        cancel_hashing_button = gr.Button('Cancel background hashing')
+        checksums_button = gr.Button('Calculate all checksums without cache')
 
-    cache = read_hash_cache()
+        hash_cache_json = gr.JSON(label='Local files')
 
-    def find_in_cache(file_path, temp_hash):
-        for entry in cache:
-            if entry.get('path') == file_path and entry.get('temp_hash') == temp_hash and \
-                    entry.get('sha256') is not None:
-                return entry['sha256']
+    read_button.click(fn=_on_read_hash_click, outputs=hash_cache_json)
+    calculate_button.click(fn=_on_calculate_hash_click, outputs=hash_cache_json)
+    hashing_state_button.click(fn=_on_hashing_state_click, outputs=hash_cache_json)
+    cancel_hashing_button.click(fn=_on_cancel_hashing_click, outputs=hash_cache_json)
+    compare_hash_button.click(fn=_on_compare_hash_click, outputs=hash_cache_json)
+    checksums_button.click(fn=_on_calculate_checksums_click, outputs=hash_cache_json)
 
-    def search_in_dir(model_type) -> list:
-        dir_path = env.get_model_path(model_type)
-        local = []
-        files = get_model_files_in_dir(dir_path)
-        for file in files:
-            temp_hash = calculate_file_temp_hash(file)
 
-            rec = {
-                'path': file,
-                'temp_hash': temp_hash,
-                'sha256': find_in_cache(file, temp_hash)
-            }
+def _on_find_duplicates_click():
+    DuplicateFinder.instance().start()
+    return gr.JSON.update(value=json.dumps(DuplicateFinder.instance().get_state()))
 
-            local.append(rec)
-        return local
 
-    result.extend(search_in_dir(ModelType.CHECKPOINT))
-    result.extend(search_in_dir(ModelType.VAE))
-    result.extend(search_in_dir(ModelType.LORA))
-    result.extend(search_in_dir(ModelType.HYPER_NETWORK))
-    result.extend(search_in_dir(ModelType.EMBEDDING))
-    result.extend(search_in_dir(ModelType.LYCORIS))
+def _on_duplicates_state_click():
+    return gr.JSON.update(value=json.dumps(DuplicateFinder.instance().get_state()))
 
-    return [
-        gr.JSON.update(value=json.dumps(result)),
-        gr.Button.update(visible=False)
-    ]
 
+def _on_cancel_duplicates_click():
+    DuplicateFinder.instance().stop()
+    return gr.JSON.update(value=json.dumps(DuplicateFinder.instance().get_state()))
 
-def _on_hash_cache_save_click(json_data):
-    write_hash_cache(json_data)
 
+def _on_link_duplicates_click():
+    try:
+        result = DuplicateFinder.instance().link_duplicates()
+    except RuntimeError as ex:
+        result = {'error': str(ex)}
+    return gr.JSON.update(value=json.dumps(result))
 
-def _ui_hash_cache():
-    with gr.Column():
-        read_button = gr.Button('Read hash cache')
-        compare_hash_button = gr.Button('Compare hash with cache')
-        calculate_button = gr.Button('Calculate hashes')
-        save_hash_button = gr.Button('Save hash', visible=False)
 
-        hash_cache_json = gr.JSON(label='Local files')
+def _ui_duplicates():
+    with gr.Column():
+        find_button = gr.Button('Find duplicate model files')
+        state_button = gr.Button('Show duplicates search result')
+        cancel_button = gr.Button('Cancel duplicates search')
+        link_button = gr.Button('Replace found duplicates with hardlinks')
 
-    read_button.click(fn=_on_read_hash_click, outputs=[hash_cache_json, save_hash_button])
-    calculate_button.click(fn=_on_calculate_hash_click, outputs=[hash_cache_json, save_hash_button])
-    compare_hash_button.click(fn=_on_compare_hash_click, outputs=[hash_cache_json, save_hash_button])
+        duplicates_json = gr.JSON(label='Duplicates')
 
-    save_hash_button.click(fn=_on_hash_cache_save_click, inputs=hash_cache_json)
+    find_button.click(fn=_on_find_duplicates_click, outputs=duplicates_json)
+    state_button.click(fn=_on_duplicates_state_click, outputs=duplicates_json)
+    cancel_button.click(fn=_on_cancel_duplicates_click, outputs=duplicates_json)
+    link_button.click(fn=_on_link_duplicates_click, outputs=duplicates_json)
 
 
 def _on_remove_duplicates_click():
@@ -297,6 +256,11 @@ def _on_add_tag_to_all_records_click(tag):
     return f'{records_updated_count} records has been updated.'
 
 
+def _on_remove_unlinked_store_files_click():
+    result = ModelStore.instance().remove_unlinked()
+    return f'{result["removed"]} unlinked store files has been removed, {result["freed"]} bytes freed.'
+
+
 def _ui_debug_utils():
     with gr.Row():
         with gr.Column():
@@ -307,6 +271,7 @@ def _ui_debug_utils():
                                                   max_lines=1,
                                                   info='This tag will be added to all records.')
             add_tag_to_all_records_button = gr.Button("Add tag to all records")
+            remove_unlinked_store_files_button = gr.Button("Remove unlinked model store files")
         with gr.Column():
             debug_html_output = gr.HTML()
 
@@ -314,6 +279,7 @@ def _ui_debug_utils():
     remove_all_records.click(fn=_on_remove_all_records_click, outputs=[debug_html_output])
     add_tag_to_all_records_button.click(fn=_on_add_tag_to_all_records_click,
                                         inputs=[add_all_records_tag_text], outputs=[debug_html_output])
+    remove_unlinked_store_files_button.click(fn=_on_remove_unlinked_store_files_click, outputs=[debug_html_output])
 
 
 def debug_ui_block():
@@ -331,9 +297,15 @@ def debug_ui_block():
         with gr.Tab('Local files'):
             _ui_local_files()
 
+        with gr.Tab('File index'):
+            _ui_file_index()
+
         with gr.Tab('Hash cache'):
             _ui_hash_cache()
 
+        with gr.Tab('Duplicate files'):
+            _ui_duplicates()
+
         with gr.Tab('Utils'):
             _ui_debug_utils()
 
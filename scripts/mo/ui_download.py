@@ -1,11 +1,11 @@
 import json
-import time
 
 import gradio as gr
 
 import scripts.mo.ui_format as ui_format
 import scripts.mo.ui_navigation as nav
 import scripts.mo.ui_styled_html as styled
+from scripts.mo.data.download_queue import PRIORITY_HIGH, PRIORITY_NORMAL
 from scripts.mo.dl.download_manager import *
 from scripts.mo.environment import env, logger
 from scripts.mo.data.record_utils import load_records_and_filter
@@ -80,6 +80,10 @@ def _generate_js_record_update(record_id, update):
             if update.get('destination') is not None:
                 result_text += update['destination']
 
+            if update.get('source'):
+                result_text += '<br>' if len(result_text) > 0 else ''
+                result_text += f'Created from local file {update["source"]}'
+
             if update.get('preview_destination'):
                 result_text += '<br>' if len(result_text) > 0 else ''
                 result_text += update['preview_destination']
@@ -95,6 +99,14 @@ def _generate_js_record_update(record_id, update):
         elif status == RECORD_STATUS_CANCELLED:
             result['result_title'] = 'Download cancelled'
 
+        elif status == RECORD_STATUS_WAITING and update.get('deferred'):
+            result['result_title'] = 'Waiting for another download of the same file.'
+
+        elif status == RECORD_STATUS_WAITING:
+            result['result_title'] = f'Download failed, retry in {ui_format.format_time(update["retry_delay"])}'
+            if update.get('exception') is not None:
+                result['result_text'] = ui_format.format_exception(update['exception'])
+
     if update.get('filename') is not None:
         result['progress_info_left'] = update['filename']
 
@@ -113,6 +125,23 @@ def _generate_js_record_update(record_id, update):
     return result
 
 
+def generate_progress_event(update: dict) -> dict:
+    """
+    Converts download state changes into the event for the download page.
+    :param update: state returned by DownloadManager.get_changes.
+    :return: dict with 'seq', 'general_status' if it changed, 'status_message' html with the pre-flight result and
+    'records' with updates of the download cards.
+    """
+    event = {'seq': update['seq']}
+    if update.get('general_status') is not None:
+        event['general_status'] = update['general_status']
+    if update.get('preflight') is not None and update.get('general_status') == GENERAL_STATUS_IN_PROGRESS:
+        event['status_message'] = _generate_preflight_message(update['preflight'])
+    if update.get('records') is not None:
+        event['records'] = [_generate_js_record_update(record_id, upd) for record_id, upd in update['records'].items()]
+    return event
+
+
 def _generate_general_update(update):
     status_message = None
 
@@ -165,29 +194,37 @@ def _generate_general_update(update):
     )
 
 
+def _generate_preflight_message(preflight) -> str:
+    message = ['Download in progress.']
+    if preflight['total_size'] > 0:
+        message.append(f'Total size: {ui_format.format_bytes(preflight["total_size"])}')
+    for filesystem in preflight['filesystems']:
+        message.append(f'Free space at {filesystem["path"]}: {ui_format.format_bytes(filesystem["free"])}')
+    if preflight['refused']:
+        message.append(f'Not enough free space for {len(preflight["refused"])} of the models, '
+                       f'{ui_format.format_bytes(sum(fs["refused"] for fs in preflight["filesystems"]))} skipped.')
+    alert = styled.alert_warning if preflight['refused'] else styled.alert_primary
+    return alert(message)
+
+
 def _on_start_click(records):
-    yield _build_widget_update(
+    # Single record is downloaded before the records queued by group downloads.
+    DownloadManager.instance().start_download(records, PRIORITY_HIGH if len(records) == 1 else PRIORITY_NORMAL)
+
+    # Progress is pushed to the page by the events endpoint, so the gradio worker isn't held by the download.
+    # Sequence number changes on every start, so the page subscribes again.
+    return _build_widget_update(
+        progress_update=json.dumps({'subscribe': DownloadManager.instance().get_state()['seq']}),
         status_message=styled.alert_primary('Download in progress.'),
         is_start_button_visible=False,
         is_cancel_button_visible=True,
         is_back_button_visible=False,
     )
 
-    DownloadManager.instance().start_download(records)
-
-    counter = 0
-    while DownloadManager.instance().is_running():
-        if counter % 20 == 0:
-            download_state = DownloadManager.instance().get_state()
-        else:
-            download_state = DownloadManager.instance().get_latest_state()
-        yield _generate_general_update(download_state)
-        time.sleep(0.2)
 
-    general_state = DownloadManager.instance().get_state()
-
-    yield _generate_general_update(general_state)
+def _on_download_finished():
     logger.debug('Completed.')
+    return _generate_general_update(DownloadManager.instance().get_state())
 
 
 def _on_id_change(data):
@@ -244,8 +281,13 @@ def download_ui_block():
                                            elem_classes='mo-alert-warning',
                                            visible=False,
                                            interactive=False)
+        download_finished_box = gr.Textbox(label='download_finished_box',
+                                           elem_classes='mo-alert-warning',
+                                           elem_id='mo-download-finished-box',
+                                           visible=False,
+                                           interactive=False)
         gr.Markdown('## Downloads')
-        status_message_widget = gr.HTML(visible=False)
+        status_message_widget = gr.HTML(visible=False, elem_id='mo-download-status-message')
         with gr.Row():
             gr.Markdown()
             back_button = gr.Button('Back', visible=True)
@@ -259,6 +301,9 @@ def download_ui_block():
                            outputs=[html_widget, download_state, start_button, cancel_button, back_button,
                                     status_message_widget])
     download_progress_box.change(fn=None, inputs=download_progress_box, _js='handleProgressUpdates')
+    download_finished_box.change(_on_download_finished,
+                                 outputs=[status_message_widget, start_button, cancel_button, back_button,
+                                          download_progress_box])
 
     start_button.click(_on_start_click, inputs=download_state,
                        outputs=[status_message_widget, start_button, cancel_button, back_button, download_progress_box])
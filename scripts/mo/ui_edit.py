@@ -6,12 +6,18 @@ import time
 import gradio as gr
 
 import scripts.mo.ui_styled_html as styled
+from scripts.mo.data.file_index import FileIndex
+from scripts.mo.data.file_watcher import FileWatcher
+from scripts.mo.data.hash_cache import HashCache
+from scripts.mo.data.hash_service import HashService, PRIORITY_USER
+from scripts.mo.data.location_reconciler import LocationReconciler
 from scripts.mo.data.storage import map_dict_to_record
-from scripts.mo.dl.download_manager import DownloadManager, calculate_sha256
+from scripts.mo.dl.download_manager import DownloadManager
 from scripts.mo.environment import env, logger
+from scripts.mo.hashing import HASH_SHA256
 from scripts.mo.models import Record, ModelType
 from scripts.mo.ui_navigation import generate_ui_token
-from scripts.mo.utils import is_blank, is_valid_filename, is_valid_url, get_model_files_in_dir, find_preview_file
+from scripts.mo.utils import is_blank, is_valid_filename, is_valid_url, find_preview_file
 
 
 def is_directory_path_valid(path):
@@ -109,15 +115,19 @@ def _on_description_output_changed(record_data, name: str, model_type_value: str
         else:
             created_at = time.time()
 
+        # Unknown files are hashed in background, hashes are filled into the record when ready.
+        is_hash_required = False
         if old_record is not None:
             if old_record.location == location:
                 sha256_hash = old_record.sha256_hash
             elif os.path.isfile(location):
-                sha256_hash = calculate_sha256(location)
+                sha256_hash = HashCache.instance().get_cached(location).get(HASH_SHA256, '')
+                is_hash_required = not sha256_hash
         elif sha256_state is not None:
             sha256_hash = sha256_state
         elif os.path.isfile(location):
-            sha256_hash = calculate_sha256(location)
+            sha256_hash = HashCache.instance().get_cached(location).get(HASH_SHA256, '')
+            is_hash_required = not sha256_hash
 
         record = Record(
             id_=record_id,
@@ -145,7 +155,13 @@ def _on_description_output_changed(record_data, name: str, model_type_value: str
         if record_id is not None and record_id:
             env.storage.update_record(record)
         else:
-            env.storage.add_record(record)
+            record_id = env.storage.add_record(record)
+            record.id_ = record_id
+
+        LocationReconciler.instance().update_fingerprint(record)
+
+        if is_hash_required:
+            HashService.instance().submit(location, PRIORITY_USER, record_id)
 
         return [
             gr.HTML.update(visible=False),
@@ -237,9 +253,12 @@ def _get_bind_location_dropdown_update(model_type_value, current_location: str):
             choices=['None']
         )
 
-    lookup_dir = os.path.join(env.get_model_path(model_type), '')
+    model_dir = os.path.normpath(env.get_model_path(model_type))
+    lookup_dir = os.path.join(model_dir, '')
 
-    files_found = get_model_files_in_dir(lookup_dir)
+    is_refresh_required = not FileWatcher.instance().is_watching([model_dir])
+    indexed_files = FileIndex.instance().get_model_files([model_dir], refresh=is_refresh_required)
+    files_found = [indexed_file.path for indexed_file in indexed_files]
     # files_exclude = env.storage.get_all_records_locations()
     # files_unbounded = [x for x in files_found if x not in files_exclude]
 
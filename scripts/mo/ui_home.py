@@ -3,6 +3,7 @@ import json
 import gradio as gr
 
 import scripts.mo.ui_styled_html as styled
+from scripts.mo.data.hash_service import HashService, PRIORITY_VISIBLE
 from scripts.mo.data.record_utils import load_records_and_filter
 from scripts.mo.environment import env, LAYOUT_CARDS
 from scripts.mo.models import ModelType, ModelSort
@@ -12,6 +13,9 @@ def _prepare_data(state_json: str):
     state = json.loads(state_json)
 
     records = load_records_and_filter(state, True)
+    # Every filtered record is rendered, so hashing them could read the whole library.
+    if env.hash_visible_records():
+        HashService.instance().submit_records(records, PRIORITY_VISIBLE)
 
     if env.layout() == LAYOUT_CARDS:
         html = styled.records_cards(records)
@@ -149,7 +153,7 @@ def home_ui_block():
                 downloaded_first_checkbox = gr.Checkbox(value=sort_downloaded_first, label='Downloaded first')
 
             with gr.Group():
-                search_box = gr.Textbox(label='Search by name',
+                search_box = gr.Textbox(label='Search',
                                         value=initial_state['query'], elem_id='model_organizer_searchbox')
                 model_types_dropdown = gr.Dropdown([model_type.value for model_type in ModelType],
                                                    value=initial_state['model_types'],
@@ -3,7 +3,10 @@ import os
 import gradio as gr
 
 import scripts.mo.ui_styled_html as styled
+from scripts.mo.data.hash_cache import HashCache
+from scripts.mo.data.model_store import ModelStore
 from scripts.mo.environment import env, logger
+from scripts.mo.hashing import HASH_SHA256
 from scripts.mo.ui_navigation import generate_ui_token
 from scripts.mo.utils import find_preview_file, find_info_file
 
@@ -61,10 +64,17 @@ def _on_remove_record_button_click(record_id):
     logger.info('removed record: %s', record_id)
     return generate_ui_token()
 
+def _remove_model_file(file_path, sha256=None):
+    # Stored copy of the file is freed once the last model file linking it is removed.
+    sha256 = HashCache.instance().get_cached(file_path).get(HASH_SHA256) or sha256
+    os.remove(file_path)
+    HashCache.instance().remove(file_path)
+    ModelStore.instance().release(sha256)
+
 def _on_remove_files_button_click(record_id):
     if os.path.isfile(record_id):
         logger.info('removed local model file: %s', record_id)
-        os.remove(record_id)
+        _remove_model_file(record_id)
 
         preview_path = find_preview_file(record_id)
         if preview_path and os.path.exists(preview_path):
@@ -74,7 +84,7 @@ def _on_remove_files_button_click(record_id):
         record = env.storage.get_record_by_id(record_id)
         if record.location and os.path.exists(record.location):
             logger.info('removed model file: %s', record.location)
-            os.remove(record.location)
+            _remove_model_file(record.location, record.sha256_hash)
 
         preview_path = find_preview_file(record.location)
         if preview_path and os.path.exists(preview_path):
@@ -409,7 +409,15 @@ def records_cards(records: List) -> str:
 def _downloads_header(record_id, title) -> str:
     content = '<div class="mo-downloads-header">'
     content += f'<h2 style="margin: 0;" id="title-{record_id}">{html.escape(title)}</h2>'
+    content += '<div class="mo-downloads-controls">'
     content += f'<p style="margin: 0; white-space: nowrap;" id="status-{record_id}">Pending</p>'
+    content += f'<button type="button" class="mo-btn mo-btn-primary" title="Move up" ' \
+               f'onclick="moveDownload(\'{record_id}\', -1)">&#9650;</button>'
+    content += f'<button type="button" class="mo-btn mo-btn-primary" title="Move down" ' \
+               f'onclick="moveDownload(\'{record_id}\', 1)">&#9660;</button>'
+    content += f'<button type="button" class="mo-btn mo-btn-warning" id="pause-{record_id}" ' \
+               f'onclick="toggleDownloadPause(\'{record_id}\')">Pause</button>'
+    content += '</div>'
     content += '</div>'
     return content
 
@@ -1,10 +1,9 @@
-import datetime
-import hashlib
 import json
 import os
 import re
 import urllib.parse
 import sys
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append('extensions-builtin/Lora')
 import networks
 
@@ -13,15 +12,14 @@ from typing import List
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 
+from scripts.mo.data.dir_listing import get_dir_listing
 from scripts.mo.environment import env
 from scripts.mo.models import Record, ModelType
 from modules import sd_hijack
 
-_HASH_CACHE_FILENAME = 'hash_cache.json'
-
 MODEL_EXTENSIONS = ['.bin', '.ckpt', '.safetensors', '.pt']
-PREVIEW_EXTENSIONS = [".png", ".jpg", ".webp"]
-INFO_EXTENSIONS = [".info", ".civitai.info"]
+_MODEL_EXTENSIONS_TUPLE = tuple(MODEL_EXTENSIONS)
+_MAX_SCAN_WORKERS = 8
 
 
 def is_blank(s: str) -> bool:
@@ -53,26 +51,79 @@ def is_valid_filename(filename: str) -> bool:
     return bool(pattern.match(filename))
 
 
+def is_model_filename(filename: str) -> bool:
+    """
+    Checks filename has one of the model files extensions.
+    :param filename: filename to check.
+    :return: True if filename is a model filename.
+    """
+    return filename.lower().endswith(_MODEL_EXTENSIONS_TUPLE)
+
+
+def is_subpath(path: str, parent: str) -> bool:
+    """
+    Checks path is equal to parent or placed inside the parent directory.
+    :param path: path to check.
+    :param parent: parent directory path.
+    :return: True if path is placed inside the parent directory.
+    """
+    path = os.path.normcase(os.path.abspath(path))
+    parent = os.path.normcase(os.path.abspath(parent))
+    return path == parent or path.startswith(os.path.join(parent, ''))
+
+
+def get_unique_model_dirs(dirs: List) -> List:
+    """
+    Removes duplicates and directories nested in other directories of the list,
+    so every directory tree is scanned only once.
+    :param dirs: list of directories paths.
+    :return: list of directories paths without nested directories, order is preserved.
+    """
+    result = []
+    for dir_path in dirs:
+        if not dir_path or any(is_subpath(dir_path, other) for other in result):
+            continue
+        result = [other for other in result if not is_subpath(other, dir_path)]
+        result.append(dir_path)
+    return result
+
+
 def get_model_files_in_dir(lookup_dir: str) -> List:
     """
     Scans for model files in the lookup_dir, and it's child directories.
     :param lookup_dir: directory path to scan.
     :return: List of models in the directory and subdirectories.
     """
-    root_dir = os.path.join(lookup_dir, '')
-    extensions = ('.bin', '.ckpt', '.safetensors', '.pt')
     result = []
-
-    if os.path.isdir(root_dir):
-        for subdir, dirs, files in os.walk(root_dir):
-            for file in files:
-                ext = os.path.splitext(file)[-1].lower()
-                if ext in extensions:
-                    filepath = os.path.join(subdir, file)
-                    result.append(filepath)
+    stack = [os.path.join(lookup_dir, '')]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif is_model_filename(entry.name) and entry.is_file():
+                        result.append(entry.path)
+        except OSError:
+            continue
     return result
 
 
+def scan_model_files(dirs: List) -> List:
+    """
+    Scans for model files in the directories and their child directories. Nested directories are skipped,
+    separate directories trees are scanned in parallel.
+    :param dirs: list of directories paths to scan.
+    :return: List of models in the directories and subdirectories.
+    """
+    dirs = get_unique_model_dirs(dirs)
+    if not dirs:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(len(dirs), _MAX_SCAN_WORKERS)) as executor:
+        return [path for files in executor.map(get_model_files_in_dir, dirs) for path in files]
+
+
 def get_model_filename_without_extension(model_file):
     """
     Extracts filename without extension for models.
@@ -93,14 +144,8 @@ def find_preview_file(model_file_path):
     :return: path to model image preview if it exists, None otherwise.
     """
     if model_file_path:
-        filename_no_ext = get_model_filename_without_extension(model_file_path)
-        path = os.path.join(os.path.dirname(model_file_path), filename_no_ext)
-
-        potential_files = sum([[path + ext, path + ".preview" + ext] for ext in PREVIEW_EXTENSIONS], [])
-
-        for file in potential_files:
-            if os.path.isfile(file):
-                return file
+        listing = get_dir_listing(os.path.dirname(model_file_path))
+        return listing.find_preview(get_model_filename_without_extension(model_file_path))
 
     return None
 
@@ -112,14 +157,8 @@ def find_info_file(model_file_path):
     :return: path to model info file if exists, None otherwise.
     """
     if model_file_path:
-        filename_no_ext = get_model_filename_without_extension(model_file_path)
-        path = os.path.join(os.path.dirname(model_file_path), filename_no_ext)
-
-        potential_files = sum([[path + ext] for ext in INFO_EXTENSIONS], [])
-
-        for file in potential_files:
-            if os.path.isfile(file):
-                return file
+        listing = get_dir_listing(os.path.dirname(model_file_path))
+        return listing.find_info(get_model_filename_without_extension(model_file_path))
 
     return None
 
@@ -187,71 +226,6 @@ def resize_preview_image(input_file, output_file):
             image.save(output_file, image_format)
 
 
-def calculate_file_temp_hash(file_path):
-    """
-    Calculates file "temp" hash. This has is based on file creation and modification timestamps and file size.
-    This is using to determinate file was changed or not.
-    :param file_path: path to target file.
-    :return: md5 hex digest string.
-    """
-    creation_timestamp = os.path.getctime(file_path)
-    creation_datetime = datetime.datetime.fromtimestamp(creation_timestamp)
-
-    modification_timestamp = os.path.getmtime(file_path)
-    modification_datetime = datetime.datetime.fromtimestamp(modification_timestamp)
-
-    size = os.path.getsize(file_path)
-
-    input_string = f'{creation_datetime} {modification_datetime} {size}'
-
-    md5_hash = hashlib.md5()
-    md5_hash.update(input_string.encode('utf-8'))
-    return md5_hash.hexdigest()
-
-
-def calculate_sha256(file_path):
-    """
-    Calculates SHA256 file hash.
-    :param file_path: target file path.
-    :return: SHA256 hex digest string.
-    """
-    with open(file_path, 'rb') as file:
-        sha256_hash = hashlib.sha256()
-        while chunk := file.read(4096):
-            sha256_hash.update(chunk)
-    return sha256_hash.hexdigest()
-
-
-def get_hash_cache_file():
-    """
-    Returns hash cache file path.
-    :return: string file path.
-    """
-    return os.path.join(env.script_dir, _HASH_CACHE_FILENAME)
-
-
-def read_hash_cache() -> List:
-    """
-    Reads hash cache file data.
-    :return: hash cache data as a list of dictionaries.
-    """
-    file_path = get_hash_cache_file()
-    if os.path.isfile(file_path):
-        with open(file_path) as file:
-            return json.load(file)
-    return []
-
-
-def write_hash_cache(hash_cache: List):
-    """
-    Writes hash cache data to file.
-    :param hash_cache: list of dictionaries to save.
-    :return: None.
-    """
-    with open(get_hash_cache_file(), 'w') as file:
-        json.dump(hash_cache, file, indent=4)
-
-
 def get_best_preview_url(record: Record) -> str:
     """
     Returns url to local preview file if it available otherwise returns record.preview_url
@@ -259,10 +233,12 @@ def get_best_preview_url(record: Record) -> str:
     :return: url to image preview.
     """
     if record.location:
-        preview_path = find_preview_file(record.location)
+        listing = get_dir_listing(os.path.dirname(record.location))
+        preview_path = listing.find_preview(get_model_filename_without_extension(record.location))
         if preview_path is None:
             return record.preview_url
         else:
+            # Preview replaced in place keeps the directory mtime, so its own mtime is read every time.
             return link_preview(preview_path)
     return record.preview_url
 
@@ -273,12 +249,8 @@ def find_info_json_file(model_file_path):
     :return: path to model info file if exists, None otherwise.
     """
     if model_file_path:
-        filename_no_ext = get_model_filename_without_extension(model_file_path)
-        path = os.path.join(os.path.dirname(model_file_path), filename_no_ext)
-
-        file = path + ".json"
-        if os.path.isfile(file):
-            return file
+        listing = get_dir_listing(os.path.dirname(model_file_path))
+        return listing.find_json(get_model_filename_without_extension(model_file_path))
 
     return None
 
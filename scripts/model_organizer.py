@@ -9,7 +9,10 @@ from modules import shared, sd_models, sd_vae, paths, ui_extra_networks
 from modules.shared import OptionInfo
 
 from scripts.mo.api import init_extension_api
+from scripts.mo.data.file_watcher import FileWatcher
 from scripts.mo.data.init_storage import initialize_storage
+from scripts.mo.data.record_utils import get_local_model_dirs
+from scripts.mo.dl.download_manager import DownloadManager
 from scripts.mo.environment import *
 from scripts.mo.ui_main import main_ui_block
 
@@ -128,6 +131,54 @@ env.autobind_file = (
     else True
 )
 	
+env.watch_model_dirs = (
+    lambda: shared.opts.mo_watch_model_dirs
+    if hasattr(shared.opts, 'mo_watch_model_dirs')
+    else True
+)
+
+env.hash_visible_records = (
+    lambda: shared.opts.mo_hash_visible_records
+    if hasattr(shared.opts, 'mo_hash_visible_records')
+    else False
+)
+
+env.hash_bandwidth_limit = (
+    lambda: int(shared.opts.mo_hash_bandwidth_limit or 0)
+    if hasattr(shared.opts, 'mo_hash_bandwidth_limit')
+    else 50
+)
+
+env.download_workers = (
+    lambda: int(shared.opts.mo_download_workers)
+    if hasattr(shared.opts, 'mo_download_workers') and shared.opts.mo_download_workers
+    else 4
+)
+
+env.download_host_workers = (
+    lambda: int(shared.opts.mo_download_host_workers)
+    if hasattr(shared.opts, 'mo_download_host_workers') and shared.opts.mo_download_host_workers
+    else 3
+)
+
+env.download_console_progress = (
+    lambda: shared.opts.mo_download_console_progress
+    if hasattr(shared.opts, 'mo_download_console_progress')
+    else True
+)
+
+env.link_existing_files = (
+    lambda: shared.opts.mo_link_existing_files
+    if hasattr(shared.opts, 'mo_link_existing_files')
+    else True
+)
+
+env.model_store_path = (
+    lambda: shared.opts.mo_model_store_path
+    if hasattr(shared.opts, 'mo_model_store_path')
+    else ''
+)
+
 env.api_key = (
     lambda: shared.opts.mo_api_key
     if hasattr(shared.opts, 'mo_api_key')
@@ -197,6 +248,17 @@ def on_ui_settings():
         'mo_prefill_pos_prompt': OptionInfo(True, 'When creating a record based on local file, automatically import the added positive prompts'),
         'mo_prefill_neg_prompt': OptionInfo(True, 'When creating a record based on local file, automatically import the added negative prompts'),
         'mo_autobind_file': OptionInfo(True, 'Automatically bind record to local file'),
+        'mo_watch_model_dirs': OptionInfo(True, 'Watch model directories for changes to keep local files list '
+                                                'up to date (requires restart)'),
+        'mo_hash_visible_records': OptionInfo(False, 'Hash downloaded records shown on the home screen in background'),
+        'mo_hash_bandwidth_limit': OptionInfo(50, 'Background hashing read speed limit, MB/s (0 - unlimited)'),
+        'mo_download_workers': OptionInfo(4, 'Number of concurrent downloads'),
+        'mo_download_host_workers': OptionInfo(3, 'Maximum concurrent downloads from the same host'),
+        'mo_download_console_progress': OptionInfo(True, 'Show download progress bars in the console'),
+        'mo_link_existing_files': OptionInfo(True, 'Link local files with the same SHA256 instead of downloading '
+                                                   'them again'),
+        'mo_model_store_path': OptionInfo('', 'Model store directory, downloaded files are kept there by SHA256 and '
+                                              'hardlinked into model directories (disabled if empty)'),
         'mo_api_key': OptionInfo("", "Civitai API Key. Create an API key under 'https://civitai.com/user/account' all the way at the bottom. Don't share the token!"),
     }
 
@@ -263,6 +325,13 @@ def on_ui_tabs():
 def on_app_started(demo: Optional[Blocks], app: FastAPI):
     init_extension_api(app)
 
+    if env.watch_model_dirs():
+        FileWatcher.instance().start(get_local_model_dirs)
+
+    # Downloads interrupted by the restart are continued.
+    if hasattr(env, 'storage'):
+        DownloadManager.instance().resume_queue()
+
 
 script_callbacks.on_ui_settings(on_ui_settings)
 script_callbacks.on_ui_tabs(on_ui_tabs)